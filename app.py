@@ -2,66 +2,100 @@
 
 import streamlit as st
 import os
-import json
-import time
+import uuid
 from datetime import datetime
-import pandas as pd
 
 from backend import (
-    client, get_engine, build_conversation,
-    clean_text, parse_json_decision, extract_sql_queries,
-    run_sql_query, safe_chat_completion, LOG_FILE
+    LLM_MODEL, get_engine, get_first_table, get_llm_scheduler_stats, get_pool_metrics, get_query_cache_stats, setup_logging
 )
-from utils import load_txt
-from rag import create_rag_store, retrieve_relevant_chunks
-from base_prompt import DECIDE_INSTRUCTION as decide_instruction, BASE_SYSTEM_PROMPT
+from rag import get_rag_store, get_rag_sync_stats, retrieve_relevant_chunks
+from pipeline import astream_turn, iterate_sync
+from tokens import count_tokens
+from tracing import start_metrics_server, stats as trace_stats
+from chat_client import CHAT_API_URL, stream_turn
+from sql_cache import sql_cache
+from history_store import HISTORY_PAGE_SIZE, HISTORY_WINDOW, append_message, recent_history, recent_messages, session_stats
 
 # ---------------- Streamlit setup ----------------
 st.set_page_config(page_title="LLM + SQL Chat", layout="wide")
 st.title("🤖 Chat con la Base de Datos")
 
 # ---------------- Session state ----------------
-if "messages" not in st.session_state:
-    st.session_state["messages"] = []
+# El historial vive en history_store (SQLite), indexado por sesión; el id de sesión
+# va en la URL para que recargar la página o reiniciar el proceso no lo pierda
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = st.query_params.get("session") or uuid.uuid4().hex
+    st.query_params["session"] = st.session_state["session_id"]
+session_id = st.session_state["session_id"]
+if "history_limit" not in st.session_state:
+    st.session_state["history_limit"] = HISTORY_WINDOW
 if "total_tokens" not in st.session_state:
     st.session_state["total_tokens"] = 0
-if "tokens_per_message" not in st.session_state:
-    st.session_state["tokens_per_message"] = []
+if "token_breakdown" not in st.session_state:
+    st.session_state["token_breakdown"] = {}
+
+# Log a archivo (basicConfig: solo la primera vez en el proceso)
+setup_logging()
+
+# /metrics de Prometheus (solo si METRICS_PORT está definido; una vez por proceso)
+start_metrics_server()
 
 # ---------------- Engine & conversation ----------------
-engine = get_engine()
+# Con CHAT_API_URL la app es un cliente liviano: engine, esquema y RAG viven en server.py
+engine = None if CHAT_API_URL else get_engine()
 db_name = os.getenv("POSTGRES_DB", "N/A")
-conversation = build_conversation(engine)
-first_table = "N/A" if engine is None else None
-if engine:
-    res = run_sql_query(engine, 
-        "SELECT table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_name LIMIT 1")
-    if res.get("rows"):
-        first_table = res["rows"][0]["table_name"]
+first_table = get_first_table(engine)
 
 # ---------------- Sidebar ----------------
 st.sidebar.header("🔗 Conexión")
-st.sidebar.markdown(f"**Base de datos:** `{db_name}`")
-st.sidebar.markdown(f"**Primera tabla:** `{first_table}`")
+if CHAT_API_URL:
+    st.sidebar.markdown(f"**Servicio de chat:** `{CHAT_API_URL}`")
+else:
+    st.sidebar.markdown(f"**Base de datos:** `{db_name}`")
+    st.sidebar.markdown(f"**Primera tabla:** `{first_table}`")
 st.sidebar.markdown(f"**Tokens consumidos:** {st.session_state['total_tokens']}")
+history_stats = session_stats(session_id)
+st.sidebar.markdown(f"**Mensajes en la sesión:** {history_stats['messages']}")
+if st.session_state["token_breakdown"]:
+    with st.sidebar.expander("🧮 Tokens del último turno"):
+        st.json(st.session_state["token_breakdown"])
+if engine:
+    with st.sidebar.expander("🔌 Pool de conexiones"):
+        st.json(get_pool_metrics(engine))
+    with st.sidebar.expander("🗃️ Caché de consultas"):
+        st.json(get_query_cache_stats())
+if not CHAT_API_URL:
+    with st.sidebar.expander("🚦 Planificador LLM"):
+        st.json(get_llm_scheduler_stats())
+    with st.sidebar.expander("🧠 Caché pregunta → SQL"):
+        st.json(sql_cache.stats())
+trace_snapshot = trace_stats.snapshot()
+if trace_snapshot:
+    with st.sidebar.expander("🩺 Diagnóstico"):
+        st.caption("Duración por etapa (ms) en los últimos turnos")
+        st.dataframe(
+            [{"etapa": name, **{k: v for k, v in s.items() if k != "totals"}} for name, s in trace_snapshot.items()],
+            hide_index=True,
+        )
+        st.json({name: s["totals"] for name, s in trace_snapshot.items() if s["totals"]})
+
+def format_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
 
 if st.sidebar.button("📜 Ver historial de conversación"):
-    for msg in st.session_state["messages"]:
-        ts = msg.get("time", "")
+    # Solo la última página; la conversación completa se recorre con "Cargar mensajes anteriores"
+    for msg in recent_messages(session_id, HISTORY_PAGE_SIZE):
         role = "Usuario" if msg["role"] == "user" else "Asistente"
-        tokens = msg.get("tokens", "N/A")
-        st.sidebar.write(f"[{ts}] {role} ({tokens} tokens): {msg['content']}")
+        st.sidebar.write(f"[{format_ts(msg['ts'])}] {role} ({msg['tokens']} tokens): {msg['content']}")
+
+# ---------------- RAG ----------------
+vectordb = None if CHAT_API_URL else get_rag_store(chunk_size=1000, chunk_overlap=50)
 
 if st.sidebar.button("📘 Ver contexto relevante"):
-    txt_content = load_txt()
-    if txt_content:
-        vectordb = create_rag_store(txt_content, chunk_size=1000, chunk_overlap=50)
+    if vectordb:
         context = retrieve_relevant_chunks("", vectordb, top_k=5)
         st.sidebar.text_area("Contexto relevante", value=context, height=300)
-
-# ---------------- RAG ----------------
-txt_content = load_txt()
-vectordb = create_rag_store(txt_content, chunk_size=1000, chunk_overlap=50) if txt_content else None
+        st.sidebar.caption(f"Última sincronización del índice: {get_rag_sync_stats()}")
 
 # ---------------- Función de burbujas de chat ----------------
 def chat_bubble(role, content, timestamp):
@@ -85,142 +119,59 @@ def chat_bubble(role, content, timestamp):
     """, unsafe_allow_html=True)
 
 # ---------------- Mostrar chat previo ----------------
-for msg in st.session_state["messages"]:
-    chat_bubble(msg["role"], msg["content"], msg["time"])
+# Solo la ventana de los últimos history_limit mensajes; cada clic suma una página más
+visible = recent_messages(session_id, st.session_state["history_limit"])
+if len(visible) < history_stats["messages"]:
+    if st.button(f"⬆️ Cargar mensajes anteriores ({history_stats['messages'] - len(visible)} más)"):
+        st.session_state["history_limit"] += HISTORY_PAGE_SIZE
+        st.rerun()
+for msg in visible:
+    chat_bubble(msg["role"], msg["content"], format_ts(msg["ts"]))
 
 # ---------------- Input del usuario ----------------
 user_prompt = st.chat_input("Escribe tu pregunta sobre los datos...")
 
 if user_prompt:
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    user_tokens = len(user_prompt.split())
-    st.session_state["messages"].append({"role": "user", "content": user_prompt, "time": timestamp, "tokens": user_tokens})
-    st.session_state["tokens_per_message"].append({"role": "user", "tokens": user_tokens})
-    chat_bubble("user", user_prompt, timestamp)
-
     MAX_HISTORY = 10
-    recent_history = st.session_state["messages"][-MAX_HISTORY:]
-
-    # ---------------- Construir prompt optimizado ----------------
-    # Inyectar ejemplos avanzados de SQL como contexto
-    advanced_context = BASE_SYSTEM_PROMPT.replace("{db_schema}", "").replace("{table_name}", first_table).replace("{table_examples}", "")
-    if vectordb:
-        relevant_context = retrieve_relevant_chunks(user_prompt, vectordb)
-        if relevant_context:
-            advanced_context += f"\n\nInformación relevante del archivo:\n{relevant_context}"
+    # El historial para el modelo se lee antes de guardar la pregunta: ya va aparte en el prompt
+    history = recent_history(session_id, MAX_HISTORY)
 
-    messages_for_model = conversation + recent_history + [
-        {"role": "system", "content": advanced_context},
-        {"role": "system", "content": decide_instruction}
-    ]
+    timestamp = datetime.now()
+    user_tokens = count_tokens(user_prompt, LLM_MODEL)
+    append_message(session_id, "user", user_prompt, user_tokens, timestamp.timestamp())
+    chat_bubble("user", user_prompt, timestamp.strftime("%Y-%m-%d %H:%M:%S"))
 
     placeholder = st.empty()
     placeholder.markdown('<div style="font-style: italic; color: gray;">Asistente está escribiendo...</div>', unsafe_allow_html=True)
 
-    with st.spinner("Generando respuesta..."):
-        time.sleep(0.5)
-        # ---------------- Paso 1: Generar decisión JSON ----------------
-        try:
-            dec_resp = safe_chat_completion(model="gpt-4o-mini", messages=messages_for_model)
-            dec_text = dec_resp.choices[0].message.content
-            used_tokens = getattr(dec_resp.usage, "total_tokens", 0)
-            st.session_state["total_tokens"] += used_tokens
-            st.session_state["tokens_per_message"].append({"role": "assistant", "tokens": used_tokens})
-        except Exception as e:
-            dec_text = f'{{"needs_sql": false, "sql": [], "notes": "error: {str(e)}"}}'
-
-        # ---------------- Paso 2: Parsear decisión ----------------
-        decision = parse_json_decision(dec_text)
-        queries = []
-        needs_sql = False
-        if decision:
-            needs_sql = bool(decision.get("needs_sql", False))
-            queries = decision.get("sql") or []
-            if isinstance(queries, str):
-                queries = extract_sql_queries(queries)
-            queries = [q.strip().rstrip(";") + ";" for q in queries if q]
-        else:
-            queries = extract_sql_queries(dec_text)
-            needs_sql = bool(queries)
-
-        # ---------------- Paso 3: Ejecutar SQL y generar respuesta final ----------------
-        final_answer = None
-        if needs_sql and queries:
-            results_for_model = []
-            all_errors = []
-            for q in queries:
-                res = run_sql_query(engine, q)
-                results_for_model.append({"query": q, "result": res})
-                if "error" in res:
-                    all_errors.append(res["error"])
-
-            results_json = json.dumps(results_for_model, ensure_ascii=False, default=str)
-
-            if all_errors:
-                final_answer = "⚠️ Algunas consultas fallaron:\n" + "\n".join(all_errors)
-            else:
-                final_instr = """Entrega UNA RESPUESTA clara y concisa basada en los resultados de SQL.
-Resume solo lo que pide el usuario.
-No repitas información de respuestas anteriores.
-No muestres SQL ni tablas crudas."""
-
-                final_messages = conversation + recent_history + [
-                    {"role": "system", "content": final_instr},
-                    {"role": "user", "content": f"Pregunta original: {user_prompt}\nResultados ejecutados: {results_json}"}
-                ]
-
-                try:
-                    final_resp = safe_chat_completion(model="gpt-4o-mini", messages=final_messages)
-                    final_answer = clean_text(final_resp.choices[0].message.content)
-                    used_tokens = getattr(final_resp.usage, "total_tokens", 0)
-                    st.session_state["total_tokens"] += used_tokens
-                    st.session_state["tokens_per_message"].append({"role": "assistant", "tokens": used_tokens})
-                except Exception as e:
-                    final_answer = f"Error generando respuesta final: {e}"
-        else:
-            # ---------------- Consulta general sin SQL ----------------
-            general_prompt = """
-Responde solo con lenguaje natural si no se requiere SQL.
-"""
-            context_info = ""
-            if vectordb:
-                relevant_context = retrieve_relevant_chunks(user_prompt, vectordb)
-                if relevant_context:
-                    context_info = f"\nInformación contextual de la base:\n{relevant_context}"
-
-            try:
-                general_resp = safe_chat_completion(model="gpt-4o-mini", messages=[
-                    {"role": "system", "content": general_prompt + context_info},
-                    {"role": "user", "content": user_prompt}
-                ])
-                final_answer = clean_text(general_resp.choices[0].message.content)
-                used_tokens = getattr(general_resp.usage, "total_tokens", 0)
-                st.session_state["total_tokens"] += used_tokens
-                st.session_state["tokens_per_message"].append({"role": "assistant", "tokens": used_tokens})
-            except Exception as e:
-                final_answer = f"Error generando respuesta conversacional: {e}"
-
-        # ---------------- Mostrar respuesta ----------------
-        placeholder.empty()
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        st.session_state["messages"].append({"role": "assistant", "content": final_answer, "time": timestamp, "tokens": used_tokens})
-        chat_bubble("assistant", final_answer, timestamp)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    turn_result = {"answer": "", "tokens": 0}
+    st.session_state["token_breakdown"] = {}
 
+    def answer_tokens():
+        """Pasa a st.write_stream solo el texto; el resto de eventos actualiza el estado."""
+        if CHAT_API_URL:
+            events = stream_turn(user_prompt, history)
+        else:
+            events = iterate_sync(astream_turn(engine, vectordb, user_prompt, history))
+        for event in events:
+            if event["type"] == "token":
+                yield event["text"]
+            elif event["type"] == "usage":
+                st.session_state["total_tokens"] += event["tokens"]
+            elif event["type"] == "budget":
+                st.session_state["token_breakdown"][event["call"]] = {
+                    k: v for k, v in event.items() if k not in ("type", "call")
+                }
+            elif event["type"] == "done":
+                turn_result.update(event)
 
+    with st.spinner("Generando respuesta..."):
+        with placeholder.container():
+            st.write_stream(answer_tokens())
+
+    # ---------------- Mostrar respuesta ----------------
+    placeholder.empty()
+    final_answer = turn_result["answer"]
+    timestamp = datetime.now()
+    append_message(session_id, "assistant", final_answer, turn_result["tokens"], timestamp.timestamp())
+    chat_bubble("assistant", final_answer, timestamp.strftime("%Y-%m-%d %H:%M:%S"))
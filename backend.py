@@ -5,25 +5,114 @@ import json
 import ast
 import logging
 import time
+import threading
+import hashlib
+from collections import OrderedDict, deque
+from datetime import date, datetime
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
-from openai import OpenAI
 from sqlalchemy import create_engine, text
-from base_prompt import BASE_SYSTEM_PROMPT
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+import sqlglot
+from sqlglot import exp
+from prompting import static_system_prompt
+from rollups import rollups_prompt_text
+from downsample import (
+    DOWNSAMPLE, DOWNSAMPLE_POINTS, DOWNSAMPLE_SQL, bucketed_query, downsample_result, finish_bucketed_result,
+    series_order_column,
+)
+from sql_validation import extract_sql, is_read_only
+from tracing import bind_context, current_span, span, start_span
+from tokens import count_message_tokens
+from llm_scheduler import (
+    LLM_BACKOFF_BASE_S, LLM_CALL_DEADLINE_S, LLM_COMPLETION_ESTIMATE, LLM_MAX_ATTEMPTS, scheduler
+)
 from utils import load_txt  # moved to utils
 
-# Logging
+# Logging: lo configuran los puntos de entrada (app, server, loader, bench) con
+# setup_logging(); importar este módulo no toca la configuración del proceso
 LOG_FILE = "llm_sql.log"
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
 
-# Load env & OpenAI client
+
+def setup_logging():
+    """Log a LOG_FILE; no hace nada si el proceso ya tiene logging configurado."""
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+
+
+# Load env. Los clientes de OpenAI (y el SDK, que es pesado de importar) se crean
+# en el primer uso: get_openai_client()
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+_CLIENTS = {}
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_openai_client(async_client: bool = False):
+    """Cliente de OpenAI compartido por el proceso (AsyncOpenAI con async_client=True)."""
+    with _CLIENT_LOCK:
+        if async_client not in _CLIENTS:
+            from openai import AsyncOpenAI, OpenAI
+            cls = AsyncOpenAI if async_client else OpenAI
+            # Sin reintentos propios del SDK: los maneja el planificador compartido (llm_scheduler.py)
+            _CLIENTS[async_client] = cls(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        return _CLIENTS[async_client]
+
+
+def __getattr__(name):
+    # backend.client / backend.aclient siguen disponibles, creados en el primer acceso
+    if name == "client":
+        return get_openai_client()
+    if name == "aclient":
+        return get_openai_client(async_client=True)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# DB connection factory: un único engine con pool por URL, compartido por todas
+# las sesiones del proceso (Streamlit re-ejecuta el script en cada interacción).
+_ENGINES = {}
+_POOL_STATS = {}
+_ENGINE_LOCK = threading.Lock()
+
+
+class _PoolStats:
+    """Latencias de checkout y timeouts del pool de un engine."""
+
+    def __init__(self, window: int = 512):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.recent = deque(maxlen=window)
+
+    def record(self, elapsed_ms: float):
+        with self.lock:
+            self.checkouts += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            self.recent.append(elapsed_ms)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            recent = sorted(self.recent)
+            p95 = recent[int(0.95 * (len(recent) - 1))] if recent else 0.0
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "checkout_ms_avg": round(self.total_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "checkout_ms_p95": round(p95, 3),
+                "checkout_ms_max": round(self.max_ms, 3),
+            }
+
 
-# DB connection factory (engine created lazily)
 def get_engine():
     db_user = os.getenv("POSTGRES_USER")
     db_pass = os.getenv("POSTGRES_PASSWORD")
@@ -32,7 +121,198 @@ def get_engine():
     db_name = os.getenv("POSTGRES_DB")
     if not all([db_user, db_pass, db_name]):
         return None
-    return create_engine(f"postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}")
+    url = f"postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
+    with _ENGINE_LOCK:
+        engine = _ENGINES.get(url)
+        if engine is None:
+            statement_timeout = int(os.getenv("POSTGRES_STATEMENT_TIMEOUT_MS", "30000"))
+            connect_args = {"options": f"-c statement_timeout={statement_timeout}"} if statement_timeout > 0 else {}
+            engine = create_engine(
+                url,
+                pool_size=int(os.getenv("POSTGRES_POOL_SIZE", "5")),
+                max_overflow=int(os.getenv("POSTGRES_MAX_OVERFLOW", "10")),
+                pool_timeout=float(os.getenv("POSTGRES_POOL_TIMEOUT", "30")),
+                pool_recycle=int(os.getenv("POSTGRES_POOL_RECYCLE", "1800")),
+                pool_pre_ping=os.getenv("POSTGRES_POOL_PRE_PING", "1").lower() not in ("0", "false", "no"),
+                connect_args=connect_args,
+            )
+            _ENGINES[url] = engine
+            # Misma clave con la que se leen (db_connection, get_pool_metrics): la URL renderizada
+            _POOL_STATS[_engine_key(engine)] = _PoolStats()
+    return engine
+
+
+def _engine_key(engine) -> str:
+    return engine.url.render_as_string(hide_password=False)
+
+
+@contextmanager
+def db_connection(engine):
+    """Toma una conexión del pool midiendo cuánto se esperó por ella."""
+    stats = _POOL_STATS.get(_engine_key(engine))
+    start = time.perf_counter()
+    try:
+        conn = engine.connect()
+    except PoolTimeoutError:
+        if stats:
+            with stats.lock:
+                stats.timeouts += 1
+        raise
+    if stats:
+        stats.record((time.perf_counter() - start) * 1000)
+    with conn:
+        yield conn
+
+
+def get_pool_metrics(engine) -> dict:
+    """Uso del pool (en uso, overflow, libres) y latencias de checkout del engine."""
+    if engine is None:
+        return {}
+    pool = engine.pool
+    metrics = {}
+    if isinstance(pool, QueuePool):
+        metrics.update({
+            "pool_size": pool.size(),
+            "in_use": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": pool.overflow(),
+        })
+    stats = _POOL_STATS.get(_engine_key(engine))
+    if stats:
+        metrics.update(stats.snapshot())
+    return metrics
+
+# ===================== CATÁLOGO DE ESQUEMA ======================
+# El catálogo (tablas, columnas, tipos y filas de ejemplo) se carga con una sola
+# consulta y se comparte entre sesiones por URL de la base. Al vencer el TTL se
+# compara una huella barata de pg_class/pg_attribute antes de recargarlo.
+
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", "300"))
+SAMPLE_ROWS = int(os.getenv("SCHEMA_SAMPLE_ROWS", "5"))
+
+_CATALOG_QUERY = """
+    SELECT table_name, column_name, data_type
+    FROM information_schema.columns
+    WHERE table_schema = 'public'
+    ORDER BY table_name, ordinal_position
+"""
+
+# information_schema no lista las vistas materializadas (rollups): se leen de pg_attribute
+_MATVIEW_QUERY = """
+    SELECT c.relname, a.attname, format_type(a.atttypid, a.atttypmod)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid
+    WHERE n.nspname = 'public' AND c.relkind = 'm' AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY c.relname, a.attnum
+"""
+
+_FINGERPRINT_QUERY = """
+    SELECT md5(coalesce(string_agg(
+        c.oid::text || ':' || c.relname || ':' || a.attnum || ':' || a.attname || ':' || a.atttypid::text,
+        ',' ORDER BY c.oid, a.attnum), ''))
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'v', 'm', 'p', 'f')
+      AND a.attnum > 0 AND NOT a.attisdropped
+"""
+
+
+@dataclass
+class SchemaCatalog:
+    """Foto del esquema público de una base, con el texto ya renderizado para el prompt."""
+    tables: dict = field(default_factory=dict)  # {tabla: [(columna, tipo), ...]}
+    views: dict = field(default_factory=dict)  # vistas materializadas, mismo formato
+    fingerprint: str = ""
+    sample_rows: list = field(default_factory=list)
+    sample_error: str = ""
+    loaded_at: float = 0.0
+
+    @property
+    def first_table(self) -> str:
+        return next(iter(sorted(self.tables)), "N/A")
+
+    @property
+    def samples(self) -> str:
+        return self.samples_text()
+
+    def samples_text(self, limit: int = None) -> str:
+        """Filas de ejemplo en JSON (las primeras `limit`, o todas)."""
+        if self.sample_error:
+            return self.sample_error
+        rows = self.sample_rows if limit is None else self.sample_rows[:limit]
+        return json.dumps(rows, indent=2, ensure_ascii=False, default=str)
+
+    @property
+    def schema_text(self) -> str:
+        return "\n".join(
+            f"Tabla {t}: columnas = {', '.join(f'{c} ({d})' for c, d in cols)}"
+            for t, cols in sorted(self.tables.items())
+        )
+
+
+_SCHEMA_CACHE = {}
+_SCHEMA_LOCK = threading.Lock()
+
+
+def _schema_fingerprint(conn) -> str:
+    return conn.execute(text(_FINGERPRINT_QUERY)).scalar() or ""
+
+
+def _load_schema_catalog(conn) -> SchemaCatalog:
+    catalog = SchemaCatalog(fingerprint=_schema_fingerprint(conn), loaded_at=time.monotonic())
+    for table_name, column_name, data_type in conn.execute(text(_CATALOG_QUERY)):
+        catalog.tables.setdefault(table_name, []).append((column_name, data_type))
+    for view_name, column_name, data_type in conn.execute(text(_MATVIEW_QUERY)):
+        catalog.views.setdefault(view_name, []).append((column_name, data_type))
+    t = catalog.first_table
+    if t == "N/A":
+        catalog.sample_error = "No se encontraron tablas en la base de datos."
+        return catalog
+    try:
+        res = conn.execute(text(f"SELECT * FROM \"{t}\" LIMIT {SAMPLE_ROWS}"))
+        catalog.sample_rows = [{k: _to_plain(v) for k, v in r.items()} for r in res.mappings().all()]
+    except Exception as e:
+        conn.rollback()
+        catalog.sample_error = f"Error al obtener ejemplos de datos: {str(e)}"
+    return catalog
+
+
+def get_schema_catalog(engine, force: bool = False):
+    """Devuelve el catálogo cacheado de la base; lo recarga solo si cambió el esquema."""
+    if engine is None:
+        return None
+    key = _engine_key(engine)
+    with _SCHEMA_LOCK, span("schema.catalog") as trace:
+        cached = _SCHEMA_CACHE.get(key)
+        if cached and not force and time.monotonic() - cached.loaded_at < SCHEMA_CACHE_TTL:
+            trace.set(cache_hit=True)
+            return cached
+        try:
+            with db_connection(engine) as conn:
+                if cached and not force and _schema_fingerprint(conn) == cached.fingerprint:
+                    cached.loaded_at = time.monotonic()
+                    trace.set(cache_hit=True)
+                    return cached
+                catalog = _load_schema_catalog(conn)
+        except Exception:
+            logging.exception("Error cargando el catálogo de esquema")
+            if cached:
+                return cached
+            raise
+        trace.set(cache_hit=False)
+        _SCHEMA_CACHE[key] = catalog
+        return catalog
+
+
+def invalidate_schema_catalog(engine=None):
+    """Descarta el catálogo cacheado (de una base o de todas)."""
+    with _SCHEMA_LOCK:
+        if engine is None:
+            _SCHEMA_CACHE.clear()
+        else:
+            _SCHEMA_CACHE.pop(_engine_key(engine), None)
 
 # ===================== UTILIDADES ======================
 
@@ -40,86 +320,534 @@ def get_db_schema_text(engine):
     """Obtiene el esquema de tablas y columnas de la base."""
     if engine is None:
         return "Conexión a la DB no configurada."
-    schema_info = []
-    with engine.connect() as conn:
-        tables = conn.execute(text(
-            "SELECT table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_name"
-        ))
-        for (table_name,) in tables:
-            cols = conn.execute(text("""
-                SELECT column_name, data_type 
-                FROM information_schema.columns 
-                WHERE table_name = :t
-                ORDER BY ordinal_position
-            """), {"t": table_name})
-            col_list = [f"{col} ({dtype})" for col, dtype in cols]
-            schema_info.append(f"Tabla {table_name}: columnas = {', '.join(col_list)}")
-    return "\n".join(schema_info)
+    return get_schema_catalog(engine).schema_text
 
 def get_first_table(engine):
     """Obtiene el nombre de la primera tabla pública."""
     if engine is None:
         return "N/A"
-    with engine.connect() as conn:
-        res = conn.execute(text(
-            "SELECT table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_name LIMIT 1"
-        ))
-        row = res.fetchone()
-        return row[0] if row else "N/A"
-
-def get_table_samples(engine, limit=5):
+    return get_schema_catalog(engine).first_table
+
+def get_table_samples(engine):
     """Devuelve algunas filas de ejemplo (en texto) para contextualizar al modelo."""
-    t = get_first_table(engine)
-    if t == "N/A" or engine is None:
+    if engine is None:
         return "No se encontraron tablas en la base de datos."
-    try:
-        with engine.connect() as conn:
-            res = conn.execute(text(f"SELECT * FROM \"{t}\" LIMIT {limit}"))
-            rows = [dict(r) for r in res.mappings().all()]
-            return json.dumps(rows, indent=2, ensure_ascii=False)
-    except Exception as e:
-        return f"Error al obtener ejemplos de datos: {str(e)}"
+    return get_schema_catalog(engine).samples
 
 # ===================== CONFIGURACIÓN DE CONVERSACIÓN (factory) ======================
-def build_conversation(engine):
-    """Construye el system message usando estado actual de la DB y archivo instrucciones."""
-    extra_context = load_txt()
-    base = BASE_SYSTEM_PROMPT \
-        .replace("{db_schema}", get_db_schema_text(engine)) \
-        .replace("{table_name}", get_first_table(engine)) \
-        .replace("{table_examples}", get_table_samples(engine))
-    if extra_context:
-        base = base + ("\n\n📘 Contexto adicional del archivo:\n" + extra_context)
-    return [{"role": "system", "content": base}]
+def build_conversation(engine, sample_rows: int = None):
+    """Construye el system message usando estado actual de la DB y archivo instrucciones.
+
+    `sample_rows` limita las filas de ejemplo incluidas (lo usa el recorte por presupuesto de tokens).
+    """
+    return [{"role": "system", "content": system_prompt_text(get_schema_catalog(engine), load_txt(), sample_rows)}]
+
+
+def system_prompt_text(catalog, extra_context: str, sample_rows: int = None) -> str:
+    """Texto del system message para un catálogo ya cargado; no consulta la base ni lee archivos."""
+    if catalog is None:
+        schema_text, table_name, samples = "Conexión a la DB no configurada.", "N/A", "No se encontraron tablas en la base de datos."
+    else:
+        schema_text, table_name, samples = catalog.schema_text, catalog.first_table, catalog.samples_text(sample_rows)
+        rollups_text = rollups_prompt_text(catalog)
+        if rollups_text:
+            schema_text = f"{schema_text}\n\n{rollups_text}"
+    return static_system_prompt(schema_text, table_name, samples, extra_context)
 
 # ===================== FUNCIONES SQL ======================
 
 def is_safe_sql(q: str) -> bool:
-    """Valida que la query sea SELECT/ WITH (ignorando comentarios/espacios iniciales)."""
-    if not q:
-        return False
-    # remover comentarios SQL de línea
-    q_clean = re.sub(r'--.*?(\n|$)', ' ', q)
-    # remover comentarios C style
-    q_clean = re.sub(r'/\*.*?\*/', ' ', q_clean, flags=re.DOTALL)
-    q_s = q_clean.strip().lower()
-    return q_s.startswith("select") or q_s.startswith("with")
-
-def run_sql_query(engine, query: str):
-    """Ejecuta SQL si es seguro."""
+    """Valida que la query sea exactamente una sentencia SELECT/WITH de solo lectura y sin funciones no permitidas (parseada con sqlglot)."""
+    return is_read_only(q)
+
+# Límites del fetch en streaming (cursor del lado del servidor)
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "10000"))
+SQL_MAX_BYTES = int(os.getenv("SQL_MAX_BYTES", "2000000"))
+SQL_YIELD_PER = int(os.getenv("SQL_YIELD_PER", "1000"))
+# Timeout por consulta (0 = el statement_timeout del engine) y paralelismo de lotes
+SQL_QUERY_TIMEOUT_MS = int(os.getenv("SQL_QUERY_TIMEOUT_MS", "0"))
+SQL_MAX_WORKERS = int(os.getenv("SQL_MAX_WORKERS", "4"))
+# Guardia previa a la ejecución: EXPLAIN (FORMAT JSON) y umbrales del plan estimado
+SQL_GUARD = os.getenv("SQL_GUARD", "1") == "1"
+SQL_MAX_COST = float(os.getenv("SQL_MAX_COST", "1000000"))
+SQL_GUARD_TIMEOUT_MS = int(os.getenv("SQL_GUARD_TIMEOUT_MS", "15000"))
+_SQL_EXECUTOR = ThreadPoolExecutor(max_workers=SQL_MAX_WORKERS, thread_name_prefix="sql")
+
+
+def _to_plain(value):
+    """Convierte valores del driver a tipos JSON compactos (Decimal -> float)."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() and value.as_tuple().exponent >= 0 else float(value)
+    return value
+
+
+def _column_type(values) -> str:
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            return "boolean"
+        if isinstance(v, int):
+            return "integer"
+        if isinstance(v, float):
+            return "number"
+        if isinstance(v, (datetime, date)):
+            return "datetime"
+        return "text"
+    return "null"
+
+
+def result_rows(result: dict) -> list:
+    """Reconstruye filas (dicts) a partir de un resultado columnar de run_sql_query."""
+    columns = result.get("columns") or []
+    return [dict(zip(columns, row)) for row in zip(*result.get("data") or [])]
+
+
+# ===================== CACHÉ DE RESULTADOS ======================
+# Clave = SQL normalizado + versión de datos (contadores de pg_stat_user_tables,
+# huella del esquema y un contador explícito que se incrementa tras cada recarga).
+# Nivel en memoria (LRU acotado en bytes) y nivel opcional en disco compartido
+# entre procesos de Streamlit (QUERY_CACHE_DIR).
+
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+QUERY_CACHE_DIR = os.getenv("QUERY_CACHE_DIR", "")
+QUERY_CACHE_DISK_MAX_BYTES = int(os.getenv("QUERY_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+DATA_VERSION_TTL = float(os.getenv("DATA_VERSION_TTL", "5"))
+
+_DATA_VERSION_QUERY = """
+    SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0)::text || ':' || coalesce(sum(n_live_tup), 0)::text
+    FROM pg_stat_user_tables
+    WHERE schemaname = 'public'
+"""
+
+
+def normalize_sql(query: str) -> str:
+    """Quita comentarios, espacios redundantes y ';' final; pasa a minúsculas fuera de comillas."""
+    q = re.sub(r"--[^\n]*", " ", query)
+    q = re.sub(r"/\*.*?\*/", " ", q, flags=re.DOTALL)
+    parts = re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", q)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i]).lower()
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+class QueryResultCache:
+    """LRU de resultados con desalojo por bytes y nivel opcional en disco."""
+
+    def __init__(self, max_bytes: int, disk_dir: str = "", disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (result, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _store(self, key: str, result: dict, size: int):
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old:
+            self._bytes -= old[1]
+        self._entries[key] = (result, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+            self.evictions += 1
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                    payload = f.read()
+                result = json.loads(payload)
+                with self._lock:
+                    self.disk_hits += 1
+                    self._store(key, result, len(payload))
+                return result
+            except (OSError, ValueError):
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, result: dict):
+        payload = json.dumps(result, ensure_ascii=False, default=str, separators=(",", ":"))
+        with self._lock:
+            self._store(key, result, len(payload))
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(payload)
+                os.replace(tmp, path)
+                self._prune_disk()
+            except OSError:
+                logging.warning("No se pudo escribir la caché de resultados en disco", exc_info=True)
+
+    def _prune_disk(self):
+        files = [e for e in os.scandir(self.disk_dir) if e.name.endswith(".json")]
+        total = sum(e.stat().st_size for e in files)
+        if total <= self.disk_max_bytes:
+            return
+        for e in sorted(files, key=lambda e: e.stat().st_mtime):
+            try:
+                total -= e.stat().st_size
+                os.remove(e.path)
+            except OSError:
+                pass
+            if total <= self.disk_max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+query_cache = QueryResultCache(QUERY_CACHE_MAX_BYTES, QUERY_CACHE_DIR, QUERY_CACHE_DISK_MAX_BYTES)
+_DATA_VERSIONS = {}  # engine key -> (version, leído en)
+_DATA_VERSION_BUMP = 0
+_DATA_VERSION_LOCK = threading.Lock()
+
+
+def bump_data_version():
+    """Invalida los resultados cacheados (llamar tras recargar o modificar datos)."""
+    global _DATA_VERSION_BUMP
+    with _DATA_VERSION_LOCK:
+        _DATA_VERSION_BUMP += 1
+        _DATA_VERSIONS.clear()
+
+
+def get_data_version(engine):
+    """Token de versión de los datos; se consulta a pg_stat como mucho cada DATA_VERSION_TTL s.
+
+    Devuelve None si pg_stat no se pudo leer: sin versión no se puede saber si un
+    resultado cacheado sigue vigente, así que la caché no se usa.
+    """
+    key = _engine_key(engine)
+    with _DATA_VERSION_LOCK:
+        cached = _DATA_VERSIONS.get(key)
+        bump = _DATA_VERSION_BUMP
+    if cached and time.monotonic() - cached[1] < DATA_VERSION_TTL:
+        return cached[0]
+    try:
+        with db_connection(engine) as conn:
+            stat = conn.execute(text(_DATA_VERSION_QUERY)).scalar() or ""
+    except Exception:
+        logging.warning("No se pudo leer pg_stat_user_tables para la versión de datos", exc_info=True)
+        return None
+    catalog = _SCHEMA_CACHE.get(key)
+    version = f"{bump}:{stat}:{catalog.fingerprint if catalog else ''}"
+    with _DATA_VERSION_LOCK:
+        _DATA_VERSIONS[key] = (version, time.monotonic())
+    return version
+
+
+def get_query_cache_stats() -> dict:
+    return query_cache.stats()
+
+
+class QueryCancelled(Exception):
+    """La consulta se canceló porque otra del mismo lote falló."""
+
+
+class _CancelScope:
+    """Permite cancelar las consultas en curso de un lote (psycopg2 connection.cancel())."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._conns = set()
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def register(self, dbapi_conn):
+        with self._lock:
+            self._conns.add(dbapi_conn)
+
+    def unregister(self, dbapi_conn):
+        with self._lock:
+            self._conns.discard(dbapi_conn)
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            conns = list(self._conns)
+        for c in conns:
+            try:
+                c.cancel()
+            except Exception:
+                pass
+
+
+class QueryRejected(Exception):
+    """La guardia de costo rechazó la consulta antes de ejecutarla."""
+
+    def __init__(self, result: dict):
+        super().__init__(result["error"])
+        self.result = result
+
+
+def _explain(conn, query: str) -> dict:
+    """Nodo raíz del plan estimado: {"Total Cost", "Plan Rows", ...}."""
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def _with_limit(query: str, limit: int) -> str:
+    """Agrega (o baja) el LIMIT de una consulta que devuelve filas."""
+    try:
+        tree = sqlglot.parse_one(query, read="postgres")
+    except sqlglot.errors.ParseError:
+        tree = None
+    if isinstance(tree, exp.Query):
+        current = tree.args.get("limit")
+        value = current.expression if current is not None else None
+        if isinstance(value, exp.Literal) and value.is_int and int(value.this) <= limit:
+            return query
+        return tree.limit(limit).sql(dialect="postgres")
+    return f"SELECT * FROM ({query.strip().rstrip(';')}) AS limited LIMIT {limit}"
+
+
+# OIDs numéricos de Postgres: int8, int2, int4, float4, float8, numeric
+_NUMERIC_TYPE_OIDS = {20, 21, 23, 700, 701, 1700}
+
+
+def _bucketed_series(conn, query: str, max_rows: int):
+    """(consulta reducida en Postgres, eje) para una serie ordenada con columnas numéricas, o None."""
+    axis = series_order_column(query)
+    if axis is None:
+        return None
+    # LIMIT 0: solo planifica, y devuelve nombres y tipos de las columnas de salida
+    res = conn.execute(text(f"SELECT * FROM ({query.strip().rstrip(';')}) AS src LIMIT 0"))
+    description = res.cursor.description
+    res.close()
+    columns = [d[0] for d in description]
+    series = [d[0] for d in description if d[1] in _NUMERIC_TYPE_OIDS and d[0] != axis]
+    if axis not in columns or not series or len(set(columns)) != len(columns):
+        return None
+    return bucketed_query(query, axis, columns, series, min(DOWNSAMPLE_POINTS, max_rows)), axis
+
+
+def _guard_query(conn, query: str, max_rows: int):
+    """Decide si la consulta se ejecuta tal cual, reducida, con LIMIT o se rechaza, según su plan estimado.
+
+    Devuelve (query, decisión) o lanza QueryRejected con un resultado estructurado.
+    """
+    plan = _explain(conn, query)
+    decision = {"action": "allow", "estimated_cost": plan["Total Cost"], "estimated_rows": plan["Plan Rows"]}
+    if plan["Plan Rows"] > max_rows:
+        bucketed = _bucketed_series(conn, query, max_rows) if DOWNSAMPLE and DOWNSAMPLE_SQL else None
+        if bucketed is not None:
+            # Serie ordenada: Postgres devuelve min/max por intervalo de toda la serie en lugar de cortarla,
+            # salvo que recorrerla entera supere el presupuesto: entonces se corta con LIMIT
+            bucketed_plan = _explain(conn, bucketed[0])
+            decision["downsampled_cost"] = bucketed_plan["Total Cost"]
+            if bucketed_plan["Total Cost"] <= SQL_MAX_COST:
+                query, decision["axis"] = bucketed
+                plan = bucketed_plan
+                decision["action"] = "downsample"
+            else:
+                bucketed = None
+        if bucketed is None:
+            # max_rows + 1: la fila extra permite marcar el resultado como truncado
+            query = _with_limit(query, max_rows + 1)
+            plan = _explain(conn, query)
+            decision.update(action="limit", limited_cost=plan["Total Cost"])
+    if plan["Total Cost"] > SQL_MAX_COST:
+        decision["action"] = "reject"
+        logging.warning(f"sql_guard: {json.dumps(decision)} query={query}")
+        raise QueryRejected({
+            "error": (f"Consulta rechazada: costo estimado {plan['Total Cost']:.0f} supera el máximo {SQL_MAX_COST:.0f}. "
+                      "Usa agregaciones, filtros por ts_ms o las tablas de resumen en lugar de recorrer la tabla cruda."),
+            "rejected": True,
+            "reason": "cost",
+            "estimated_cost": plan["Total Cost"],
+            "estimated_rows": plan["Plan Rows"],
+            "max_cost": SQL_MAX_COST,
+        })
+    return query, decision
+
+
+def _fetch_columnar(engine, query: str, max_rows: int, max_bytes: int, timeout_ms: int = 0, cancel_scope=None) -> dict:
+    with db_connection(engine) as conn:
+        if cancel_scope is not None and cancel_scope.is_set():
+            raise QueryCancelled()
+        guard = SQL_GUARD and conn.dialect.name == "postgresql"
+        if guard:
+            timeout_ms = timeout_ms or SQL_GUARD_TIMEOUT_MS
+        if timeout_ms and conn.dialect.name == "postgresql":
+            conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+        decision = None
+        if guard:
+            query, decision = _guard_query(conn, query, max_rows)
+        started = time.perf_counter()
+        dbapi_conn = conn.connection.dbapi_connection
+        if cancel_scope is not None:
+            cancel_scope.register(dbapi_conn)
+        try:
+            res = conn.execution_options(stream_results=True, yield_per=SQL_YIELD_PER).execute(text(query))
+            if not res.returns_rows:
+                res.close()
+                return {"columns": [], "types": [], "data": [], "row_count": 0, "truncated": False}
+            columns = list(res.keys())
+            data = [[] for _ in columns]
+            row_count, size, truncated = 0, 0, False
+            for row in res:
+                if row_count >= max_rows or size >= max_bytes:
+                    truncated = True
+                    break
+                if cancel_scope is not None and row_count % SQL_YIELD_PER == 0 and cancel_scope.is_set():
+                    raise QueryCancelled()
+                for col, value in zip(data, row):
+                    value = _to_plain(value)
+                    col.append(value)
+                    size += len(str(value)) + 2
+                row_count += 1
+            res.close()
+        finally:
+            if cancel_scope is not None:
+                cancel_scope.unregister(dbapi_conn)
+        if decision is not None:
+            decision.update(actual_ms=round((time.perf_counter() - started) * 1000, 1), actual_rows=row_count)
+            logging.info(f"sql_guard: {json.dumps(decision)}")
+            trace = current_span()
+            if trace is not None:
+                trace.set(guard=decision["action"])
+        result = {
+            "columns": columns,
+            "types": [_column_type(col) for col in data],
+            "data": data,
+            "row_count": row_count,
+            "truncated": truncated,
+        }
+        if decision is not None and decision["action"] == "downsample":
+            result = finish_bucketed_result(result, decision["axis"])
+        return result
+
+
+def run_sql_query(engine, query: str, max_rows: int = None, max_bytes: int = None, use_cache: bool = True,
+                  timeout_ms: int = None, cancel_scope=None):
+    """Ejecuta SQL si es seguro, en streaming y con tope de filas/bytes.
+
+    Devuelve un resultado columnar: {"columns", "types", "data", "row_count", "truncated"},
+    donde data[i] contiene los valores de columns[i]. Los resultados se cachean por
+    SQL normalizado y versión de datos.
+
+    Antes de ejecutar, la guardia de costo (EXPLAIN) agrega un LIMIT si el resultado
+    estimado supera max_rows y rechaza las consultas demasiado caras con
+    {"error", "rejected": True, "reason", "estimated_cost", "estimated_rows", "max_cost"}.
+
+    Las series ordenadas (p. ej. ORDER BY ts_ms) no se cortan: se reducen a
+    DOWNSAMPLE_POINTS puntos conservando picos (downsample.py), en Postgres si la
+    guardia estima más de max_rows filas, y si no en NumPy. El resultado agrega
+    original_row_count, reduction_ratio y downsample_method.
+    """
+    with span("sql.query") as trace:
+        result = _run_sql_query(engine, query, max_rows, max_bytes, use_cache, timeout_ms, cancel_scope, trace)
+        trace.set(rows=result.get("row_count", 0), truncated=bool(result.get("truncated")),
+                  rejected=bool(result.get("rejected")), failed="error" in result)
+        if result.get("downsample_method"):
+            trace.set(original_rows=result["original_row_count"], downsample=result["downsample_method"])
+        return result
+
+
+def _run_sql_query(engine, query, max_rows, max_bytes, use_cache, timeout_ms, cancel_scope, trace):
     if engine is None:
         return {"error": "Conexión a la base de datos no configurada."}
     if not is_safe_sql(query):
-        return {"error": "Query bloqueada: solo se permiten SELECT/WITH."}
+        return {"error": "Query bloqueada: solo se permite una sentencia SELECT/WITH de solo lectura."}
+    max_rows = SQL_MAX_ROWS if max_rows is None else max_rows
+    max_bytes = SQL_MAX_BYTES if max_bytes is None else max_bytes
+    timeout_ms = SQL_QUERY_TIMEOUT_MS if timeout_ms is None else timeout_ms
     try:
-        with engine.connect() as conn:
-            res = conn.execute(text(query))
-            rows = [dict(r) for r in res.mappings().all()]
-            return {"rows": rows}
+        cache_key = None
+        version = get_data_version(engine) if use_cache else None
+        if version is not None:
+            cache_key = "|".join((_engine_key(engine), version, str(max_rows), str(max_bytes), normalize_sql(query)))
+            cached = query_cache.get(cache_key)
+            trace.set(cache_hit=cached is not None)
+            if cached is not None:
+                return cached
+        result = _fetch_columnar(engine, query, max_rows, max_bytes, timeout_ms, cancel_scope)
+        if DOWNSAMPLE:
+            result = downsample_result(result)
+        if cache_key:
+            query_cache.put(cache_key, result)
+        return result
+    except QueryRejected as e:
+        return e.result
     except Exception as e:
+        if cancel_scope is not None and cancel_scope.is_set():
+            return {"error": "Consulta cancelada porque otra consulta del lote falló.", "cancelled": True}
         logging.exception("Error ejecutando SQL")
         return {"error": str(e)}
 
+
+def run_sql_queries(engine, queries: list, max_rows: int = None, max_bytes: int = None, timeout_ms: int = None):
+    """Ejecuta un lote de consultas independientes en paralelo, cada una en su conexión del pool.
+
+    Devuelve los resultados en el mismo orden que `queries`. Si una falla, se cancelan
+    las que aún no empezaron y las que están en curso.
+    """
+    with span("sql.batch", queries=len(queries)):
+        return _run_sql_batch(engine, queries, max_rows, max_bytes, timeout_ms)
+
+
+def _run_sql_batch(engine, queries, max_rows, max_bytes, timeout_ms):
+    if len(queries) <= 1:
+        return [run_sql_query(engine, q, max_rows, max_bytes, timeout_ms=timeout_ms) for q in queries]
+    scope = _CancelScope()
+    # bind_context: los spans de cada consulta quedan como hijos de sql.batch
+    futures = {
+        _SQL_EXECUTOR.submit(bind_context(run_sql_query), engine, q, max_rows, max_bytes, True, timeout_ms, scope): i
+        for i, q in enumerate(queries)
+    }
+    results = [None] * len(queries)
+    for fut in as_completed(futures):
+        if fut.cancelled():
+            continue
+        res = fut.result()
+        results[futures[fut]] = res
+        if "error" in res and not scope.is_set():
+            scope.cancel()
+            for other in futures:
+                other.cancel()
+    for fut, i in futures.items():
+        if results[i] is None:
+            results[i] = {"error": "Consulta cancelada porque otra consulta del lote falló.", "cancelled": True}
+    return results
+
 # ===================== FUNCIONES AUXILIARES ======================
 
 def clean_text(text: str) -> str:
@@ -143,39 +871,87 @@ def parse_json_decision(text: str):
 
 def extract_sql_queries(text: str):
     """Extrae consultas SQL de un texto generado."""
-    t = clean_text(text)
-    # Buscar bloques de triple backtick con sql
-    blocks = re.findall(r"(?is)```(?:sql)?\s*(select.*?);?\s*```", t)
-    if blocks:
-        return [b.strip().rstrip(";") + ";" for b in blocks]
-    selects = re.findall(r"(?is)(select\b.*?;)", t)
-    if selects:
-        return [s.strip() for s in selects]
-    lines = re.findall(r"(?im)^select\b.*", t)
-    if lines:
-        return [l.strip() for l in lines]
-    return []
+    return extract_sql(clean_text(text))
 
 # ===================== LLM wrapper ======================
-def safe_chat_completion(model: str, messages: list, max_retries: int = 3, backoff: float = 1.0):
-    """Wrapper simple con reintentos exponenciales ante fallos transitorios."""
-    last_exc = None
-    for attempt in range(max_retries):
-        try:
-            resp = client.chat.completions.create(model=model, messages=messages)
-            return resp
-        except Exception as e:
-            last_exc = e
-            logging.warning(f"Chat completion error (attempt {attempt+1}/{max_retries}): {e}")
-            time.sleep(backoff * (2 ** attempt))
-    logging.error("safe_chat_completion: todas las reintentos fallaron")
-    raise last_exc
+def _usage_attrs(usage) -> dict:
+    """Tokens de un objeto usage de OpenAI como atributos de span."""
+    if usage is None:
+        return {}
+    return {k: getattr(usage, k, 0) or 0 for k in ("prompt_tokens", "completion_tokens", "total_tokens")}
+
+def get_llm_scheduler_stats() -> dict:
+    return scheduler.snapshot()
+
+def _call_tokens(model: str, messages: list) -> int:
+    """Tokens que se reservan en el limitador: entrada exacta más la salida estimada."""
+    return count_message_tokens(messages, model) + LLM_COMPLETION_ESTIMATE
+
+def safe_chat_completion(model: str, messages: list, max_retries: int = LLM_MAX_ATTEMPTS, backoff: float = LLM_BACKOFF_BASE_S,
+                         deadline_s: float = LLM_CALL_DEADLINE_S):
+    """Llamada al LLM a través del planificador compartido (límites, reintentos solo de errores transitorios y deadline)."""
+    with span("llm.chat", model=model) as trace:
+        resp = scheduler.call(get_openai_client().chat.completions.create, _call_tokens(model, messages), attempts=max_retries,
+                              backoff=backoff, deadline_s=deadline_s, trace=trace, model=model, messages=messages)
+        trace.set(**_usage_attrs(getattr(resp, "usage", None)))
+        return resp
+
+async def async_safe_chat_completion(model: str, messages: list, max_retries: int = LLM_MAX_ATTEMPTS,
+                                     backoff: float = LLM_BACKOFF_BASE_S, deadline_s: float = LLM_CALL_DEADLINE_S):
+    """Versión asíncrona de safe_chat_completion (cliente AsyncOpenAI)."""
+    with span("llm.chat", model=model) as trace:
+        resp = await scheduler.acall(get_openai_client(async_client=True).chat.completions.create, _call_tokens(model, messages), attempts=max_retries,
+                                     backoff=backoff, deadline_s=deadline_s, trace=trace, model=model, messages=messages)
+        trace.set(**_usage_attrs(getattr(resp, "usage", None)))
+        return resp
+
+async def astream_chat_completion(model: str, messages: list, usage: dict = None, max_retries: int = LLM_MAX_ATTEMPTS,
+                                  backoff: float = LLM_BACKOFF_BASE_S, deadline_s: float = LLM_CALL_DEADLINE_S,
+                                  trace_parent=None):
+    """Genera el texto de la respuesta token a token.
+
+    Solo se reintenta la apertura del stream; `usage` (si se pasa) recibe total_tokens
+    del último chunk. El span "llm.stream" se abre a mano (no como actual) porque
+    cruza los yields del generador; `trace_parent` lo cuelga del span del turno.
+    """
+    trace = start_span("llm.stream", parent=trace_parent, model=model)
+    started = time.perf_counter()
+    error = None
+    chunks = scheduler.astream(
+        get_openai_client(async_client=True).chat.completions.create, _call_tokens(model, messages), attempts=max_retries, backoff=backoff,
+        deadline_s=deadline_s, trace=trace, model=model, messages=messages, stream=True,
+        stream_options={"include_usage": True},
+    )
+    try:
+        async for chunk in chunks:
+            if getattr(chunk, "usage", None):
+                trace.set(**_usage_attrs(chunk.usage))
+                if usage is not None:
+                    usage["total_tokens"] = getattr(chunk.usage, "total_tokens", 0)
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if "first_token_ms" not in trace.attrs:
+                        trace.set(first_token_ms=round((time.perf_counter() - started) * 1000, 1))
+                    yield delta
+    except BaseException as e:
+        # GeneratorExit (el consumidor cortó el stream) no cuenta como error
+        if not isinstance(e, GeneratorExit):
+            error = e
+        raise
+    finally:
+        # Cerrar el stream libera su lugar en el planificador aunque el consumidor corte antes
+        await chunks.aclose()
+        trace.end(error=error)
 
 # Exports
 __all__ = [
-    "client", "get_engine", "build_conversation",
-    "run_sql_query", "extract_sql_queries", "parse_json_decision",
-    "clean_text", "safe_chat_completion", "LOG_FILE"
+    "client", "aclient", "get_openai_client", "setup_logging", "LLM_MODEL",
+    "get_engine", "db_connection", "get_pool_metrics", "build_conversation", "system_prompt_text",
+    "get_schema_catalog", "invalidate_schema_catalog", "get_first_table",
+    "run_sql_query", "run_sql_queries", "result_rows", "extract_sql_queries",
+    "normalize_sql", "bump_data_version", "get_query_cache_stats", "parse_json_decision",
+    "clean_text", "safe_chat_completion", "get_llm_scheduler_stats", "async_safe_chat_completion", "astream_chat_completion", "LOG_FILE"
 ]
 
 
@@ -36,8 +36,9 @@ Reglas IMPORTANTES:
 3️⃣ Buenas prácticas SQL:
    - Usa solo tablas y columnas que existen en el esquema.
    - Cada consulta termina en punto y coma (;).
-   - Para columnas texto-numéricas, convierte de forma segura:
-       REPLACE(col, ',', '.')::numeric
+   - Las columnas de sensores ya son numéricas (double precision): no uses REPLACE ni casts.
+   - ts_ms es el tiempo desde el inicio de la grabación en milisegundos (una fila cada 50 ms);
+     úsalo para ordenar series temporales y para filtrar o agrupar por intervalos de tiempo.
    - Evita errores por NULL o formatos incorrectos con filtros apropiados.
    - Usa siempre comillas dobles para los nombres de columnas exactos como aparecen en la tabla.
    - Cada WITH debe terminar en un SELECT final que devuelva resultados.
@@ -48,7 +49,7 @@ Reglas IMPORTANTES:
 4️⃣ Tipos de análisis que puedes hacer:
    - Promedios, sumas, conteos, mínimos, máximos.
    - Agrupamientos (GROUP BY / HAVING).
-   - Comparaciones o tendencias temporales (usando ROW_NUMBER(), LAG, LEAD).
+   - Comparaciones o tendencias temporales (ordenando por ts_ms, con LAG, LEAD o agrupando por ts_ms / 1000).
    - Análisis por percentiles o desviación estándar.
    - Comparación entre períodos o categorías.
    - Análisis de anomalías (valores fuera del promedio ± k*desviación).
@@ -63,14 +64,14 @@ Reglas IMPORTANTES:
 
 6️⃣ Ejemplos:
 
-Usuario: "¿Cómo evolucionó el promedio de col4 a lo largo del tiempo?"
+Usuario: "¿Cómo evolucionó el promedio de t41_44_avg a lo largo del tiempo?"
 Tú:
 {{
   "needs_sql": true,
   "sql": [
-    "WITH ordered AS (SELECT ROW_NUMBER() OVER (ORDER BY col1) AS idx, REPLACE(col4, ',', '.')::numeric AS value FROM {table_placeholder} WHERE col4 IS NOT NULL AND trim(col4) <> '') SELECT idx, value, value - LAG(value) OVER (ORDER BY idx) AS diff FROM ordered;"
+    "WITH por_segundo AS (SELECT ts_ms / 1000 AS segundo, AVG(t41_44_avg) AS value FROM {table_placeholder} WHERE t41_44_avg IS NOT NULL GROUP BY 1) SELECT segundo, value, value - LAG(value) OVER (ORDER BY segundo) AS diff FROM por_segundo ORDER BY segundo;"
   ],
-  "notes": "Se analiza la tendencia de col4 usando una función de ventana con LAG."
+  "notes": "Se analiza la tendencia de t41_44_avg por segundo usando una función de ventana con LAG."
 }}
 
 Usuario: "¿Existe correlación entre t2 y t41_44_avg?"
@@ -78,7 +79,7 @@ Tú:
 {{
   "needs_sql": true,
   "sql": [
-    "SELECT CORR(REPLACE(t2, ',', '.')::numeric, REPLACE(t41_44_avg, ',', '.')::numeric) AS correlacion FROM {table_placeholder} WHERE t2 IS NOT NULL AND t41_44_avg IS NOT NULL;"
+    "SELECT CORR(t2, t41_44_avg) AS correlacion FROM {table_placeholder};"
   ],
   "notes": "Calcula la correlación de Pearson entre t2 y t41_44_avg."
 }}
@@ -88,7 +89,7 @@ Tú:
 {{
   "needs_sql": true,
   "sql": [
-    "SELECT REPLACE(w9, ',', '.')::numeric AS w9, REPLACE(gen_tsb, ',', '.')::numeric AS gen_tsb, (REPLACE(gen_tsb, ',', '.')::numeric / NULLIF(REPLACE(w9, ',', '.')::numeric, 0)) AS relacion FROM {table_placeholder} WHERE w9 IS NOT NULL AND gen_tsb IS NOT NULL;"
+    "SELECT ts_ms, w9, gen_tsb, gen_tsb / NULLIF(w9, 0) AS relacion FROM {table_placeholder} WHERE w9 IS NOT NULL AND gen_tsb IS NOT NULL ORDER BY ts_ms;"
   ],
   "notes": "Analiza la relación entre velocidad del eje y temperatura del bobinado mediante la razón gen_tsb/w9."
 }}
@@ -98,7 +99,7 @@ Tú:
 {{
   "needs_sql": true,
   "sql": [
-    "SELECT CORR(REPLACE(t2, ',', '.')::numeric, REPLACE(t41_44_avg, ',', '.')::numeric) AS corr_t2_turbina, CORR(REPLACE(t2, ',', '.')::numeric, REPLACE(w9, ',', '.')::numeric) AS corr_t2_velocidad, CORR(REPLACE(t41_44_avg, ',', '.')::numeric, REPLACE(w9, ',', '.')::numeric) AS corr_turbina_velocidad FROM {table_placeholder} WHERE t2 IS NOT NULL AND t41_44_avg IS NOT NULL AND w9 IS NOT NULL;"
+    "SELECT CORR(t2, t41_44_avg) AS corr_t2_turbina, CORR(t2, w9) AS corr_t2_velocidad, CORR(t41_44_avg, w9) AS corr_turbina_velocidad FROM {table_placeholder};"
   ],
   "notes": "Evalúa correlaciones cruzadas entre tres variables para identificar relaciones potenciales."
 }}
@@ -127,7 +128,8 @@ RESPONDE SOLO con un OBJETO JSON EXACTO:
   "notes": ""
 }
 Reglas:
-- Genera SQL válido para PostgreSQL usando CAST y REPLACE para columnas texto-numéricas.
+- Genera SQL válido para PostgreSQL. Las columnas de sensores ya son numéricas: no uses REPLACE ni casts.
+- Para series temporales ordena o agrupa por ts_ms (milisegundos, una fila cada 50 ms).
 - Usa CORR, diferencias y ratios cuando el usuario pida comparar columnas.
 - Para tendencias, series temporales y outliers, usa ejemplos de CTE proporcionados en el prompt.
 - Cada consulta debe ser SELECT o WITH y terminar en ;.
@@ -136,4 +138,31 @@ Reglas:
 - Si el usuario pide información sobre la tabla o correlaciones entre columnas, genera siempre SQL válido para obtener el valor real.
 """
 
-
+INVALID_SQL_INSTRUCTION = """Estas consultas no pasaron la validación contra el esquema y no se ejecutaron:
+{errors}
+Corrígelas usando solo tablas, columnas y funciones que existen en el esquema (respeta mayúsculas y comillas)
+y devuelve de nuevo el OBJETO JSON completo con todas las consultas necesarias."""
+
+ANSWER_TEMPLATE_INSTRUCTION = """Agrega al JSON el campo "answer_template":
+- Si cada consulta devuelve una sola fila (agregados como AVG, MIN, MAX, COUNT o CORR sin GROUP BY), escribe ahí
+  la respuesta final para el usuario con cada valor como {alias}, usando los alias de columna de tus consultas
+  y, si corresponde, un formato: "La temperatura promedio de entrada al compresor es {promedio_t2:.2f} K."
+  Los valores se insertan tal como vienen de la base: usa las unidades de la descripción de cada columna.
+- Si alguna consulta devuelve varias filas, deja "answer_template": ""."""
+
+REJECTED_SQL_INSTRUCTION = """Estas consultas fueron rechazadas antes de ejecutarse porque su costo estimado es demasiado alto:
+{rejections}
+Reescríbelas para que sean más baratas (agrega o agrupa en la base, filtra por ts_ms o usa las tablas de resumen)
+y devuelve de nuevo el OBJETO JSON completo con todas las consultas necesarias."""
+
+FINAL_INSTRUCTION = """Entrega UNA RESPUESTA clara y concisa basada en los resultados de SQL.
+Resume solo lo que pide el usuario.
+No repitas información de respuestas anteriores.
+No muestres SQL ni tablas crudas.
+Los resultados vienen en formato columnar: "columns" son los nombres y "data"[i] los valores de columns[i].
+Si "condensed" es true, recibes un resumen estadístico por columna (summary) y algunas filas de head/tail en lugar de todas las filas; row_count indica cuántas filas devolvió la consulta.
+Si "truncated" es true, el resultado fue recortado: acláralo si afecta la respuesta."""
+
+GENERAL_PROMPT = """
+Responde solo con lenguaje natural si no se requiere SQL.
+"""
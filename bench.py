@@ -0,0 +1,326 @@
+# bench.py
+"""Benchmark y replay del pipeline pregunta -> respuesta, sin servicios externos de LLM.
+
+Levanta un servidor local compatible con la API de OpenAI (chat, streaming y
+embeddings) que responde de forma determinista a partir del corpus, reproduce las
+preguntas contra la base local (Postgres, opcionalmente cargada desde llm_sql.csv
+con loader.py) y reporta latencias p50/p95/p99 por etapa, tokens por turno, filas
+leídas y memoria. Con --baseline compara contra un reporte guardado y termina con
+código 1 si hay regresiones.
+
+Con --modes se repite la medición para cada modo del pipeline (classic, routed,
+single) y se agrega una comparación: latencia, llamadas al LLM por turno y precisión
+(intención correcta según el corpus y mismas filas que el primer modo).
+
+Uso:
+    python bench.py [--corpus bench_questions.jsonl] [--seed] [--repeat 3]
+                    [--baseline bench_baseline.json] [--save-baseline]
+                    [--modes classic,routed,single]
+"""
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import resource
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from tokens import count_message_tokens, count_tokens
+from vector_index import HashingEmbeddings
+
+STUB_MODEL = "gpt-4o-mini"
+PERCENTILES = (50, 95, 99)
+
+
+def load_corpus(path: str) -> list:
+    """Preguntas del corpus: {"id", "question", "sql": [...], "session", "answer_template" (opcionales)} por línea."""
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# ===================== SERVIDOR OPENAI DE PRUEBA ======================
+# La llamada de decisión (sin stream) devuelve el SQL del corpus para la pregunta
+# (y su answer_template si el prompt la pide, en el modo single); la respuesta final
+# (stream) es un texto fijo con la huella del prompt, así un cambio en los
+# resultados SQL se ve como un cambio de respuesta.
+
+class _StubHandler(BaseHTTPRequestHandler):
+    corpus = {}
+    latency_ms = 0
+    embedder = HashingEmbeddings()
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if self.path.endswith("/embeddings"):
+            self._embeddings(body)
+        elif self.path.endswith("/chat/completions"):
+            self._chat(body)
+        else:
+            self.send_error(404)
+
+    def _embeddings(self, body: dict):
+        inputs = body.get("input")
+        inputs = [inputs] if isinstance(inputs, (str, int)) or (inputs and isinstance(inputs[0], int)) else inputs
+        # LangChain puede mandar tokens (listas de enteros): se embebe su representación en texto
+        texts = [t if isinstance(t, str) else json.dumps(t) for t in inputs]
+        vectors = self.embedder.embed_documents(texts)
+        if body.get("encoding_format") == "base64":
+            vectors = [base64.b64encode(np.asarray(v, dtype=np.float32).tobytes()).decode("ascii") for v in vectors]
+        used = sum(count_tokens(t, STUB_MODEL) for t in texts)
+        self._json({
+            "object": "list",
+            "model": body.get("model", "stub-embedding"),
+            "data": [{"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)],
+            "usage": {"prompt_tokens": used, "total_tokens": used},
+        })
+
+    def _chat(self, body: dict):
+        messages = body.get("messages", [])
+        user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+        prompt_tokens = count_message_tokens(messages, STUB_MODEL)
+        if not body.get("stream"):
+            entry = self.corpus.get(user.strip())
+            sql = entry.get("sql", []) if entry else []
+            decision = {"needs_sql": bool(sql), "sql": sql, "notes": "stub"}
+            if any("answer_template" in (m.get("content") or "") for m in messages):
+                decision["answer_template"] = (entry or {}).get("answer_template", "")
+            content = json.dumps(decision, ensure_ascii=False)
+            completion_tokens = count_tokens(content, STUB_MODEL)
+            self._json({
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+            return
+        digest = hashlib.sha256(user.encode("utf-8")).hexdigest()[:12]
+        answer = f"Respuesta simulada {digest}: el resultado se resume en pocas palabras para medir el streaming."
+        completion_tokens = count_tokens(answer, STUB_MODEL)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def chunk(payload: dict):
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+        base = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0, "model": body.get("model")}
+        for word in answer.split(" "):
+            chunk({**base, "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]})
+        chunk({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        chunk({**base, "choices": [], "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                                "total_tokens": prompt_tokens + completion_tokens}})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_stub_server(corpus: list, latency_ms: int = 0):
+    """Levanta el servidor de prueba en un puerto libre y devuelve (server, base_url)."""
+    handler = type("StubHandler", (_StubHandler,), {
+        "corpus": {e["question"].strip(): e for e in corpus},
+        "latency_ms": latency_ms,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, name="openai-stub", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+# ===================== EJECUCIÓN Y REPORTE ======================
+
+def replay(corpus: list, engine, vectordb, repeat: int = 1, mode: str = None) -> list:
+    """Reproduce el corpus `repeat` veces; las preguntas con la misma "session" comparten historial."""
+    from pipeline import run_turn
+
+    records = []
+    for run in range(repeat):
+        sessions = {}
+        for entry in corpus:
+            history = sessions.setdefault(entry.get("session") or entry["id"], [])
+            history.append({"role": "user", "content": entry["question"]})
+            tracemalloc.reset_peak()
+            result = run_turn(engine, vectordb, entry["question"], history[-10:], mode=mode)
+            history.append({"role": "assistant", "content": result["answer"]})
+            records.append({
+                "id": entry["id"],
+                "run": run,
+                "answer": result["answer"],
+                "tokens": result["tokens"],
+                "rows": result["rows"],
+                "mode": result["mode"],
+                "needs_sql": result["needs_sql"],
+                "expected_sql": bool(entry.get("sql")),
+                "llm_calls": result["llm_calls"],
+                "stages": result["stages"],
+                "total_ms": result["total_ms"],
+                "first_token_ms": result["first_token_ms"],
+                "peak_bytes": tracemalloc.get_traced_memory()[1],
+            })
+    return records
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    return {f"p{p}": round(float(np.percentile(values, p)), 2) for p in PERCENTILES}
+
+
+def summarize(records: list) -> dict:
+    """Reporte agregado: percentiles por etapa, tokens, filas, memoria y respuestas por pregunta."""
+    stages = sorted({s for r in records for s in r["stages"]})
+    return {
+        "turns": len(records),
+        "latency_ms": {
+            **{s: _percentiles([r["stages"][s] for r in records if s in r["stages"]]) for s in stages},
+            "first_token": _percentiles([r["first_token_ms"] for r in records if r["first_token_ms"] is not None]),
+            "total": _percentiles([r["total_ms"] for r in records]),
+        },
+        "tokens_per_turn": {"mean": round(float(np.mean([r["tokens"] for r in records])), 1),
+                            **_percentiles([r["tokens"] for r in records])},
+        "rows_fetched": {"total": sum(r["rows"] for r in records),
+                         "per_turn": round(sum(r["rows"] for r in records) / max(len(records), 1), 1)},
+        "memory": {"peak_traced_bytes": max((r["peak_bytes"] for r in records), default=0),
+                   "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+        # Respuestas de la primera pasada: con el LLM de prueba son deterministas
+        "answers": {r["id"]: hashlib.sha256(r["answer"].encode("utf-8")).hexdigest()[:16] for r in records if r["run"] == 0},
+        "rows_by_question": {r["id"]: r["rows"] for r in records if r["run"] == 0},
+    }
+
+
+def compare_modes(reports: dict) -> dict:
+    """Latencia, llamadas al LLM y precisión por modo; las filas se comparan contra el primer modo."""
+    reference = next(iter(reports.values()))
+    out = {}
+    for mode, report in reports.items():
+        first = [r for r in report["records"] if r["run"] == 0]
+        same_rows = sum(1 for qid, rows in report["rows_by_question"].items() if reference["rows_by_question"].get(qid) == rows)
+        out[mode] = {
+            "total_ms": report["latency_ms"]["total"],
+            "first_token_ms": report["latency_ms"].get("first_token", {}),
+            "llm_calls_per_turn": round(float(np.mean([r["llm_calls"] for r in report["records"]])), 2),
+            "tokens_per_turn": report["tokens_per_turn"]["mean"],
+            # Intención correcta: hubo SQL exactamente cuando el corpus espera SQL
+            "intent_accuracy": round(sum(r["needs_sql"] == r["expected_sql"] for r in first) / max(len(first), 1), 3),
+            "rows_match": round(same_rows / max(len(report["rows_by_question"]), 1), 3),
+        }
+    return out
+
+
+def diff_against_baseline(report: dict, baseline: dict, tolerance: float) -> list:
+    """Regresiones respecto del baseline: p95 por etapa, tokens, filas, memoria y respuestas distintas."""
+    problems = []
+
+    def check(name, current, previous):
+        if previous and current > previous * (1 + tolerance):
+            problems.append(f"{name}: {current} vs {previous} (+{(current / previous - 1) * 100:.0f}%)")
+
+    for stage, values in report["latency_ms"].items():
+        check(f"latency_ms.{stage}.p95", values.get("p95", 0), baseline.get("latency_ms", {}).get(stage, {}).get("p95"))
+    check("tokens_per_turn.mean", report["tokens_per_turn"]["mean"], baseline.get("tokens_per_turn", {}).get("mean"))
+    check("rows_fetched.total", report["rows_fetched"]["total"], baseline.get("rows_fetched", {}).get("total"))
+    check("memory.peak_traced_bytes", report["memory"]["peak_traced_bytes"], baseline.get("memory", {}).get("peak_traced_bytes"))
+    for qid, answer in report["answers"].items():
+        previous = baseline.get("answers", {}).get(qid)
+        if previous and previous != answer:
+            problems.append(f"answers.{qid}: la respuesta cambió ({previous} -> {answer})")
+    for qid, rows in report["rows_by_question"].items():
+        previous = baseline.get("rows_by_question", {}).get(qid)
+        if previous is not None and previous != rows:
+            problems.append(f"rows_by_question.{qid}: {previous} -> {rows} filas")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline con un LLM de prueba.")
+    parser.add_argument("--corpus", default="bench_questions.jsonl")
+    parser.add_argument("--repeat", type=int, default=1, help="Pasadas sobre el corpus (la primera es en frío)")
+    parser.add_argument("--seed", action="store_true", help="Carga --csv en la base antes de medir")
+    parser.add_argument("--csv", default="llm_sql.csv")
+    parser.add_argument("--no-rag", action="store_true", help="No indexa ni recupera contexto RAG")
+    parser.add_argument("--stub-latency-ms", type=int, default=0, help="Latencia simulada por llamada al LLM")
+    parser.add_argument("--baseline", default=None, help="Reporte JSON contra el que comparar")
+    parser.add_argument("--save-baseline", action="store_true", help="Guarda el reporte como nuevo baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Margen relativo antes de marcar regresión")
+    parser.add_argument("--output", default=None, help="Archivo donde escribir el reporte")
+    parser.add_argument("--modes", default=None,
+                        help="Modos del pipeline a medir, separados por coma (por defecto PIPELINE_MODE)")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    server, base_url = start_stub_server(corpus, args.stub_latency_ms)
+    # El cliente de OpenAI lee el entorno al crearse (en la primera llamada): se fija antes
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ["LLM_MODEL"] = STUB_MODEL
+
+    from backend import get_engine, query_cache, setup_logging
+    setup_logging()
+    from sql_cache import sql_cache
+    engine = get_engine()
+    if engine is None:
+        raise SystemExit("Configura POSTGRES_USER, POSTGRES_PASSWORD y POSTGRES_DB apuntando a una base local.")
+    if args.seed:
+        from loader import load_csv
+        print(f"{load_csv(engine, args.csv)} filas cargadas desde {args.csv}")
+    vectordb = None
+    if not args.no_rag:
+        from rag import get_rag_store
+        vectordb = get_rag_store()
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()] if args.modes else [None]
+    reports = {}
+    tracemalloc.start()
+    try:
+        for mode in modes:
+            # Cada modo arranca en frío: sin resultados ni SQL cacheados de la medición anterior
+            query_cache.clear()
+            sql_cache.clear()
+            records = replay(corpus, engine, vectordb, args.repeat, mode)
+            reports[mode or "default"] = {**summarize(records), "records": records}
+    finally:
+        tracemalloc.stop()
+        server.shutdown()
+    comparison = compare_modes(reports) if len(reports) > 1 else None
+    report = next(iter(reports.values()))
+    report.pop("records")
+    if comparison:
+        report["modes"] = comparison
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"Baseline guardado en {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            problems = diff_against_baseline(report, json.load(f), args.tolerance)
+        for p in problems:
+            print(f"REGRESIÓN {p}")
+        if problems:
+            sys.exit(1)
+        print("Sin regresiones respecto del baseline")
+
+
+if __name__ == "__main__":
+    main()
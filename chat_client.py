@@ -0,0 +1,47 @@
+# chat_client.py
+"""Cliente del servicio de chat (server.py): la app de Streamlit lo usa como cliente liviano.
+
+Con CHAT_API_URL definido, los turnos se ejecutan en el servicio y la app solo
+consume los eventos NDJSON de POST /chat, que son los mismos dicts que produce
+pipeline.astream_turn.
+"""
+import os
+import json
+
+CHAT_API_URL = os.getenv("CHAT_API_URL", "")  # p. ej. http://localhost:8000
+CHAT_API_TENANT = os.getenv("CHAT_API_TENANT", "streamlit")
+CHAT_API_TIMEOUT = float(os.getenv("CHAT_API_TIMEOUT", "120"))
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant-ID")
+
+
+def _error_events(message: str):
+    yield {"type": "token", "text": message}
+    yield {"type": "done", "answer": message, "tokens": 0}
+
+
+def stream_turn(user_prompt: str, history: list, url: str = None, tenant: str = None):
+    """Genera los eventos del turno leídos del servicio; los errores de red o HTTP llegan como respuesta."""
+    # httpx solo hace falta en modo cliente liviano: no se importa junto con la app
+    import httpx
+
+    url = (url or CHAT_API_URL).rstrip("/")
+    payload = {
+        "question": user_prompt,
+        "history": [{"role": m["role"], "content": m["content"]} for m in history if m.get("content")],
+    }
+    headers = {TENANT_HEADER: tenant or CHAT_API_TENANT}
+    try:
+        with httpx.stream("POST", f"{url}/chat", json=payload, headers=headers, timeout=CHAT_API_TIMEOUT) as resp:
+            if resp.status_code != 200:
+                resp.read()
+                try:
+                    detail = resp.json().get("error", resp.text)
+                except ValueError:
+                    detail = resp.text
+                yield from _error_events(f"⚠️ El servicio de chat respondió {resp.status_code}: {detail}")
+                return
+            for line in resp.iter_lines():
+                if line:
+                    yield json.loads(line)
+    except httpx.HTTPError as e:
+        yield from _error_events(f"⚠️ No se pudo contactar al servicio de chat ({url}): {e}")
@@ -0,0 +1,144 @@
+# condense.py
+import os
+import numpy as np
+
+# pandas se importa al condensar el primer resultado grande, no al cargar el módulo
+from downsample import downsample_result
+
+# Por encima de CONDENSE_MAX_ROWS filas el resultado se reemplaza por un resumen
+# cuyo tamaño depende solo del número de columnas, no del de filas.
+CONDENSE_MAX_ROWS = int(os.getenv("CONDENSE_MAX_ROWS", "50"))
+CONDENSE_SAMPLE_ROWS = int(os.getenv("CONDENSE_SAMPLE_ROWS", "3"))
+CONDENSE_OUTLIERS = int(os.getenv("CONDENSE_OUTLIERS", "3"))
+CONDENSE_MAX_COLUMNS = int(os.getenv("CONDENSE_MAX_COLUMNS", "30"))
+CONDENSE_MAX_TEXT = 80
+# Puntos de la serie reducida (min/max por intervalo) que acompañan al resumen de una serie temporal
+CONDENSE_SERIES_POINTS = int(os.getenv("CONDENSE_SERIES_POINTS", "40"))
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def _r(value):
+    """Redondea a 6 cifras significativas para no gastar tokens en decimales."""
+    if value is None or not np.isfinite(value):
+        return None
+    return float(f"{value:.6g}")
+
+
+def _short(value):
+    if isinstance(value, str) and len(value) > CONDENSE_MAX_TEXT:
+        return value[:CONDENSE_MAX_TEXT] + "…"
+    return value
+
+
+def _as_numeric(series):
+    """Devuelve la serie (pandas) como float64 si es numérica (acepta coma decimal en texto)."""
+    import pandas as pd
+
+    if pd.api.types.is_bool_dtype(series):
+        return None
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype("float64")
+    non_null = series.notna()
+    if not non_null.any():
+        return None
+    parsed = pd.to_numeric(series.astype(str).str.replace(",", ".", regex=False).where(non_null), errors="coerce")
+    if parsed.notna().sum() == non_null.sum():
+        return parsed.astype("float64")
+    return None
+
+
+def _numeric_summary(name: str, values: np.ndarray, outliers: int) -> dict:
+    finite = np.isfinite(values)
+    y = values[finite]
+    summary = {"column": name, "kind": "numeric", "count": int(y.size), "nulls": int(values.size - y.size)}
+    if not y.size:
+        return summary
+    mean = y.mean()
+    std = y.std(ddof=1) if y.size > 1 else 0.0
+    summary.update({
+        "min": _r(y.min()),
+        "max": _r(y.max()),
+        "mean": _r(mean),
+        "std": _r(std),
+        "percentiles": {f"p{p}": _r(v) for p, v in zip(PERCENTILES, np.percentile(y, PERCENTILES))},
+    })
+    # Pendiente por mínimos cuadrados contra el número de fila
+    x = np.flatnonzero(finite).astype("float64")
+    dx = x - x.mean()
+    denom = (dx * dx).sum()
+    summary["slope_per_row"] = _r((dx * (y - mean)).sum() / denom) if denom else 0.0
+    if std > 0 and outliers > 0:
+        z = np.abs(y - mean) / std
+        k = min(outliers, z.size)
+        top = np.argpartition(z, -k)[-k:]
+        top = top[np.argsort(-z[top])]
+        summary["outliers"] = [{"row": int(x[i]), "value": _r(y[i]), "z": _r(z[i])} for i in top]
+    return summary
+
+
+def _text_summary(name: str, series) -> dict:
+    non_null = series.dropna().astype(str)
+    top = non_null.value_counts().head(3)
+    return {
+        "column": name,
+        "kind": "text",
+        "count": int(non_null.size),
+        "nulls": int(series.size - non_null.size),
+        "distinct": int(non_null.nunique()),
+        "top": [{"value": _short(v), "count": int(c)} for v, c in top.items()],
+    }
+
+
+def _columnar_slice(columns, data, rows: slice) -> dict:
+    return {"columns": columns, "data": [[_short(v) for v in col[rows]] for col in data]}
+
+
+def condense_result(result: dict, max_rows: int = None, sample_rows: int = None, outliers: int = None) -> dict:
+    """Resume un resultado columnar de run_sql_query si supera max_rows filas.
+
+    El resumen incluye, por columna, conteos, min/max, media, desviación, percentiles,
+    pendiente y outliers (numéricas) o valores más frecuentes (texto), más unas pocas
+    filas del principio y del final. Si el resultado es una serie ordenada, agrega
+    "series": CONDENSE_SERIES_POINTS puntos que conservan su forma y sus picos.
+    """
+    max_rows = CONDENSE_MAX_ROWS if max_rows is None else max_rows
+    sample_rows = CONDENSE_SAMPLE_ROWS if sample_rows is None else sample_rows
+    outliers = CONDENSE_OUTLIERS if outliers is None else outliers
+    if "error" in result or result.get("row_count", 0) <= max_rows:
+        return result
+
+    import pandas as pd
+
+    columns = result["columns"][:CONDENSE_MAX_COLUMNS]
+    data = result["data"][:CONDENSE_MAX_COLUMNS]
+    df = pd.DataFrame({i: col for i, col in enumerate(data)})
+    summary = []
+    for i, name in enumerate(columns):
+        numeric = _as_numeric(df[i])
+        if numeric is not None:
+            summary.append(_numeric_summary(name, numeric.to_numpy(), outliers))
+        else:
+            summary.append(_text_summary(name, df[i]))
+
+    condensed = {
+        "condensed": True,
+        "row_count": result["row_count"],
+        "truncated": result.get("truncated", False),
+        "omitted_columns": max(0, len(result["columns"]) - len(columns)),
+        "summary": summary,
+        "head": _columnar_slice(columns, data, slice(0, sample_rows)),
+        "tail": _columnar_slice(columns, data, slice(-sample_rows, None) if sample_rows else slice(0, 0)),
+    }
+    if result.get("downsample_method"):
+        condensed.update({
+            "original_row_count": result["original_row_count"],
+            "reduction_ratio": result["reduction_ratio"],
+            "downsample_method": result["downsample_method"],
+            "note": "Filas ya reducidas conservando picos: min/max exactos, media y percentiles aproximados.",
+        })
+    shape = downsample_result({**result, "columns": columns, "types": result["types"][:CONDENSE_MAX_COLUMNS], "data": data},
+                              points=CONDENSE_SERIES_POINTS, method="minmax")
+    if shape.get("row_count") < result["row_count"]:
+        condensed["series"] = _columnar_slice(columns, shape["data"], slice(None))
+    return condensed
@@ -0,0 +1,232 @@
+# downsample.py
+"""Reducción de series temporales que conserva la forma (picos y transitorios incluidos).
+
+Un resultado ordenado por una columna de tiempo o de orden (ts_ms, bucket, ...) con
+columnas numéricas se reduce a un presupuesto de DOWNSAMPLE_POINTS puntos:
+
+- minmax (por defecto): divide la serie en intervalos de igual cantidad de filas y
+  de cada uno conserva la primera y la última fila, y las filas con el mínimo y el
+  máximo de cada columna. Los extremos de la serie quedan siempre.
+- lttb: Largest-Triangle-Three-Buckets, la fila que forma el triángulo de mayor
+  área con sus vecinas (sumando las columnas normalizadas). Da curvas más suaves
+  pero no garantiza conservar todos los extremos.
+
+Cuando la consulta viene ordenada y la guardia estima más filas que SQL_MAX_ROWS,
+bucketed_query hace el mismo min/max por intervalo en Postgres (ntile + row_number):
+solo viajan los puntos elegidos y se cubre la serie completa, en lugar de cortarla
+con un LIMIT.
+
+El resultado indica original_row_count, reduction_ratio y downsample_method.
+"""
+import os
+from datetime import timezone
+
+import numpy as np
+import sqlglot
+from sqlglot import exp
+
+DOWNSAMPLE = os.getenv("DOWNSAMPLE", "1") == "1"
+DOWNSAMPLE_POINTS = int(os.getenv("DOWNSAMPLE_POINTS", "1000"))
+DOWNSAMPLE_METHOD = os.getenv("DOWNSAMPLE_METHOD", "minmax")  # minmax | lttb
+DOWNSAMPLE_SQL = os.getenv("DOWNSAMPLE_SQL", "1") == "1"
+
+DOWNSAMPLE_METHODS = ("minmax", "lttb")
+# Columnas que se reconocen como eje aunque no sean la primera
+AXIS_COLUMNS = ("ts_ms", "bucket", "ts", "time", "timestamp", "fecha", "tiempo")
+TOTAL_COLUMN = "_ds_total"
+_NUMERIC = ("integer", "number")
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _buckets_for(points: int, series: int) -> int:
+    """Intervalos que entran en el presupuesto: cada uno aporta hasta 2 + 2 * series filas."""
+    return max(1, points // (2 + 2 * series))
+
+
+def _datetimes(values) -> np.ndarray:
+    """Columna de fechas como datetime64[ns]; las que traen zona horaria se pasan antes a UTC."""
+    return np.array([v.astimezone(timezone.utc).replace(tzinfo=None) if getattr(v, "tzinfo", None) else v
+                     for v in values], dtype="datetime64[ns]")
+
+
+def _floats(values) -> np.ndarray:
+    """Columna como float64, con NaN en lugar de None."""
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except TypeError:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+# ===================== DETECCIÓN ======================
+
+def series_axis(result: dict):
+    """Índice de la columna eje (numérica o fecha, no decreciente) o None si no es una serie."""
+    columns, types, data = result.get("columns") or [], result.get("types") or [], result.get("data") or []
+    candidates = [i for i, c in enumerate(columns) if c.lower() in AXIS_COLUMNS] + [0]
+    for i in dict.fromkeys(candidates):
+        if i >= len(columns) or types[i] not in _NUMERIC + ("datetime",):
+            continue
+        values = data[i]
+        if any(v is None for v in values):
+            continue
+        x = _datetimes(values) if types[i] == "datetime" else np.asarray(values, dtype=np.float64)
+        if x.size > 1 and bool(np.all(x[1:] >= x[:-1])):
+            return i
+    return None
+
+
+def series_order_column(query: str):
+    """Columna del ORDER BY ascendente único de la consulta (candidata a eje) o None."""
+    try:
+        tree = sqlglot.parse_one(query, read="postgres")
+    except sqlglot.errors.ParseError:
+        return None
+    if not isinstance(tree, exp.Query):
+        return None
+    order = tree.args.get("order")
+    if order is None or len(order.expressions) != 1:
+        return None
+    ordered = order.expressions[0]
+    if ordered.args.get("desc") or not isinstance(ordered.this, exp.Column):
+        return None
+    return ordered.this.name
+
+
+# ===================== REDUCCIÓN EN NUMPY ======================
+
+def minmax_indices(ys: np.ndarray, points: int) -> np.ndarray:
+    """Filas a conservar de ys (series x filas): primera, última, mínimo y máximo por intervalo."""
+    n = ys.shape[1]
+    buckets = _buckets_for(points, ys.shape[0])
+    if n <= buckets:
+        return np.arange(n)
+    starts = np.arange(buckets) * n // buckets
+    ends = np.r_[starts[1:], n] - 1
+    # Matriz intervalos x posiciones (los intervalos difieren en a lo sumo una fila):
+    # argmin/argmax por fila dan el mínimo y el máximo de cada intervalo sin bucles
+    positions = starts[:, None] + np.arange((ends - starts).max() + 1)[None, :]
+    valid = positions <= ends[:, None]
+    positions = np.minimum(positions, n - 1)
+    keep = [starts, ends]
+    for y in ys:
+        window = y[positions]
+        missing = ~valid | np.isnan(window)
+        keep.append(starts + np.argmin(np.where(missing, np.inf, window), axis=1))
+        keep.append(starts + np.argmax(np.where(missing, -np.inf, window), axis=1))
+    return np.unique(np.concatenate(keep))
+
+
+def lttb_indices(x: np.ndarray, ys: np.ndarray, points: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets sobre la suma de las series normalizadas."""
+    n = x.size
+    if points >= n or points < 3:
+        return np.arange(n) if points >= n else np.array([0, n - 1])
+    std = np.nanstd(ys, axis=1, keepdims=True)
+    z = np.nan_to_num((ys - np.nanmean(ys, axis=1, keepdims=True)) / np.where(std > 0, std, 1.0))
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    chosen = np.empty(points, dtype=np.int64)
+    chosen[0], chosen[-1] = 0, n - 1
+    a = 0
+    for b in range(points - 2):
+        lo, hi = edges[b], max(edges[b + 1], edges[b] + 1)
+        nxt_lo, nxt_hi = hi, (edges[b + 2] if b + 2 < len(edges) else n)
+        avg_x = x[nxt_lo:max(nxt_hi, nxt_lo + 1)].mean()
+        avg_z = z[:, nxt_lo:max(nxt_hi, nxt_lo + 1)].mean(axis=1, keepdims=True)
+        # Área (x2) del triángulo entre el punto elegido, cada candidato y el promedio siguiente
+        area = np.abs((x[a] - avg_x) * (z[:, lo:hi] - z[:, a:a + 1]) - (x[a] - x[lo:hi]) * (avg_z - z[:, a:a + 1]))
+        a = lo + int(np.argmax(area.sum(axis=0)))
+        chosen[b + 1] = a
+    return chosen
+
+
+def downsample_result(result: dict, points: int = None, method: str = None) -> dict:
+    """Reduce un resultado columnar de run_sql_query si es una serie ordenada con más de `points` filas.
+
+    Devuelve el mismo formato con las filas elegidas, más original_row_count,
+    reduction_ratio, downsample_method y downsample_axis. Si no aplica, el resultado
+    vuelve sin cambios.
+    """
+    points = DOWNSAMPLE_POINTS if points is None else points
+    method = method or DOWNSAMPLE_METHOD
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"DOWNSAMPLE_METHOD desconocido: {method!r} (opciones: {', '.join(DOWNSAMPLE_METHODS)})")
+    if "error" in result or result.get("row_count", 0) <= points:
+        return result
+    axis = series_axis(result)
+    if axis is None:
+        return result
+    series = [i for i, t in enumerate(result["types"]) if t in _NUMERIC and i != axis]
+    if not series:
+        return result
+    ys = np.array([_floats(result["data"][i]) for i in series])
+    if method == "lttb":
+        x_values = result["data"][axis]
+        if result["types"][axis] == "datetime":
+            x = _datetimes(x_values).astype(np.int64).astype(np.float64)
+        else:
+            x = np.asarray(x_values, dtype=np.float64)
+        keep = lttb_indices(x, ys, points)
+    else:
+        keep = minmax_indices(ys, points)
+    # Un resultado ya reducido (p. ej. en Postgres) conserva su conteo original
+    original = result.get("original_row_count", result["row_count"])
+    return {
+        **result,
+        "data": [[col[i] for i in keep] for col in result["data"]],
+        "row_count": int(keep.size),
+        "original_row_count": original,
+        "reduction_ratio": round(original / keep.size, 2),
+        "downsample_method": method,
+        "downsample_axis": result["columns"][axis],
+    }
+
+
+# ===================== REDUCCIÓN EN POSTGRES ======================
+
+def bucketed_query(query: str, axis: str, columns: list, series: list, points: int) -> str:
+    """Envuelve una consulta ordenada por `axis` para que Postgres devuelva solo el min/max por intervalo.
+
+    Mismas columnas que la original más TOTAL_COLUMN (filas antes de reducir), que
+    finish_bucketed_result quita del resultado.
+    """
+    buckets = _buckets_for(points, len(series))
+    ax = _quote(axis)
+    ranks = [f"row_number() OVER (PARTITION BY _ds_bucket ORDER BY {ax}) AS _ds_r0",
+             f"row_number() OVER (PARTITION BY _ds_bucket ORDER BY {ax} DESC) AS _ds_r1"]
+    for i, col in enumerate(series):
+        c = _quote(col)
+        ranks += [f"row_number() OVER (PARTITION BY _ds_bucket ORDER BY {c} ASC NULLS LAST) AS _ds_r{2 * i + 2}",
+                  f"row_number() OVER (PARTITION BY _ds_bucket ORDER BY {c} DESC NULLS LAST) AS _ds_r{2 * i + 3}"]
+    keep = " OR ".join(f"_ds_r{i} = 1" for i in range(len(ranks)))
+    select = ", ".join(_quote(c) for c in columns)
+    inner = query.strip().rstrip(";")
+    return (
+        f"SELECT {select}, {TOTAL_COLUMN} FROM ("
+        f"SELECT t.*, {', '.join(ranks)} FROM ("
+        f"SELECT src.*, ntile({buckets}) OVER (ORDER BY {ax}) AS _ds_bucket, count(*) OVER () AS {TOTAL_COLUMN} "
+        f"FROM ({inner}) AS src) AS t) AS w "
+        f"WHERE {keep} ORDER BY {ax}"
+    )
+
+
+def finish_bucketed_result(result: dict, axis: str) -> dict:
+    """Quita TOTAL_COLUMN del resultado de bucketed_query y agrega los datos de la reducción."""
+    if TOTAL_COLUMN not in result.get("columns", []):
+        return result
+    i = result["columns"].index(TOTAL_COLUMN)
+    totals = result["data"][i]
+    original = int(totals[0]) if totals else 0
+    rows = result["row_count"]
+    return {
+        **result,
+        "columns": result["columns"][:i] + result["columns"][i + 1:],
+        "types": result["types"][:i] + result["types"][i + 1:],
+        "data": result["data"][:i] + result["data"][i + 1:],
+        "original_row_count": original,
+        "reduction_ratio": round(original / rows, 2) if rows else 0.0,
+        "downsample_method": "minmax-sql",
+        "downsample_axis": axis,
+    }
@@ -0,0 +1,120 @@
+# history_store.py
+"""Historial de chat persistente por sesión, en SQLite (WAL) sobre disco local.
+
+Cada mensaje es una fila compacta (sesión, rol, texto, timestamp en segundos,
+tokens) que solo se agrega, nunca se reescribe. El índice (session, id) permite
+leer la ventana de mensajes más recientes y paginar hacia atrás sin recorrer toda
+la sesión, así que el costo de cada rerun no crece con la longitud de la charla.
+
+Una sola conexión por proceso y por archivo, compartida entre los hilos de los
+reruns de Streamlit (check_same_thread=False) y serializada con un lock: cada
+operación es una sentencia corta, así que no se abre una conexión ni se recrea el
+esquema en cada rerun. WAL deja que otros procesos lean mientras este escribe.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+HISTORY_DB = os.getenv("HISTORY_DB", "chat_history.db")
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "20"))  # mensajes que se renderizan al abrir la sesión
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))  # mensajes por página al cargar anteriores
+HISTORY_BUSY_TIMEOUT_MS = int(os.getenv("HISTORY_BUSY_TIMEOUT_MS", "5000"))
+
+_ROLES = ("user", "assistant")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    session TEXT    NOT NULL,
+    role    INTEGER NOT NULL,  -- 0 = user, 1 = assistant
+    content TEXT    NOT NULL,
+    ts      INTEGER NOT NULL,  -- segundos desde epoch
+    tokens  INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_session_id ON messages (session, id);
+"""
+
+_conns = {}
+_lock = threading.Lock()
+
+
+# ===================== CONEXIÓN ======================
+
+def _connect(path: str = None) -> sqlite3.Connection:
+    """Conexión compartida del proceso para `path`; el esquema se crea al abrirla. Usar con _lock tomado."""
+    path = path or HISTORY_DB
+    conn = _conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=HISTORY_BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        _conns[path] = conn
+    return conn
+
+
+def _execute(path: str, sql: str, params=()):
+    """Ejecuta una sentencia en la conexión compartida; devuelve (filas, lastrowid, rowcount)."""
+    with _lock:
+        cur = _connect(path).execute(sql, params)
+        return cur.fetchall(), cur.lastrowid, cur.rowcount
+
+
+def _row_to_message(row) -> dict:
+    msg_id, role, content, ts, tokens = row
+    return {"id": msg_id, "role": _ROLES[role], "content": content, "ts": ts, "tokens": tokens}
+
+
+# ===================== ESCRITURA ======================
+
+def append_message(session: str, role: str, content: str, tokens: int = 0, ts: float = None, path: str = None) -> int:
+    """Agrega un mensaje a la sesión y devuelve su id."""
+    if role not in _ROLES:
+        raise ValueError(f"Rol desconocido: {role!r}")
+    _, lastrowid, _ = _execute(
+        path,
+        "INSERT INTO messages (session, role, content, ts, tokens) VALUES (?, ?, ?, ?, ?)",
+        (session, _ROLES.index(role), content or "", int(ts if ts is not None else time.time()), int(tokens or 0)),
+    )
+    return lastrowid
+
+
+# ===================== LECTURA ======================
+
+def recent_messages(session: str, limit: int = HISTORY_WINDOW, before_id: int = None, path: str = None) -> list:
+    """Los `limit` mensajes más recientes (anteriores a `before_id`, si se da), en orden cronológico."""
+    if limit <= 0:
+        return []
+    if before_id is None:
+        rows, _, _ = _execute(
+            path,
+            "SELECT id, role, content, ts, tokens FROM messages WHERE session = ? ORDER BY id DESC LIMIT ?",
+            (session, limit),
+        )
+    else:
+        rows, _, _ = _execute(
+            path,
+            "SELECT id, role, content, ts, tokens FROM messages WHERE session = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (session, before_id, limit),
+        )
+    return [_row_to_message(r) for r in reversed(rows)]
+
+
+def recent_history(session: str, max_messages: int, path: str = None) -> list:
+    """Historial para el modelo: [{"role", "content"}] de los últimos `max_messages` mensajes."""
+    return [{"role": m["role"], "content": m["content"]} for m in recent_messages(session, max_messages, path=path)]
+
+
+def session_stats(session: str, path: str = None) -> dict:
+    """Mensajes y tokens acumulados de la sesión."""
+    rows, _, _ = _execute(path, "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM messages WHERE session = ?", (session,))
+    count, tokens = rows[0]
+    return {"messages": count, "tokens": tokens}
+
+
+def clear_session(session: str, path: str = None) -> int:
+    """Borra los mensajes de la sesión; devuelve cuántos había."""
+    _, _, rowcount = _execute(path, "DELETE FROM messages WHERE session = ?", (session,))
+    return rowcount
@@ -0,0 +1,61 @@
+# intent.py
+"""Router local de intención: decide sin LLM si una pregunta necesita datos.
+
+Solo se manda directo a la respuesta general (RAG, sin esquema ni SQL) lo que es
+claramente no-datos: saludos, agradecimientos y preguntas de definición que no
+mencionan tablas, columnas, palabras de agregación ni de tiempo o cambio ("ayer",
+"subió", "varió"). Ante la duda, la pregunta sigue el camino normal con la llamada
+de decisión.
+"""
+import re
+
+from sql_cache import normalize_question
+
+GENERAL = "general"
+DATA = "data"
+
+# Uno o más saludos/agradecimientos seguidos ("hola buenas tardes", "ok gracias")
+_SMALL_TALK = re.compile(
+    r"^((hola|buenas|buen dia|buenos dias|buenas tardes|buenas noches|hey|hi|hello|gracias|muchas gracias|"
+    r"ok|okay|dale|perfecto|genial|excelente|chau|adios|hasta luego|saludos|a todos|equipo|bot|che)( |$))+$"
+)
+_DEFINITION = re.compile(
+    r"^(que es|que son|que significa|que significan|que quiere decir|explica|explicame|define|defini|"
+    r"como funciona|como funcionan|para que sirve|para que sirven|what is|what are|explain)\b"
+)
+# Palabras que indican que la respuesta sale de la tabla (sin acentos, como quedan al normalizar)
+_DATA_WORDS = {
+    "promedio", "media", "mediana", "maximo", "maxima", "minimo", "minima", "cuanto", "cuanta", "cuantos", "cuantas",
+    "total", "suma", "conteo", "contar", "correlacion", "correlaciona", "relacion", "relaciona", "tendencia",
+    "evolucion", "evoluciono", "serie", "valor", "valores", "fila", "filas", "registro", "registros", "dato", "datos",
+    "tabla", "tablas", "columna", "columnas", "desvio", "varianza", "varia", "atipico", "atipicos", "outlier",
+    "outliers", "compara", "comparar", "mostrame", "muestra", "dame", "lista", "listar", "grafico", "rango", "pico",
+    "picos", "percentil", "sql", "consulta", "mayor", "menor", "ultimo", "ultimos", "primer", "primeros",
+    # Verbos de cambio, también en pasado (sin acento: "varió" -> "vario")
+    "vario", "variaron", "subio", "subieron", "sube", "suben", "bajo", "bajaron", "baja", "bajan", "aumento",
+    "aumentaron", "disminuyo", "disminuyeron", "cayo", "cayeron", "cambio", "cambiaron", "oscilo", "fluctuo",
+}
+# Referencias temporales: una "definición" que las menciona pregunta por lo que pasó en los datos
+_TIME_WORDS = {
+    "hoy", "ayer", "anteayer", "anoche", "ahora", "recien", "reciente", "recientemente", "semana", "mes", "ano",
+    "hora", "horas", "minuto", "minutos", "dia", "dias", "manana", "tarde", "noche", "turno", "durante", "desde",
+    "hasta", "cuando",
+}
+
+
+def classify_intent(question: str, catalog=None) -> str:
+    """GENERAL para preguntas claramente sin datos; DATA en cualquier otro caso."""
+    norm = normalize_question(question)
+    if not norm:
+        return GENERAL
+    if _SMALL_TALK.match(norm):
+        return GENERAL
+    if not _DEFINITION.match(norm):
+        return DATA
+    words = set(norm.split())
+    names = set()
+    if catalog is not None:
+        for table, cols in catalog.tables.items():
+            names.add(table.lower())
+            names.update(c.lower() for c, _ in cols)
+    return DATA if words & (_DATA_WORDS | _TIME_WORDS | names) else GENERAL
@@ -0,0 +1,374 @@
+# llm_scheduler.py
+"""Planificador compartido de llamadas al LLM.
+
+Todas las llamadas del proceso (síncronas, asíncronas y en streaming) pasan por un
+único LLMScheduler que:
+  - limita requests/min y tokens/min con dos token buckets,
+  - acota las llamadas en curso (LLM_MAX_IN_FLIGHT),
+  - distingue errores reintentables (429, 5xx, timeouts, conexión) de los fatales
+    (autenticación, request inválido, cuota agotada), que se propagan sin reintentar,
+  - reintenta con backoff exponencial con jitter, respetando Retry-After; un 429
+    pausa a todo el proceso, no solo a la llamada que lo recibió,
+  - abre un circuit breaker tras LLM_BREAKER_THRESHOLD fallas seguidas,
+  - corta cada llamada al vencer su deadline (espera en cola incluida).
+
+La profundidad de la cola, las llamadas en curso y los contadores se exportan en
+/metrics (tracing.register_metric); el tiempo de espera queda en el span "llm.queue".
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+from tracing import register_metric, start_span
+
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))  # requests por minuto (0 = sin límite)
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))  # tokens por minuto (0 = sin límite)
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE_S", "1.0"))
+LLM_BACKOFF_MAX_S = float(os.getenv("LLM_BACKOFF_MAX_S", "20"))
+LLM_MAX_RETRY_AFTER_S = float(os.getenv("LLM_MAX_RETRY_AFTER_S", "60"))
+LLM_CALL_DEADLINE_S = float(os.getenv("LLM_CALL_DEADLINE_S", "90"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "30"))
+LLM_COMPLETION_ESTIMATE = int(os.getenv("LLM_COMPLETION_ESTIMATE", "500"))  # tokens de salida supuestos al encolar
+
+_POLL_S = 0.05  # espera entre intentos de tomar un lugar en curso
+
+
+class LLMUnavailable(Exception):
+    """El circuit breaker está abierto: el proveedor viene fallando y no se lo llama."""
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """La llamada no terminó (o no consiguió lugar) antes de su deadline."""
+
+
+# ===================== CLASIFICACIÓN DE ERRORES ======================
+
+# El SDK de OpenAI no se importa acá (es lento de cargar): si una excepción viene
+# del SDK, el módulo ya está en sys.modules
+
+def _is_rate_limit(exc: BaseException) -> bool:
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(exc, openai.RateLimitError)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """True para fallas transitorias del proveedor; False para errores que se repetirían igual."""
+    openai = sys.modules.get("openai")
+    if openai is None:
+        return False
+    if isinstance(exc, (openai.AuthenticationError, openai.PermissionDeniedError, openai.BadRequestError,
+                        openai.NotFoundError, openai.UnprocessableEntityError)):
+        return False
+    if isinstance(exc, openai.RateLimitError):
+        # Sin cuota no hay espera que alcance
+        return getattr(exc, "code", None) != "insufficient_quota"
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    return False
+
+
+def retry_after(exc: BaseException):
+    """Segundos indicados por el servidor (retry-after-ms / retry-after), o None."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return min(float(headers["retry-after-ms"]) / 1000, LLM_MAX_RETRY_AFTER_S)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        return min(max(seconds, 0.0), LLM_MAX_RETRY_AFTER_S)
+    except (TypeError, ValueError):
+        return None
+
+
+# ===================== TOKEN BUCKET ======================
+
+class TokenBucket:
+    """Capacidad `per_minute` que se repone de forma continua. Sin límite si per_minute <= 0."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self._rate = per_minute / 60.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Segundos hasta poder tomar `amount` (0 si ya se puede)."""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)  # un pedido mayor que la capacidad espera al bucket lleno
+        return max(0.0, (amount - self.level) / self._rate)
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.level -= min(amount, self.capacity)
+
+    def adjust(self, delta: float):
+        """Corrige lo tomado con el consumo real (delta > 0 consume más; puede quedar en negativo)."""
+        if self.capacity > 0:
+            self.level = min(self.capacity, self.level - delta)
+
+
+# ===================== PLANIFICADOR ======================
+
+class LLMScheduler:
+    def __init__(self, rpm: int = LLM_RPM, tpm: int = LLM_TPM, max_in_flight: int = LLM_MAX_IN_FLIGHT,
+                 breaker_threshold: int = LLM_BREAKER_THRESHOLD, breaker_cooldown: float = LLM_BREAKER_COOLDOWN_S):
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._max_in_flight = max_in_flight
+        self._in_flight = 0
+        self._waiting = 0
+        self._paused_until = 0.0
+        self._breaker_threshold = breaker_threshold
+        self._breaker_cooldown = breaker_cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.counters = {"calls": 0, "retries": 0, "fatal": 0, "exhausted": 0, "deadline": 0, "circuit_rejected": 0}
+
+    # ---------------- Estado del circuito y admisión ----------------
+
+    def _check_circuit(self, now: float):
+        """Lanza LLMUnavailable si el circuito está abierto; en medio abierto deja pasar una sonda."""
+        if self._opened_at is None:
+            return False
+        if now - self._opened_at < self._breaker_cooldown or self._probing:
+            self.counters["circuit_rejected"] += 1
+            raise LLMUnavailable(f"LLM no disponible: {self._failures} fallas seguidas, circuito abierto.")
+        return True
+
+    def _try_start(self, tokens: int) -> float:
+        """Toma un lugar y los tokens si hay; si no, devuelve cuántos segundos esperar."""
+        with self._lock:
+            now = time.monotonic()
+            probe = self._check_circuit(now)
+            wait = max(self._paused_until - now,
+                       self._requests.wait_time(1, now),
+                       self._tokens.wait_time(tokens, now))
+            if wait <= 0 and self._max_in_flight > 0 and self._in_flight >= self._max_in_flight:
+                wait = _POLL_S
+            if wait > 0:
+                return wait
+            self._requests.take(1)
+            self._tokens.take(tokens)
+            self._in_flight += 1
+            self._probing = probe
+            self.counters["calls"] += 1
+            return 0.0
+
+    def _finish(self, failure: BaseException = None, estimated: int = 0, used: int = None):
+        """Libera el lugar, corrige el bucket de tokens y actualiza el circuit breaker."""
+        with self._lock:
+            self._in_flight -= 1
+            self._probing = False
+            if used is not None:
+                self._tokens.adjust(used - estimated)
+            if failure is None:
+                self._failures, self._opened_at = 0, None
+                return
+            if not is_retryable(failure):
+                return
+            self._failures += 1
+            if self._failures >= self._breaker_threshold:
+                if self._opened_at is None:
+                    logging.error(f"llm_scheduler: circuito abierto tras {self._failures} fallas seguidas")
+                self._opened_at = time.monotonic()
+            hint = retry_after(failure)
+            if _is_rate_limit(failure) and hint:
+                # El proveedor pidió esperar: aplica a todas las llamadas del proceso
+                self._paused_until = max(self._paused_until, time.monotonic() + hint)
+
+    def _next_delay(self, exc: BaseException, attempt: int, base: float) -> float:
+        """Backoff exponencial con jitter completo; nunca menos que el Retry-After del servidor."""
+        delay = random.uniform(0, min(LLM_BACKOFF_MAX_S, base * (2 ** attempt)))
+        hint = retry_after(exc)
+        return max(delay, hint) if hint is not None else delay
+
+    def _give_up(self, exc, attempt: int, attempts: int, trace) -> bool:
+        """True si exc se propaga: fatal, sin intentos restantes o sin tiempo para otro."""
+        if not is_retryable(exc):
+            self._count("fatal")
+            return True
+        if attempt + 1 >= attempts:
+            self._count("exhausted")
+            return True
+        self._count("retries")
+        if trace is not None:
+            trace.add("retries")
+        return False
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counters[key] += 1
+
+    def _deadline_error(self, what: str):
+        self._count("deadline")
+        return LLMDeadlineExceeded(f"Deadline de la llamada al LLM vencido {what}.")
+
+    # ---------------- Espera de un lugar ----------------
+
+    def _acquire(self, tokens: int, deadline: float, trace=None):
+        queue_span = start_span("llm.queue", parent=trace, tokens=tokens)
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                wait = self._try_start(tokens)
+                if wait <= 0:
+                    return
+                if time.monotonic() + wait > deadline:
+                    raise self._deadline_error("esperando lugar")
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+            queue_span.end()
+
+    async def _aacquire(self, tokens: int, deadline: float, trace=None):
+        queue_span = start_span("llm.queue", parent=trace, tokens=tokens)
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                wait = self._try_start(tokens)
+                if wait <= 0:
+                    return
+                if time.monotonic() + wait > deadline:
+                    raise self._deadline_error("esperando lugar")
+                await asyncio.sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+            queue_span.end()
+
+    # ---------------- Llamadas ----------------
+
+    def call(self, create, tokens: int, attempts: int = LLM_MAX_ATTEMPTS, backoff: float = LLM_BACKOFF_BASE_S,
+             deadline_s: float = LLM_CALL_DEADLINE_S, trace=None, **kwargs):
+        """Ejecuta create(**kwargs, timeout=...) con admisión, reintentos y deadline."""
+        deadline = time.monotonic() + deadline_s
+        for attempt in range(attempts):
+            self._acquire(tokens, deadline, trace)
+            try:
+                resp = create(timeout=max(deadline - time.monotonic(), 0.001), **kwargs)
+            except Exception as e:
+                self._finish(e, tokens)
+                if self._give_up(e, attempt, attempts, trace):
+                    raise
+                delay = self._next_delay(e, attempt, backoff)
+                if time.monotonic() + delay > deadline:
+                    raise self._deadline_error("antes del siguiente reintento") from e
+                logging.warning(f"LLM error reintentable (intento {attempt+1}/{attempts}, espera {delay:.1f}s): {e}")
+                time.sleep(delay)
+                continue
+            self._finish(None, tokens, getattr(getattr(resp, "usage", None), "total_tokens", None))
+            return resp
+
+    async def acall(self, create, tokens: int, attempts: int = LLM_MAX_ATTEMPTS, backoff: float = LLM_BACKOFF_BASE_S,
+                    deadline_s: float = LLM_CALL_DEADLINE_S, trace=None, **kwargs):
+        """Versión asíncrona de call()."""
+        deadline = time.monotonic() + deadline_s
+        for attempt in range(attempts):
+            await self._aacquire(tokens, deadline, trace)
+            try:
+                resp = await create(timeout=max(deadline - time.monotonic(), 0.001), **kwargs)
+            except Exception as e:
+                self._finish(e, tokens)
+                if self._give_up(e, attempt, attempts, trace):
+                    raise
+                delay = self._next_delay(e, attempt, backoff)
+                if time.monotonic() + delay > deadline:
+                    raise self._deadline_error("antes del siguiente reintento") from e
+                logging.warning(f"LLM error reintentable (intento {attempt+1}/{attempts}, espera {delay:.1f}s): {e}")
+                await asyncio.sleep(delay)
+                continue
+            self._finish(None, tokens, getattr(getattr(resp, "usage", None), "total_tokens", None))
+            return resp
+
+    async def astream(self, create, tokens: int, attempts: int = LLM_MAX_ATTEMPTS, backoff: float = LLM_BACKOFF_BASE_S,
+                      deadline_s: float = LLM_CALL_DEADLINE_S, trace=None, **kwargs):
+        """Genera los chunks de un stream. Solo se reintenta la apertura; el lugar se mantiene hasta el final."""
+        deadline = time.monotonic() + deadline_s
+        for attempt in range(attempts):
+            await self._aacquire(tokens, deadline, trace)
+            try:
+                stream = await create(timeout=max(deadline - time.monotonic(), 0.001), **kwargs)
+            except Exception as e:
+                self._finish(e, tokens)
+                if self._give_up(e, attempt, attempts, trace):
+                    raise
+                delay = self._next_delay(e, attempt, backoff)
+                if time.monotonic() + delay > deadline:
+                    raise self._deadline_error("antes del siguiente reintento") from e
+                logging.warning(f"LLM stream error reintentable (intento {attempt+1}/{attempts}, espera {delay:.1f}s): {e}")
+                await asyncio.sleep(delay)
+                continue
+            used, failure = None, None
+            try:
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        used = getattr(chunk.usage, "total_tokens", None)
+                    yield chunk
+            except Exception as e:
+                failure = e
+                raise
+            finally:
+                self._finish(failure, tokens, used)
+            return
+
+    # ---------------- Métricas ----------------
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            if self._opened_at is None:
+                circuit = "closed"
+            elif now - self._opened_at < self._breaker_cooldown:
+                circuit = "open"
+            else:
+                circuit = "half_open"
+            return {
+                "queued": self._waiting,
+                "in_flight": self._in_flight,
+                "max_in_flight": self._max_in_flight,
+                "circuit": circuit,
+                "consecutive_failures": self._failures,
+                "paused_s": round(max(0.0, self._paused_until - now), 2),
+                "requests_available": round(self._requests.level, 1) if self._requests.capacity > 0 else None,
+                "tokens_available": round(self._tokens.level, 1) if self._tokens.capacity > 0 else None,
+                **self.counters,
+            }
+
+
+scheduler = LLMScheduler()
+
+register_metric("llm_sql_llm_queue_depth", "gauge", "Llamadas al LLM esperando lugar.", lambda: scheduler.snapshot()["queued"])
+register_metric("llm_sql_llm_in_flight", "gauge", "Llamadas al LLM en curso.", lambda: scheduler.snapshot()["in_flight"])
+register_metric("llm_sql_llm_circuit_open", "gauge", "1 si el circuit breaker del LLM no está cerrado.",
+                lambda: int(scheduler.snapshot()["circuit"] != "closed"))
+register_metric("llm_sql_llm_calls_total", "counter", "Llamadas al LLM por resultado.",
+                lambda: dict(scheduler.counters), label="outcome")
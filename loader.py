@@ -0,0 +1,151 @@
+# loader.py
+"""Carga el CSV de sensores en Postgres con COPY FROM STDIN.
+
+El CSV usa ';' como separador y coma decimal. Las columnas se cargan como
+double precision y se agrega ts_ms (cada fila son 50 ms) como clave temporal.
+El archivo se lee en streaming y se envía en lotes, con memoria constante.
+Al terminar se recrean los rollups por segundo y por minuto (ver rollups.py).
+
+Uso:
+    python loader.py llm_sql.csv [--table llm_sql] [--batch-rows 50000]
+"""
+import os
+import re
+import csv
+import argparse
+import logging
+from contextlib import closing
+
+from backend import get_engine, bump_data_version, invalidate_schema_catalog, setup_logging
+from rollups import ROLLUP_GRAINS, rollup_name, rollup_statements
+
+ROW_INTERVAL_MS = 50
+LOAD_BATCH_ROWS = int(os.getenv("LOAD_BATCH_ROWS", "50000"))
+TIME_COLUMN = "ts_ms"
+
+
+def column_name(header: str) -> str:
+    """Nombre de columna en Postgres: minúsculas y solo [a-z0-9_] (GEN_TsB -> gen_tsb)."""
+    name = re.sub(r"[^0-9a-z_]+", "_", header.strip().lower()).strip("_")
+    return name or "col"
+
+
+def _number(value: str, line_no: int, column: str) -> str:
+    """Convierte '375,0' -> '375.0' en formato texto de COPY ('\\N' para vacíos)."""
+    value = value.strip()
+    if not value:
+        return "\\N"
+    value = value.replace(",", ".")
+    try:
+        float(value)
+    except ValueError:
+        raise ValueError(f"Valor no numérico en la línea {line_no}, columna {column}: {value!r}")
+    return value
+
+
+class _LineStream:
+    """Objeto tipo archivo sobre un iterador de líneas (lo que consume copy_expert)."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buf = ""
+
+    def read(self, size=-1):
+        parts, length = [self._buf], len(self._buf)
+        while size < 0 or length < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            parts.append(line)
+            length += len(line)
+        data = "".join(parts)
+        if size < 0:
+            self._buf = ""
+            return data
+        self._buf = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        if self._buf:
+            line, self._buf = self._buf, ""
+            return line
+        return next(self._lines, "")
+
+
+def _batch_lines(reader, columns, first_row: int, batch_rows: int, counter: list):
+    """Genera hasta batch_rows líneas en formato texto de COPY, con ts_ms al principio."""
+    for i, row in enumerate(reader):
+        row_idx = first_row + i
+        line_no = row_idx + 2  # +1 por el encabezado, +1 por numerar desde 1
+        if len(row) != len(columns):
+            raise ValueError(f"La línea {line_no} tiene {len(row)} campos, se esperaban {len(columns)}")
+        values = [_number(v, line_no, c) for v, c in zip(row, columns)]
+        counter[0] += 1
+        yield f"{row_idx * ROW_INTERVAL_MS}\t" + "\t".join(values) + "\n"
+        if i + 1 >= batch_rows:
+            return
+
+
+def load_csv(engine, csv_path: str, table: str = None, batch_rows: int = LOAD_BATCH_ROWS, delimiter: str = ";") -> int:
+    """Carga el CSV en `table` (reemplazándola de forma atómica) y devuelve las filas cargadas."""
+    table = column_name(table or os.path.splitext(os.path.basename(csv_path))[0])
+    staging = f"{table}__loading"
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f, closing(engine.raw_connection()) as conn:
+        reader = csv.reader(f, delimiter=delimiter)
+        columns = [column_name(h) for h in next(reader)]
+        if len(set(columns)) != len(columns) or TIME_COLUMN in columns:
+            raise ValueError(f"Encabezado inválido o con columnas repetidas: {columns}")
+        cols_sql = ", ".join(f'"{c}" double precision' for c in columns)
+        quoted = ", ".join(f'"{c}"' for c in columns)
+        copy_sql = f'COPY "{staging}" ("{TIME_COLUMN}", {quoted}) FROM STDIN'
+        try:
+            cur = conn.cursor()
+            cur.execute(f'DROP TABLE IF EXISTS "{staging}"')
+            cur.execute(f'CREATE TABLE "{staging}" ("{TIME_COLUMN}" bigint NOT NULL, {cols_sql})')
+            loaded = 0
+            while True:
+                counter = [0]
+                cur.copy_expert(copy_sql, _LineStream(_batch_lines(reader, columns, loaded, batch_rows, counter)))
+                loaded += counter[0]
+                logging.info(f"loader: {loaded} filas cargadas en {staging}")
+                if counter[0] < batch_rows:
+                    break
+            # Índice creado después del COPY (más rápido que mantenerlo durante la carga)
+            cur.execute(f'ALTER TABLE "{staging}" ADD CONSTRAINT "{table}_pkey_new" PRIMARY KEY ("{TIME_COLUMN}")')
+            cur.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE')
+            cur.execute(f'ALTER TABLE "{staging}" RENAME TO "{table}"')
+            cur.execute(f'ALTER TABLE "{table}" RENAME CONSTRAINT "{table}_pkey_new" TO "{table}_pkey"')
+            # Los rollups caen con el CASCADE: se recrean en la misma transacción
+            for stmt in rollup_statements(table, columns):
+                cur.execute(stmt)
+            conn.commit()
+            for name in [table] + [rollup_name(table, g) for g in ROLLUP_GRAINS]:
+                cur.execute(f'ANALYZE "{name}"')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    invalidate_schema_catalog(engine)
+    bump_data_version()
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga el CSV de sensores en Postgres con COPY.")
+    parser.add_argument("csv_path", nargs="?", default="llm_sql.csv")
+    parser.add_argument("--table", default=None, help="Tabla destino (por defecto, el nombre del archivo)")
+    parser.add_argument("--batch-rows", type=int, default=LOAD_BATCH_ROWS)
+    parser.add_argument("--delimiter", default=";")
+    args = parser.parse_args()
+
+    setup_logging()
+    engine = get_engine()
+    if engine is None:
+        raise SystemExit("Configura POSTGRES_USER, POSTGRES_PASSWORD y POSTGRES_DB para cargar datos.")
+    loaded = load_csv(engine, args.csv_path, args.table, args.batch_rows, args.delimiter)
+    print(f"{loaded} filas cargadas en {column_name(args.table or os.path.splitext(os.path.basename(args.csv_path))[0])}")
+
+
+if __name__ == "__main__":
+    main()
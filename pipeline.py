@@ -0,0 +1,480 @@
+# pipeline.py
+import os
+import asyncio
+import json
+import threading
+import time
+from string import Formatter
+
+from backend import (
+    LLM_MODEL, system_prompt_text, get_schema_catalog, clean_text,
+    parse_json_decision, extract_sql_queries, run_sql_queries,
+    async_safe_chat_completion, astream_chat_completion
+)
+from condense import condense_result
+from rollups import route_query
+from sql_validation import split_sql, validate_sql
+from sql_cache import SQL_CACHE_ENABLED, catalog_columns, sql_cache
+from intent import DATA, classify_intent
+from rag import retrieve_chunks
+from tokens import count_tokens, fit_to_budget
+from prompting import assemble, dedupe_chunks, static_prefix_report
+from tracing import span, start_span, stats as trace_stats
+from utils import load_txt
+from base_prompt import (
+    ANSWER_TEMPLATE_INSTRUCTION, DECIDE_INSTRUCTION, FINAL_INSTRUCTION, GENERAL_PROMPT, INVALID_SQL_INSTRUCTION,
+    REJECTED_SQL_INSTRUCTION
+)
+
+# Veces que se le devuelve al modelo SQL inválido o rechazado por costo para que lo corrija
+SQL_REPAIR_ATTEMPTS = int(os.getenv("SQL_REPAIR_ATTEMPTS", "2"))
+SQL_MAX_STATEMENTS = int(os.getenv("SQL_MAX_STATEMENTS", "5"))
+# classic: decisión -> SQL -> respuesta final, siempre
+# routed:  además, un router local manda las preguntas claramente sin datos directo a la respuesta general
+# single:  routed + la decisión trae una plantilla de respuesta que se completa localmente
+#          cuando todas las consultas devuelven una fila (sin segunda llamada al LLM)
+PIPELINE_MODES = ("classic", "routed", "single")
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "classic").lower()
+
+# ===================== Pipeline asíncrono de un turno ======================
+# decisión JSON -> SQL -> respuesta final en streaming. Los eventos que produce
+# astream_turn son dicts con "type":
+#   budget   -> {"call", "total", "budget", "trimmed", "parts", "static_prefix"} tokens de cada prompt
+#   route    -> {"mode", "intent"} modo del pipeline y decisión del router local
+#   cache    -> {"question", "similarity", "exact"} SQL reutilizado de una pregunta equivalente
+#   decision -> {"needs_sql", "queries", "executed", "cached"} (executed: SQL tras rutear a los rollups)
+#   invalid  -> {"invalid"} consultas que no pasaron la validación local, con sus errores
+#   sql      -> {"rows", "truncated", "errors"} filas devueltas por cada consulta ejecutada
+#   rejected -> {"rejections"} consultas rechazadas por costo que se devuelven al modelo
+#   usage    -> {"tokens"} por cada llamada al LLM
+#   token    -> {"text"} fragmento de la respuesta final
+#   done     -> {"answer", "tokens", "template"} (template: respuesta completada localmente)
+
+
+async def _empty():
+    return []
+
+
+def _history_messages(history: list) -> list:
+    """Deja solo role/content (los mensajes de la UI llevan hora y tokens)."""
+    return [{"role": m["role"], "content": m["content"]} for m in history if m.get("content")]
+
+
+def parse_decision(dec_text: str):
+    """Devuelve (needs_sql, queries) a partir del texto de decisión del modelo."""
+    decision = parse_json_decision(dec_text)
+    if decision:
+        needs_sql = bool(decision.get("needs_sql", False))
+        queries = decision.get("sql") or []
+        if isinstance(queries, str):
+            queries = extract_sql_queries(queries)
+        # Un elemento con varias sentencias se separa (cada una se valida y ejecuta por su cuenta)
+        return needs_sql, [s for q in queries if isinstance(q, str) for s in split_sql(q)]
+    queries = extract_sql_queries(dec_text)
+    return bool(queries), queries
+
+
+def parse_answer_template(dec_text: str) -> str:
+    """Plantilla de respuesta del modo single ("" si el modelo no la dio)."""
+    decision = parse_json_decision(dec_text)
+    template = decision.get("answer_template") if isinstance(decision, dict) else None
+    return template.strip() if isinstance(template, str) else ""
+
+
+def fill_answer_template(template: str, results: list):
+    """Completa la plantilla con los valores de resultados de una fila; None si no se puede.
+
+    Solo se aceptan campos que sean alias de columna ({alias} o {alias:.2f}): nada
+    de posicionales, atributos, índices ni formatos anidados ({alias:{ancho}}).
+    """
+    if not template or not results:
+        return None
+    values = {}
+    for r in results:
+        if "error" in r or r.get("row_count") != 1:
+            return None
+        values.update({col: data[0] for col, data in zip(r["columns"], r["data"])})
+    try:
+        parsed = [(field, spec) for _, field, spec, _ in Formatter().parse(template) if field is not None]
+        if not parsed or any(field not in values or "{" in (spec or "") for field, spec in parsed):
+            return None
+        return template.format_map(values)
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+        return None
+
+
+def validate_queries(queries: list, catalog) -> list:
+    """Consultas inválidas contra el esquema cacheado: lista de (query, errores)."""
+    invalid = []
+    for q in queries:
+        errors = validate_sql(q, catalog)
+        if errors:
+            invalid.append((q, errors))
+    if len(queries) > SQL_MAX_STATEMENTS:
+        invalid.append((f"{len(queries)} consultas", [f"Se permiten como máximo {SQL_MAX_STATEMENTS} consultas por pregunta."]))
+    return invalid
+
+
+def lookup_cached_sql(turn: dict):
+    """SQL verificado de una pregunta equivalente, si sigue siendo válido contra el esquema actual."""
+    catalog = turn["catalog"]
+    if not SQL_CACHE_ENABLED or catalog is None:
+        return None
+    hit = sql_cache.lookup(turn["user_prompt"], catalog.fingerprint, catalog_columns(catalog))
+    if hit is not None and validate_queries(hit["queries"], catalog):
+        sql_cache.discard(hit["question"])
+        return None
+    return hit
+
+
+async def prepare_turn(engine, vectordb, user_prompt: str, history: list) -> dict:
+    """Reúne el material del turno: catálogo de esquema, instrucciones y chunks RAG se obtienen en paralelo."""
+    catalog, extra_context, chunks = await asyncio.gather(
+        asyncio.to_thread(get_schema_catalog, engine),
+        asyncio.to_thread(load_txt),
+        asyncio.to_thread(retrieve_chunks, user_prompt, vectordb) if vectordb else _empty(),
+    )
+    history = _history_messages(history)
+    # La pregunta actual va al final del prompt, no dentro del historial
+    if history and history[-1]["role"] == "user" and history[-1]["content"] == user_prompt:
+        history = history[:-1]
+    return {
+        "engine": engine,
+        "catalog": catalog,
+        "extra_context": extra_context,
+        "static": {},  # sample_rows -> (prompt estático, filas de ejemplo), ver _static
+        "history": history,
+        "user_prompt": user_prompt,
+        "chunks": chunks,
+        "sample_rows": len(catalog.sample_rows) if catalog else 0,
+    }
+
+
+def _static(turn: dict, sample_rows: int):
+    """Prompt estático y el texto de las filas de ejemplo que contiene.
+
+    Se arma con el catálogo y las instrucciones del turno (sin E/S) y se reutiliza en
+    cada iteración del recorte por presupuesto y entre llamadas del mismo turno.
+    """
+    cached = turn["static"].get(sample_rows)
+    if cached is None:
+        static_text = system_prompt_text(turn["catalog"], turn["extra_context"], sample_rows)
+        samples = turn["catalog"].samples_text(sample_rows) if turn["catalog"] else ""
+        cached = turn["static"][sample_rows] = (static_text, samples)
+    return cached
+
+
+def _with_prefix_report(fitted):
+    messages, report = fitted
+    report["static_prefix"] = static_prefix_report(messages, lambda t: count_tokens(t, LLM_MODEL))
+    return messages, report
+
+
+def validation_feedback(invalid: list) -> str:
+    """Instrucción con los errores de validación (lista de (query, errores))."""
+    return INVALID_SQL_INSTRUCTION.format(errors="\n".join(
+        f"- {q}\n  " + "\n  ".join(errors) for q, errors in invalid
+    ))
+
+
+def rejection_feedback(rejected: list) -> str:
+    """Instrucción con las consultas rechazadas por costo (lista de (query, resultado))."""
+    return REJECTED_SQL_INSTRUCTION.format(rejections="\n".join(
+        f"- {q} -> costo estimado {r['estimated_cost']:.0f} (máximo {r['max_cost']:.0f})" for q, r in rejected
+    ))
+
+
+def decision_messages(turn: dict, feedback: str = "", template: bool = False):
+    """Prompt de la llamada de decisión, recortado al presupuesto de tokens."""
+    instructions = DECIDE_INSTRUCTION + (ANSWER_TEMPLATE_INSTRUCTION if template else "")
+
+    def build(history, chunks, sample_rows):
+        static_text, samples = _static(turn, sample_rows)
+        rag_text = "\n".join(dedupe_chunks(chunks, static_text))
+        if rag_text:
+            rag_text = f"Información relevante del archivo:\n{rag_text}"
+        messages = assemble(static_text, history, [rag_text, instructions, feedback], turn["user_prompt"])
+        return messages, {
+            "static": static_text.replace(samples, "", 1),
+            "samples": samples,
+            "history": history,
+            "rag": rag_text,
+            "instructions": instructions + feedback,
+            "user": turn["user_prompt"],
+        }
+    return _with_prefix_report(fit_to_budget(build, turn["history"], turn["chunks"], turn["sample_rows"], LLM_MODEL, keep_history=0))
+
+
+def final_messages(turn: dict, results_for_model: list):
+    results_json = json.dumps(results_for_model, ensure_ascii=False, default=str, separators=(",", ":"))
+    question = f"Pregunta original: {turn['user_prompt']}\nResultados ejecutados: {results_json}"
+
+    def build(history, chunks, sample_rows):
+        static_text, samples = _static(turn, sample_rows)
+        messages = assemble(static_text, history, [FINAL_INSTRUCTION], question)
+        return messages, {
+            "static": static_text.replace(samples, "", 1),
+            "samples": samples,
+            "history": history,
+            "instructions": FINAL_INSTRUCTION,
+            "results": question,
+        }
+    return _with_prefix_report(fit_to_budget(build, turn["history"], [], turn["sample_rows"], LLM_MODEL, keep_history=0))
+
+
+def general_messages(turn: dict):
+    def build(history, chunks, sample_rows):
+        context_info = ""
+        if chunks:
+            context_info = "\nInformación contextual de la base:\n" + "\n".join(dedupe_chunks(chunks, ""))
+        messages = assemble(GENERAL_PROMPT + context_info, [], [], turn["user_prompt"])
+        return messages, {"instructions": GENERAL_PROMPT, "rag": context_info, "user": turn["user_prompt"]}
+    return fit_to_budget(build, [], turn["chunks"], 0, LLM_MODEL, keep_history=0)
+
+
+async def astream_turn(engine, vectordb, user_prompt: str, history: list, trace_parent=None, mode: str = None):
+    """Ejecuta un turno completo y emite eventos; la respuesta final llega token a token.
+
+    `mode` es uno de PIPELINE_MODES (por defecto PIPELINE_MODE). Cada etapa queda
+    registrada como span hijo de "turn" (ver tracing.py), y la duración del turno
+    también como "turn[<modo>]" para comparar modos. Los spans se abren solo
+    alrededor de los await: cada paso del generador puede correr en otro contexto,
+    así que ninguno queda abierto a través de un yield.
+    """
+    mode = (mode or PIPELINE_MODE).lower()
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Modo de pipeline desconocido: {mode!r} (opciones: {', '.join(PIPELINE_MODES)})")
+    root = start_span("turn", parent=trace_parent, mode=mode)
+    error = None
+    try:
+        async for event in _turn_events(engine, vectordb, user_prompt, history, root, mode):
+            if event["type"] == "usage":
+                root.add("llm_calls")
+            elif event["type"] == "done":
+                root.set(tokens=event["tokens"], template=bool(event.get("template")))
+            yield event
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            error = e
+        raise
+    finally:
+        root.end(error=error)
+        trace_stats.record(f"turn[{mode}]", root.duration_ms, error is not None, root.attrs)
+
+
+async def _turn_events(engine, vectordb, user_prompt: str, history: list, root, mode: str):
+    with span("prepare", parent=root):
+        turn = await prepare_turn(engine, vectordb, user_prompt, history)
+    total_tokens = 0
+
+    # ---------------- Router local: lo claramente sin datos va directo a la respuesta general ----------------
+    intent = classify_intent(user_prompt, turn["catalog"]) if mode != "classic" else DATA
+    root.set(intent=intent)
+    yield {"type": "route", "mode": mode, "intent": intent}
+
+    needs_sql, queries, template, hit = False, [], "", None
+    if intent == DATA:
+        # ---------------- Paso 0: SQL ya verificado para una pregunta equivalente ----------------
+        with span("sql_cache", parent=root) as trace:
+            hit = await asyncio.to_thread(lookup_cached_sql, turn)
+            trace.set(hit=hit is not None)
+    # Si el SQL reutilizado falla se vuelve a la llamada de decisión sin gastar un intento de reparación
+    last_attempt = SQL_REPAIR_ATTEMPTS + (1 if hit is not None else 0)
+
+    feedback, results = "", []
+    for attempt in (range(last_attempt + 1) if intent == DATA else ()):
+        if hit is not None:
+            needs_sql, queries = True, hit["queries"]
+            template = hit["template"] if mode == "single" else ""
+            yield {"type": "cache", "question": hit["question"], "similarity": hit["similarity"], "exact": hit["exact"]}
+        else:
+            # ---------------- Paso 1: Generar decisión JSON ----------------
+            # Armar y tokenizar el prompt es CPU: fuera del event loop compartido
+            messages, report = await asyncio.to_thread(decision_messages, turn, feedback, mode == "single")
+            yield {"type": "budget", "call": "decision", **report}
+            try:
+                with span("decision", parent=root, attempt=attempt):
+                    dec_resp = await async_safe_chat_completion(model=LLM_MODEL, messages=messages)
+                dec_text = dec_resp.choices[0].message.content
+                used_tokens = getattr(dec_resp.usage, "total_tokens", 0)
+                total_tokens += used_tokens
+                yield {"type": "usage", "tokens": used_tokens}
+            except Exception as e:
+                dec_text = json.dumps({"needs_sql": False, "sql": [], "notes": f"error: {e}"})
+
+            # ---------------- Paso 2: Parsear decisión ----------------
+            needs_sql, queries = parse_decision(dec_text)
+            template = parse_answer_template(dec_text) if mode == "single" else ""
+        # Las agregaciones que lo permiten se leen de los rollups en lugar de la tabla cruda
+        executed = [route_query(q, turn["catalog"]) for q in queries]
+        yield {"type": "decision", "needs_sql": needs_sql, "queries": queries, "executed": executed, "cached": hit is not None}
+        if not (needs_sql and queries):
+            break
+
+        # ---------------- Paso 3: Validar localmente y ejecutar SQL ----------------
+        with span("validate", parent=root, queries=len(queries)) as trace:
+            invalid = validate_queries(queries, turn["catalog"])
+            trace.set(invalid=len(invalid))
+        if invalid:
+            yield {"type": "invalid", "invalid": [{"query": q, "errors": e} for q, e in invalid]}
+            if attempt == last_attempt:
+                # SQL que se sabe inválido nunca llega a la base
+                results = [{"error": f"{q}: {' '.join(e)}"} for q, e in invalid]
+                break
+            feedback = validation_feedback(invalid)
+            continue
+        with span("sql", parent=root, queries=len(executed)) as trace:
+            results = await asyncio.to_thread(run_sql_queries, engine, executed)
+            trace.set(rows=sum(r.get("row_count", 0) for r in results))
+        yield {
+            "type": "sql",
+            "rows": [r.get("row_count", 0) for r in results],
+            "truncated": [bool(r.get("truncated")) for r in results],
+            "errors": sum(1 for r in results if "error" in r),
+        }
+        if hit is not None and any("error" in r for r in results):
+            sql_cache.discard(hit["question"])
+            hit = None
+            continue
+        rejected = [(q, r) for q, r in zip(queries, results) if r.get("rejected")]
+        if not rejected or attempt == last_attempt:
+            break
+        # Las consultas demasiado caras vuelven al modelo para que las reescriba
+        feedback = rejection_feedback(rejected)
+        yield {"type": "rejected", "rejections": [{"query": q, **r} for q, r in rejected]}
+
+    # ---------------- Armar el prompt final ----------------
+    if needs_sql and queries:
+        errors = [r["error"] for r in results if "error" in r and not r.get("cancelled")]
+        if not errors and hit is None and SQL_CACHE_ENABLED and turn["catalog"] is not None:
+            # SQL que corrió sin errores: queda disponible para preguntas equivalentes
+            await asyncio.to_thread(sql_cache.store, user_prompt, queries, turn["catalog"].fingerprint, template,
+                                    catalog_columns(turn["catalog"]))
+        if errors:
+            answer = "⚠️ Algunas consultas fallaron:\n" + "\n".join(errors)
+            yield {"type": "token", "text": answer}
+            yield {"type": "done", "answer": answer, "tokens": total_tokens}
+            return
+        # Modo single: resultados de una fila y plantilla válida -> sin segunda llamada al LLM
+        answer = fill_answer_template(template, results)
+        if answer:
+            yield {"type": "token", "text": answer}
+            yield {"type": "done", "answer": answer, "tokens": total_tokens, "template": True}
+            return
+        messages, report = await asyncio.to_thread(final_messages, turn, [
+            {"query": q, "result": condense_result(r)} for q, r in zip(queries, results)
+        ])
+        yield {"type": "budget", "call": "final", **report}
+        error_prefix = "Error generando respuesta final"
+    else:
+        # ---------------- Consulta general sin SQL ----------------
+        messages, report = await asyncio.to_thread(general_messages, turn)
+        yield {"type": "budget", "call": "general", **report}
+        error_prefix = "Error generando respuesta conversacional"
+
+    # ---------------- Paso 4: Respuesta final en streaming ----------------
+    usage, parts = {}, []
+    try:
+        async for delta in astream_chat_completion(model=LLM_MODEL, messages=messages, usage=usage, trace_parent=root):
+            parts.append(delta)
+            yield {"type": "token", "text": delta}
+    except Exception as e:
+        parts = [f"{error_prefix}: {e}"]
+        yield {"type": "token", "text": parts[0]}
+    used_tokens = usage.get("total_tokens", 0)
+    total_tokens += used_tokens
+    yield {"type": "usage", "tokens": used_tokens}
+    yield {"type": "done", "answer": clean_text("".join(parts)), "tokens": total_tokens}
+
+
+# ===================== Orquestador síncrono ======================
+# Etapa a la que se atribuye el tiempo transcurrido hasta cada evento
+_STAGE_OF_EVENT = {
+    "route": "prepare",
+    "budget": "prepare",
+    "cache": "sql_cache",
+    "decision": "decision_llm",
+    "invalid": "validate",
+    "sql": "sql",
+    "rejected": "sql",
+    "token": "final_llm",
+    "done": "final_llm",
+}
+
+
+def run_turn(engine, vectordb, user_prompt: str, history: list, mode: str = None) -> dict:
+    """Ejecuta un turno completo fuera de la UI y devuelve respuesta, tokens, filas y tiempos por etapa.
+
+    Los tiempos (ms) se atribuyen por evento: hasta el presupuesto de la decisión es
+    "prepare", hasta la decisión "decision_llm", hasta el resultado SQL "sql" y hasta
+    el final del streaming "final_llm" ("first_token_ms" mide el primer fragmento).
+    También devuelve el modo, la intención del router, si hubo SQL y cuántas
+    llamadas al LLM hizo el turno.
+    """
+    stages, events, rows = {}, [], 0
+    answer, tokens, first_token_ms = "", 0, None
+    route, needs_sql, llm_calls = {}, False, 0
+    started = last = time.perf_counter()
+    for event in iterate_sync(astream_turn(engine, vectordb, user_prompt, history, mode=mode)):
+        now = time.perf_counter()
+        stage = _STAGE_OF_EVENT.get(event["type"])
+        if event["type"] == "budget" and event["call"] != "decision":
+            stage = "prepare_final"
+        if stage:
+            stages[stage] = stages.get(stage, 0.0) + (now - last) * 1000
+            last = now
+        if event["type"] == "token" and first_token_ms is None:
+            first_token_ms = (now - started) * 1000
+        elif event["type"] == "sql":
+            rows += sum(event["rows"])
+        elif event["type"] == "route":
+            route = event
+        elif event["type"] == "decision":
+            needs_sql = bool(event["needs_sql"] and event["queries"])
+        elif event["type"] == "usage":
+            llm_calls += 1
+        elif event["type"] == "done":
+            answer, tokens = event["answer"], event["tokens"]
+        events.append(event)
+    return {
+        "answer": answer,
+        "tokens": tokens,
+        "rows": rows,
+        "mode": route.get("mode"),
+        "intent": route.get("intent"),
+        "needs_sql": needs_sql,
+        "llm_calls": llm_calls,
+        "stages": stages,
+        "total_ms": (time.perf_counter() - started) * 1000,
+        "first_token_ms": first_token_ms,
+        "events": events,
+    }
+
+
+# ===================== Puente síncrono ======================
+# Un único event loop de fondo por proceso: el cliente AsyncOpenAI (httpx) queda
+# ligado a un loop, así que todas las sesiones de Streamlit lo comparten.
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _get_loop():
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="pipeline-loop", daemon=True).start()
+        return _LOOP
+
+
+def iterate_sync(agen):
+    """Consume un generador asíncrono desde código síncrono (p. ej. st.write_stream)."""
+    loop = _get_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
@@ -0,0 +1,66 @@
+# prompting.py
+import re
+import hashlib
+from base_prompt import BASE_SYSTEM_PROMPT
+
+# ===================== Ensamblado de prompts ======================
+# Todo lo estático (prompt base con esquema y ejemplos + archivo de instrucciones)
+# va una sola vez, en el primer mensaje y byte a byte idéntico entre turnos; luego
+# el historial previo (que solo crece por el final) y al final lo propio del turno
+# (RAG, instrucción de la llamada y la pregunta actual). Así el proveedor puede
+# reutilizar el prefijo cacheado entre turnos y entre la llamada de decisión y la final.
+
+
+def static_system_prompt(schema_text: str, table_name: str, samples: str, extra_context: str = "") -> str:
+    """Prompt de sistema estático: prompt base con esquema/ejemplos y el archivo de instrucciones."""
+    base = BASE_SYSTEM_PROMPT \
+        .replace("{db_schema}", schema_text) \
+        .replace("{table_name}", table_name) \
+        .replace("{table_examples}", samples)
+    if extra_context:
+        base = base + ("\n\n📘 Contexto adicional del archivo:\n" + extra_context)
+    return base
+
+
+def _squash(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def dedupe_chunks(chunks: list, static_text: str) -> list:
+    """Quita los chunks RAG que ya están completos dentro del contenido estático (y los repetidos)."""
+    static = _squash(static_text)
+    seen, kept = set(), []
+    for chunk in chunks:
+        key = _squash(chunk)
+        if not key or key in seen or key in static:
+            continue
+        seen.add(key)
+        kept.append(chunk)
+    return kept
+
+
+def assemble(static_text: str, history: list, turn_blocks: list, user_message: str = None) -> list:
+    """Ordena los mensajes: estático, historial previo y, al final, lo propio del turno."""
+    messages = []
+    if static_text:
+        messages.append({"role": "system", "content": static_text})
+    messages.extend(history)
+    messages.extend({"role": "system", "content": b} for b in turn_blocks if b)
+    if user_message:
+        messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+def static_prefix_report(messages: list, count) -> dict:
+    """Tamaño y huella del prefijo estático (primer mensaje de sistema) de un prompt ensamblado.
+
+    `count(text)` cuenta tokens; la huella permite verificar que el prefijo no cambia entre turnos.
+    """
+    if not messages or messages[0]["role"] != "system":
+        return {"tokens": 0, "chars": 0, "sha256": ""}
+    text = messages[0]["content"]
+    return {
+        "tokens": count(text),
+        "chars": len(text),
+        "sha256": hashlib.sha256(text.encode("utf-8")).hexdigest()[:16],
+    }
@@ -1,26 +1,110 @@
 # rag.py
 import os
+import json
 import hashlib
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import logging
+import threading
+from collections import OrderedDict
 
-# Try to import embeddings with backward/forward compatibility
-try:
-    # Newer packaging
-    from langchain_openai import OpenAIEmbeddings
-except Exception:
+# LangChain, Chroma y el cliente de embeddings se importan en el primer uso: el
+# camino sin RAG no los carga, y con un índice al día solo se abre el backend elegido
+from utils import load_txt, TXT_FILE
+from vector_index import HashingEmbeddings, NumpyVectorIndex
+from tracing import current_span, span
+
+VECTOR_DIR = "vector_store"
+# Backend del índice: "chroma" (persistente, SQLite) o "numpy" (matriz .npy en proceso).
+# Embedder: "openai" o "hash" (local y determinista, para correr/medir offline).
+RAG_BACKEND = os.getenv("RAG_BACKEND", "chroma").lower()
+RAG_EMBEDDER = os.getenv("RAG_EMBEDDER", "openai").lower()
+NUMPY_SUBDIR = "numpy"
+MANIFEST_FILE = "manifest.json"
+EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "64"))
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "256"))
+
+# Recursos de larga vida compartidos por todas las sesiones del proceso
+_EMBEDDINGS = None
+_STORES = {}  # (rutas, vector_dir, chunk_size, chunk_overlap) -> (firma de los archivos, hash, store)
+_LAST_SYNC_STATS = {}
+_RAG_LOCK = threading.RLock()
+
+
+def _mark_embedding_cache(hit: bool):
+    s = current_span()
+    if s is not None:
+        s.set(embedding_cache_hit=hit)
+
+
+def _openai_embeddings_class():
+    """OpenAIEmbeddings según la versión instalada de LangChain, o None."""
     try:
-        from langchain.embeddings.openai import OpenAIEmbeddings
+        # Newer packaging
+        from langchain_openai import OpenAIEmbeddings
     except Exception:
-        OpenAIEmbeddings = None
+        try:
+            from langchain.embeddings.openai import OpenAIEmbeddings
+        except Exception:
+            return None
+    return OpenAIEmbeddings
 
-from langchain.vectorstores import Chroma
 
-VECTOR_DIR = "vector_store"
+class MemoizedEmbeddings:
+    """Cliente de embeddings que memoriza embed_query (LRU) para no repetir la misma consulta.
+
+    Cumple la interfaz Embeddings de LangChain (embed_query / embed_documents) sin
+    heredar de ella, igual que HashingEmbeddings, para no importar LangChain.
+    """
+
+    def __init__(self, inner, maxsize: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.inner = inner
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed_query(self, text):
+        with self._lock:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                _mark_embedding_cache(True)
+                return self._cache[text]
+        _mark_embedding_cache(False)
+        vector = self.inner.embed_query(text)
+        with self._lock:
+            self.misses += 1
+            self._cache[text] = vector
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.inner.embed_documents(texts)
+
+
+def get_embeddings():
+    """Devuelve el cliente de embeddings compartido (se crea una sola vez)."""
+    global _EMBEDDINGS
+    with _RAG_LOCK:
+        if _EMBEDDINGS is None:
+            if RAG_EMBEDDER == "hash":
+                _EMBEDDINGS = MemoizedEmbeddings(HashingEmbeddings())
+            else:
+                OpenAIEmbeddings = _openai_embeddings_class()
+                if OpenAIEmbeddings is None:
+                    raise ImportError("OpenAIEmbeddings no está disponible. Revisa la versión de LangChain/langchain-openai.")
+                _EMBEDDINGS = MemoizedEmbeddings(OpenAIEmbeddings())
+        return _EMBEDDINGS
 
 def _get_text_hash(text: str):
     """Genera un hash del texto para detectar cambios."""
     return hashlib.md5(text.encode("utf-8")).hexdigest()
 
+def _chunk_id(chunk: str) -> str:
+    """Id direccionado por contenido: el mismo chunk siempre tiene el mismo id."""
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
 def _chroma_store_exists(vector_dir: str):
     """Comprobación más robusta de persistencia de Chroma."""
     if not os.path.exists(vector_dir):
@@ -29,75 +113,186 @@ def _chroma_store_exists(vector_dir: str):
     for name in ("chroma.sqlite3", "index", ".chromadb"):
         if os.path.exists(os.path.join(vector_dir, name)):
             return True
-    # fallback: any files present
-    return any(os.scandir(vector_dir))
+    # fallback: any files present (except our own bookkeeping / the numpy backend)
+    return any(e.name not in (MANIFEST_FILE, "text_hash.txt", NUMPY_SUBDIR) for e in os.scandir(vector_dir))
 
-def create_rag_store(text, vector_dir=VECTOR_DIR, chunk_size=1000, chunk_overlap=50):
-    """Crea o carga el vector store de manera persistente según hash del texto."""
-    if not text:
-        return None
-
-    if OpenAIEmbeddings is None:
-        raise ImportError("OpenAIEmbeddings no está disponible. Revisa la versión de LangChain/langchain-openai.")
+def _store_dir(vector_dir: str) -> str:
+    return os.path.join(vector_dir, NUMPY_SUBDIR) if RAG_BACKEND == "numpy" else vector_dir
 
-    os.makedirs(vector_dir, exist_ok=True)
-    hash_file = os.path.join(vector_dir, "text_hash.txt")
-    old_hash = None
-    if os.path.exists(hash_file):
-        try:
-            with open(hash_file, "r", encoding="utf-8") as f:
-                old_hash = f.read().strip()
-        except Exception:
-            old_hash = None
+def _store_exists(vector_dir: str) -> bool:
+    if RAG_BACKEND == "numpy":
+        return NumpyVectorIndex.exists(_store_dir(vector_dir))
+    return _chroma_store_exists(vector_dir)
 
-    current_hash = _get_text_hash(text)
+def _read_manifest(store_dir: str) -> dict:
+    try:
+        with open(os.path.join(store_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    need_rebuild = current_hash != old_hash or not _chroma_store_exists(vector_dir)
+def _write_manifest(store_dir: str, manifest: dict):
+    path = os.path.join(store_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
 
-    if need_rebuild:
-        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        chunks = splitter.split_text(text)
-        embeddings = OpenAIEmbeddings()
-        vectordb = Chroma.from_texts(chunks, embedding=embeddings, persist_directory=vector_dir) \
-            if hasattr(Chroma, "from_texts") else Chroma.from_texts(chunks, embeddings, persist_directory=vector_dir)
-        # persist may be a method or automatic depending on version
+def _open_store(vector_dir: str, reset: bool = False):
+    """Abre (o crea vacío) el índice del backend configurado."""
+    embeddings = get_embeddings()
+    if RAG_BACKEND == "numpy":
+        store_dir = _store_dir(vector_dir)
+        if reset or not NumpyVectorIndex.exists(store_dir):
+            return NumpyVectorIndex.from_texts([], embeddings, store_dir)
+        return NumpyVectorIndex(store_dir, embeddings)
+    from langchain.vectorstores import Chroma
+    # In some versions constructor signature is different
+    try:
+        vectordb = Chroma(persist_directory=vector_dir, embedding_function=embeddings)
+    except Exception:
+        vectordb = Chroma(persist_directory=vector_dir, embeddings=embeddings)
+    if reset:
+        # Índice sin manifest (formato anterior, ids aleatorios): se vacía y se reconstruye
         try:
-            vectordb.persist()
+            vectordb.delete_collection()
         except Exception:
             pass
         try:
-            with open(hash_file, "w", encoding="utf-8") as f:
-                f.write(current_hash)
+            vectordb = Chroma(persist_directory=vector_dir, embedding_function=embeddings)
         except Exception:
-            pass
-    else:
-        vectordb = load_rag_store(vector_dir)
+            vectordb = Chroma(persist_directory=vector_dir, embeddings=embeddings)
+    return vectordb
+
+def sync_rag_store(source_texts: dict, vector_dir=VECTOR_DIR, chunk_size=1000, chunk_overlap=50,
+                   batch_size=EMBED_BATCH_SIZE):
+    """Sincroniza el índice con {fuente: texto} re-embebiendo solo los chunks nuevos o cambiados.
+
+    Los chunks se identifican por el hash de su contenido; el manifest guarda el hash de
+    cada fuente y sus chunks, así una fuente sin cambios ni siquiera se vuelve a partir.
+    Devuelve (store, stats) con stats = {"reused", "embedded", "deleted", "sources"}.
+    """
+    with span("rag.sync") as trace:
+        store_dir = _store_dir(vector_dir)
+        os.makedirs(store_dir, exist_ok=True)
+        settings = {"backend": RAG_BACKEND, "embedder": RAG_EMBEDDER, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+        manifest = _read_manifest(store_dir)
+        compatible = manifest.get("settings") == settings and _store_exists(vector_dir)
+        old_sources = manifest.get("sources", {}) if compatible else {}
+
+        splitter = None
+        sources, texts_by_id, meta_by_id = {}, {}, {}
+        for source, text in source_texts.items():
+            if not text:
+                continue
+            text_hash = _get_text_hash(text)
+            previous = old_sources.get(source)
+            if previous and previous.get("hash") == text_hash:
+                sources[source] = previous
+                continue
+            if splitter is None:
+                from langchain.text_splitter import RecursiveCharacterTextSplitter
+                splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+            ids = []
+            for chunk in splitter.split_text(text):
+                cid = _chunk_id(chunk)
+                ids.append(cid)
+                texts_by_id.setdefault(cid, chunk)
+                meta_by_id.setdefault(cid, {"source": source, "chunk_id": cid})
+            sources[source] = {"hash": text_hash, "chunks": ids}
+
+        existing = {cid for entry in old_sources.values() for cid in entry.get("chunks", [])}
+        needed = {cid for entry in sources.values() for cid in entry["chunks"]}
+        new_ids = [cid for cid in texts_by_id if cid in needed and cid not in existing]
+        deleted = list(existing - needed)
+
+        vectordb = _open_store(vector_dir, reset=not compatible)
+        if deleted:
+            vectordb.delete(ids=deleted)
+        if new_ids:
+            if RAG_BACKEND == "numpy":
+                vectordb.add_texts([texts_by_id[c] for c in new_ids], metadatas=[meta_by_id[c] for c in new_ids],
+                                   ids=new_ids, batch_size=batch_size)
+            else:
+                for i in range(0, len(new_ids), batch_size):
+                    batch = new_ids[i:i + batch_size]
+                    vectordb.add_texts([texts_by_id[c] for c in batch], metadatas=[meta_by_id[c] for c in batch], ids=batch)
+                # persist may be a method or automatic depending on version
+                try:
+                    vectordb.persist()
+                except Exception:
+                    pass
+        _write_manifest(store_dir, {"settings": settings, "sources": sources})
 
+        stats = {"reused": len(needed) - len(new_ids), "embedded": len(new_ids), "deleted": len(deleted), "sources": len(sources)}
+        _LAST_SYNC_STATS.update(stats)
+        logging.info(f"RAG sync: {stats}")
+        trace.set(**stats)
+        return vectordb, stats
+
+def create_rag_store(text, vector_dir=VECTOR_DIR, chunk_size=1000, chunk_overlap=50, source=TXT_FILE):
+    """Crea o actualiza el vector store persistente para un único texto."""
+    if not text:
+        return None
+    vectordb, _ = sync_rag_store({source: text}, vector_dir, chunk_size, chunk_overlap)
     return vectordb
 
+def get_rag_sources() -> list:
+    """Fuentes del RAG: RAG_SOURCES (separadas por coma o os.pathsep) o el archivo de instrucciones."""
+    raw = os.getenv("RAG_SOURCES", "")
+    sources = [p.strip() for p in raw.replace(os.pathsep, ",").split(",") if p.strip()]
+    return sources or [TXT_FILE]
+
+def get_rag_sync_stats() -> dict:
+    """Resultado de la última sincronización (chunks reutilizados/embebidos/eliminados)."""
+    return dict(_LAST_SYNC_STATS)
+
+def get_rag_store(sources=None, vector_dir=VECTOR_DIR, chunk_size=1000, chunk_overlap=50):
+    """Devuelve el vector store residente; solo se resincroniza si cambia el mtime/tamaño y el hash de alguna fuente."""
+    sources = tuple(sources or get_rag_sources())
+    signature = []
+    for path in sources:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+    signature = tuple(signature)
+    key = (tuple(os.path.abspath(p) for p in sources), vector_dir, chunk_size, chunk_overlap)
+    with _RAG_LOCK:
+        entry = _STORES.get(key)
+        if entry and entry[0] == signature:
+            return entry[2]
+        texts = {path: load_txt(path) for path in sources}
+        content_hash = _get_text_hash("\0".join(f"{p}\0{t}" for p, t in texts.items()))
+        if entry and entry[1] == content_hash:
+            # Cambió el mtime pero no el contenido
+            _STORES[key] = (signature, content_hash, entry[2])
+            return entry[2]
+        store = sync_rag_store(texts, vector_dir, chunk_size, chunk_overlap)[0] if any(texts.values()) else None
+        _STORES[key] = (signature, content_hash, store)
+        return store
+
 def load_rag_store(vector_dir=VECTOR_DIR):
     """Carga el vector store existente si existe."""
-    if OpenAIEmbeddings is None:
-        raise ImportError("OpenAIEmbeddings no está disponible. Revisa la versión de LangChain/langchain-openai.")
-    if not _chroma_store_exists(vector_dir):
+    if not _store_exists(vector_dir):
         return None
-    embeddings = OpenAIEmbeddings()
-    # In some versions constructor signature is different
-    try:
-        vectordb = Chroma(persist_directory=vector_dir, embedding_function=embeddings)
-    except Exception:
-        vectordb = Chroma(persist_directory=vector_dir, embeddings=embeddings)
-    return vectordb
+    return _open_store(vector_dir)
+
+def retrieve_chunks(query, vectordb, top_k=5) -> list:
+    """Recupera los chunks más relevantes para la pregunta, de mayor a menor relevancia."""
+    if not vectordb:
+        return []
+    with span("rag.retrieve", k=top_k) as trace:
+        # similarity_search vs similar_documents naming may vary
+        try:
+            docs = vectordb.similarity_search(query, k=top_k)
+        except Exception:
+            docs = vectordb.similarity_search(query, top_k)
+        trace.set(returned=len(docs))
+    return [getattr(d, "page_content", str(d)) for d in docs]
 
 def retrieve_relevant_chunks(query, vectordb, top_k=5):
     """Recupera los chunks más relevantes para la pregunta."""
-    if not vectordb:
-        return ""
-    # similarity_search vs similar_documents naming may vary
-    try:
-        docs = vectordb.similarity_search(query, k=top_k)
-    except Exception:
-        docs = vectordb.similarity_search(query, top_k)
-    return "\n".join(getattr(d, "page_content", str(d)) for d in docs)
+    return "\n".join(retrieve_chunks(query, vectordb, top_k))
 
 
@@ -0,0 +1,358 @@
+# rollups.py
+"""Rollups por intervalos de tiempo de la tabla de sensores.
+
+Por cada tabla cargada con loader.py se mantienen vistas materializadas con un
+resumen por segundo y por minuto (<tabla>__rollup_1s / <tabla>__rollup_1m):
+conteo, suma, suma de cuadrados, mínimo y máximo por columna, y productos
+cruzados para las correlaciones entre pares de columnas. Con esas sumas se
+reconstruyen exactamente AVG, SUM, COUNT, MIN, MAX, varianzas, desvíos y CORR.
+
+route_query reescribe las consultas agregadas sobre la tabla cruda para que lean
+el rollup más grueso que la granularidad pedida permita.
+
+Uso:
+    python rollups.py [--table llm_sql] [--refresh]
+"""
+import os
+import re
+import logging
+import argparse
+from itertools import combinations
+
+import sqlglot
+from sqlglot import exp
+
+TIME_COLUMN = "ts_ms"
+BUCKET_COLUMN = "bucket"
+# Granularidades en orden creciente: cada una se construye a partir de la anterior
+ROLLUP_GRAINS = {"1s": 1000, "1m": 60000}
+ROLLUP_PAIR_COLUMNS = [c.strip() for c in os.getenv("ROLLUP_PAIR_COLUMNS", "t2,t41_44_avg,w9,gen_tsb").split(",") if c.strip()]
+ROLLUP_ROUTING = os.getenv("ROLLUP_ROUTING", "1") == "1"
+
+NUMERIC_TYPES = {"double precision", "real", "numeric", "integer", "bigint", "smallint"}
+_ROLLUP_RE = re.compile(r"^(?P<table>.+)__rollup_(?P<grain>\w+)$")
+_PAIR_RE = re.compile(r"^(?P<a>.+)__(?P<b>.+)_sab$")
+
+
+def rollup_name(table: str, grain: str) -> str:
+    return f"{table}__rollup_{grain}"
+
+
+def rollup_columns(columns: list) -> list:
+    """Columnas numéricas que se resumen: (columna, tipo) -> nombres, sin ts_ms."""
+    return [c for c, t in columns if t in NUMERIC_TYPES and c != TIME_COLUMN]
+
+
+def rollup_pairs(columns: list) -> list:
+    """Pares de columnas con productos cruzados (para CORR)."""
+    chosen = [c for c in ROLLUP_PAIR_COLUMNS if c in columns]
+    return list(combinations(chosen, 2))
+
+
+# ===================== DEFINICIÓN DE LOS ROLLUPS ======================
+
+def _base_select(table: str, columns: list, pairs: list, width: int) -> str:
+    """Rollup más fino, agregado directamente desde la tabla cruda."""
+    parts = [f'("{TIME_COLUMN}" / {width}) * {width} AS {BUCKET_COLUMN}', "count(*)::bigint AS n"]
+    for c in columns:
+        parts += [
+            f'count("{c}")::bigint AS "{c}_n"',
+            f'sum("{c}") AS "{c}_sum"',
+            f'sum("{c}" * "{c}") AS "{c}_sumsq"',
+            f'min("{c}") AS "{c}_min"',
+            f'max("{c}") AS "{c}_max"',
+        ]
+    for a, b in pairs:
+        both = f'"{a}" IS NOT NULL AND "{b}" IS NOT NULL'
+        parts += [
+            f'(count(*) FILTER (WHERE {both}))::bigint AS "{a}__{b}_n"',
+            f'sum("{a}") FILTER (WHERE {both}) AS "{a}__{b}_sa"',
+            f'sum("{b}") FILTER (WHERE {both}) AS "{a}__{b}_sb"',
+            f'sum("{a}" * "{a}") FILTER (WHERE {both}) AS "{a}__{b}_saa"',
+            f'sum("{b}" * "{b}") FILTER (WHERE {both}) AS "{a}__{b}_sbb"',
+            f'sum("{a}" * "{b}") AS "{a}__{b}_sab"',
+        ]
+    return f'SELECT {", ".join(parts)} FROM "{table}" GROUP BY 1'
+
+
+def _coarser_select(source: str, columns: list, pairs: list, width: int) -> str:
+    """Rollup más grueso, re-agregado desde el rollup anterior (mucho menos filas que la tabla cruda)."""
+    parts = [f"({BUCKET_COLUMN} / {width}) * {width} AS {BUCKET_COLUMN}", "sum(n)::bigint AS n"]
+    for c in columns:
+        parts += [
+            f'sum("{c}_n")::bigint AS "{c}_n"',
+            f'sum("{c}_sum") AS "{c}_sum"',
+            f'sum("{c}_sumsq") AS "{c}_sumsq"',
+            f'min("{c}_min") AS "{c}_min"',
+            f'max("{c}_max") AS "{c}_max"',
+        ]
+    for a, b in pairs:
+        p = f"{a}__{b}"
+        parts.append(f'sum("{p}_n")::bigint AS "{p}_n"')
+        parts += [f'sum("{p}_{s}") AS "{p}_{s}"' for s in ("sa", "sb", "saa", "sbb", "sab")]
+    return f'SELECT {", ".join(parts)} FROM "{source}" GROUP BY 1'
+
+
+def rollup_statements(table: str, columns: list) -> list:
+    """DDL que (re)crea los rollups de `table`. `columns` son los nombres de las columnas numéricas."""
+    pairs = rollup_pairs(columns)
+    statements, previous = [], None
+    for grain, width in ROLLUP_GRAINS.items():
+        name = rollup_name(table, grain)
+        select = _base_select(table, columns, pairs, width) if previous is None else _coarser_select(previous, columns, pairs, width)
+        statements += [
+            f'DROP MATERIALIZED VIEW IF EXISTS "{name}" CASCADE',
+            f'CREATE MATERIALIZED VIEW "{name}" AS {select}',
+            # Índice único: permite REFRESH ... CONCURRENTLY y filtrar por rango de tiempo
+            f'CREATE UNIQUE INDEX "{name}_bucket" ON "{name}" ({BUCKET_COLUMN})',
+        ]
+        previous = name
+    return statements
+
+
+def _table_columns(conn, table: str) -> list:
+    from sqlalchemy import text
+    rows = conn.execute(text(
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name = :t ORDER BY ordinal_position"
+    ), {"t": table})
+    return [(c, t) for c, t in rows]
+
+
+def build_rollups(engine, table: str):
+    """Crea (o recrea) los rollups de `table` en una sola transacción."""
+    from sqlalchemy import text
+    with engine.begin() as conn:
+        columns = _table_columns(conn, table)
+        if TIME_COLUMN not in [c for c, _ in columns]:
+            raise ValueError(f"La tabla {table} no tiene la columna {TIME_COLUMN}; cárgala con loader.py")
+        for stmt in rollup_statements(table, rollup_columns(columns)):
+            conn.execute(text(stmt))
+    analyze_rollups(engine, table)
+
+
+def refresh_rollups(engine, table: str):
+    """Refresca los rollups existentes (del más fino al más grueso) sin bloquear lecturas."""
+    from sqlalchemy import text
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for grain in ROLLUP_GRAINS:
+            conn.execute(text(f'REFRESH MATERIALIZED VIEW CONCURRENTLY "{rollup_name(table, grain)}"'))
+    analyze_rollups(engine, table)
+
+
+def analyze_rollups(engine, table: str):
+    from sqlalchemy import text
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for grain in ROLLUP_GRAINS:
+            conn.execute(text(f'ANALYZE "{rollup_name(table, grain)}"'))
+
+
+# ===================== DESCRIPCIÓN PARA EL PROMPT ======================
+
+def catalog_rollups(catalog) -> dict:
+    """{tabla cruda: {grano: (vista, columnas resumidas, pares)}} a partir del catálogo."""
+    found = {}
+    for view, cols in (getattr(catalog, "views", None) or {}).items():
+        m = _ROLLUP_RE.match(view)
+        if not m or m.group("grain") not in ROLLUP_GRAINS or m.group("table") not in catalog.tables:
+            continue
+        names = [c for c, _ in cols]
+        summarized = [c[:-4] for c in names if c.endswith("_sum") and f"{c[:-4]}_sumsq" in names]
+        pairs = [(p.group("a"), p.group("b")) for p in map(_PAIR_RE.match, names) if p]
+        found.setdefault(m.group("table"), {})[m.group("grain")] = (view, summarized, pairs)
+    return found
+
+
+def rollups_prompt_text(catalog) -> str:
+    """Texto que presenta los rollups al modelo (vacío si no hay)."""
+    lines = []
+    for table, grains in sorted(catalog_rollups(catalog).items()):
+        any_view = next(iter(grains.values()))
+        _, summarized, pairs = any_view
+        lines.append(f"Tablas de resumen precalculadas de {table} (leen miles de veces menos filas; úsalas siempre que la granularidad lo permita):")
+        for grain, (view, _, _) in sorted(grains.items(), key=lambda g: ROLLUP_GRAINS[g[0]]):
+            lines.append(f"  - {view}: una fila cada {ROLLUP_GRAINS[grain]} ms; {BUCKET_COLUMN} = ts_ms del inicio del intervalo.")
+        lines.append(f"  Columnas: {BUCKET_COLUMN}, n (filas crudas del intervalo) y, por cada columna c de ({', '.join(summarized)}): c_n, c_sum, c_sumsq, c_min, c_max.")
+        if pairs:
+            lines.append(f"  Pares para correlación (p = a__b): {', '.join(f'{a}__{b}' for a, b in pairs)}, con p_n, p_sa, p_sb, p_saa, p_sbb, p_sab.")
+        lines.append("  Fórmulas: promedio = SUM(c_sum) / SUM(c_n); mínimo = MIN(c_min); máximo = MAX(c_max);")
+        lines.append("  varianza = (SUM(c_sumsq) - SUM(c_sum)^2 / SUM(c_n)) / (SUM(c_n) - 1);")
+        lines.append("  CORR = (n*sab - sa*sb) / SQRT((n*saa - sa^2) * (n*sbb - sb^2)) con las sumas del par.")
+        lines.append("  Agrupa por bucket / K (K múltiplo del intervalo) para series por segundo, minuto u hora.")
+    return "\n".join(lines)
+
+
+# ===================== RUTEO DE CONSULTAS ======================
+# Una consulta sobre la tabla cruda se reescribe al rollup si solo usa agregados
+# reconstruibles sobre columnas resumidas y ts_ms aparece únicamente como
+# `ts_ms / K` (K múltiplo del intervalo) o en filtros `>=` / `<` alineados.
+
+_AGG_NAMES = {
+    exp.Count: "count", exp.Sum: "sum", exp.Avg: "avg", exp.Min: "min", exp.Max: "max",
+    exp.Stddev: "stddev", exp.StddevSamp: "stddev_samp", exp.StddevPop: "stddev_pop",
+    exp.Variance: "variance", exp.VariancePop: "var_pop", exp.Corr: "corr",
+}
+
+
+class _NotRoutable(Exception):
+    pass
+
+
+def _col(name: str) -> str:
+    return f'"{name}"'
+
+
+def _variance(c: str, pop: bool) -> str:
+    n, s, ss = f"SUM({_col(c + '_n')})", f"SUM({_col(c + '_sum')})", f"SUM({_col(c + '_sumsq')})"
+    denom = n if pop else f"({n} - 1)"
+    return f"GREATEST(({ss} - {s} * {s} / NULLIF({n}, 0)) / NULLIF({denom}, 0), 0)"
+
+
+def _agg_sql(node, summarized: set, pairs: set) -> str:
+    """SQL equivalente sobre el rollup para un agregado de la consulta original."""
+    kind = type(node)
+    if kind not in _AGG_NAMES or node.args.get("distinct") or isinstance(node.this, exp.Distinct):
+        raise _NotRoutable("agregado no soportado")
+    arg = node.this
+    if kind is exp.Count and isinstance(arg, exp.Star):
+        return "SUM(n)"
+    if not isinstance(arg, exp.Column) or arg.name not in summarized:
+        raise _NotRoutable("argumento no resumido")
+    c = arg.name
+    if kind is exp.Corr:
+        other = node.expression
+        if not isinstance(other, exp.Column):
+            raise _NotRoutable("argumento no resumido")
+        if (c, other.name) in pairs:
+            a, b = c, other.name
+        elif (other.name, c) in pairs:
+            a, b = other.name, c
+        else:
+            raise _NotRoutable("par sin productos cruzados")
+        p = lambda s: f"SUM({_col(f'{a}__{b}_{s}')})"
+        n, sa, sb = p("n"), p("sa"), p("sb")
+        num = f"({n} * {p('sab')} - {sa} * {sb})"
+        den = f"SQRT(GREATEST(({n} * {p('saa')} - {sa} * {sa}) * ({n} * {p('sbb')} - {sb} * {sb}), 0))"
+        return f"{num} / NULLIF({den}, 0)"
+    if kind is exp.Count:
+        return f"SUM({_col(c + '_n')})"
+    if kind is exp.Sum:
+        return f"SUM({_col(c + '_sum')})"
+    if kind is exp.Avg:
+        return f"SUM({_col(c + '_sum')}) / NULLIF(SUM({_col(c + '_n')}), 0)"
+    if kind is exp.Min:
+        return f"MIN({_col(c + '_min')})"
+    if kind is exp.Max:
+        return f"MAX({_col(c + '_max')})"
+    if kind in (exp.Variance, exp.VariancePop):
+        return _variance(c, kind is exp.VariancePop)
+    return f"SQRT({_variance(c, kind is exp.StddevPop)})"
+
+
+def _int_literal(node):
+    if isinstance(node, exp.Literal) and not node.is_string and re.fullmatch(r"\d+", node.this):
+        return int(node.this)
+    return None
+
+
+def _rewrite_time(column, width: int):
+    """Reescribe un uso de ts_ms fuera de agregados; falla si no está alineado al intervalo."""
+    parent = column.parent
+    if isinstance(parent, (exp.Div, exp.IntDiv)) and parent.this is column:
+        k = _int_literal(parent.expression)
+        if k and k % width == 0:
+            return
+    elif isinstance(parent, (exp.GTE, exp.LT)) and parent.this is column:
+        k = _int_literal(parent.expression)
+        if k is not None and k % width == 0:
+            return
+    raise _NotRoutable("uso de ts_ms no alineado al intervalo")
+
+
+def _is_alias_ref(column, aliases: set, source_columns: set) -> bool:
+    """Referencia a un alias del SELECT: solo en GROUP BY/ORDER BY/HAVING y si no es una columna real."""
+    return (column.name in aliases and column.name not in source_columns and not column.table
+            and column.find_ancestor(exp.Group, exp.Order, exp.Having) is not None)
+
+
+def _route_to(tree, view: str, width: int, summarized: set, pairs: set, source_columns: set):
+    select = tree.copy()
+    aliases = {e.alias for e in select.expressions if e.alias}
+    aggs = list(select.find_all(*_AGG_NAMES))
+    for agg in aggs:
+        if agg.find_ancestor(exp.Window, exp.Filter, *_AGG_NAMES) is not None:
+            raise _NotRoutable("agregado anidado, con ventana o con filtro")
+    for column in list(select.find_all(exp.Column)):
+        if column.find_ancestor(*_AGG_NAMES) is not None:
+            continue
+        if column.name == TIME_COLUMN:
+            _rewrite_time(column, width)
+            column.replace(exp.column(BUCKET_COLUMN))
+        elif not _is_alias_ref(column, aliases, source_columns):
+            raise _NotRoutable(f"columna {column.name} fuera de un agregado")
+    for agg in aggs:
+        new = sqlglot.parse_one(_agg_sql(agg, summarized, pairs), read="postgres")
+        if agg.parent is select and agg.arg_key == "expressions":
+            new = exp.alias_(new, _AGG_NAMES[type(agg)])
+        agg.replace(new)
+    select.find(exp.Table).replace(exp.to_table(f'"{view}"', dialect="postgres"))
+    return select
+
+
+def route_query(query: str, catalog) -> str:
+    """Devuelve la consulta reescrita sobre el rollup más grueso posible, o la original."""
+    if not ROLLUP_ROUTING or catalog is None:
+        return query
+    rollups = catalog_rollups(catalog)
+    if not rollups:
+        return query
+    try:
+        statements = sqlglot.parse(query, read="postgres")
+    except sqlglot.errors.ParseError:
+        return query
+    if len([s for s in statements if s is not None]) != 1 or not isinstance(statements[0], exp.Select):
+        return query
+    tree = statements[0]
+    tables = list(tree.find_all(exp.Table))
+    if (len(tables) != 1 or tables[0].name not in rollups or tree.args.get("joins") or tree.args.get("with")
+            or tree.args.get("distinct") or tree.find(exp.Subquery, exp.Window) or not tree.find(*_AGG_NAMES)
+            or any(not isinstance(s.parent, exp.Count) for s in tree.find_all(exp.Star))):
+        return query
+    table = tables[0].name
+    source_columns = {c for c, _ in catalog.tables[table]}
+    for grain, width in sorted(ROLLUP_GRAINS.items(), key=lambda g: -g[1]):
+        if grain not in rollups[table]:
+            continue
+        view, summarized, pairs = rollups[table][grain]
+        try:
+            routed = _route_to(tree, view, width, set(summarized), set(pairs), source_columns)
+        except _NotRoutable as e:
+            logging.debug(f"rollups: no se usa {view}: {e}")
+            continue
+        sql = routed.sql(dialect="postgres") + ";"
+        logging.info(f"rollups: consulta ruteada a {view}: {sql}")
+        return sql
+    return query
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crea o refresca los rollups por segundo y por minuto.")
+    parser.add_argument("--table", default="llm_sql")
+    parser.add_argument("--refresh", action="store_true", help="Refresca los rollups existentes en lugar de recrearlos")
+    args = parser.parse_args()
+
+    from backend import get_engine, bump_data_version, invalidate_schema_catalog
+    engine = get_engine()
+    if engine is None:
+        raise SystemExit("Configura POSTGRES_USER, POSTGRES_PASSWORD y POSTGRES_DB para crear los rollups.")
+    if args.refresh:
+        refresh_rollups(engine, args.table)
+    else:
+        build_rollups(engine, args.table)
+    invalidate_schema_catalog(engine)
+    bump_data_version()
+    print(f"Rollups de {args.table} listos: {', '.join(rollup_name(args.table, g) for g in ROLLUP_GRAINS)}")
+
+
+if __name__ == "__main__":
+    main()
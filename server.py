@@ -0,0 +1,307 @@
+# server.py
+"""Servicio HTTP/WebSocket (ASGI) con el mismo flujo decisión -> SQL -> respuesta que la app.
+
+Cada proceso comparte entre todas las peticiones el engine con pool, el catálogo de
+esquema cacheado y el vector store RAG; los turnos corren en el event loop del
+servidor y las consultas SQL en el pool de hilos de backend. Cada tenant declarado
+en TENANT_LIMITS (cabecera TENANT_HEADER) tiene su propio límite de turnos
+concurrentes; la cabecera no se autentica, así que cualquier otro valor comparte el
+límite del tenant "default".
+
+Endpoints:
+    POST /chat        {"question", "history": [...], "stream": true} -> eventos NDJSON
+                      (los mismos dicts que pipeline.astream_turn); con "stream": false
+                      devuelve {"answer", "tokens", "events"} al terminar.
+    WS   /chat/ws     un mensaje JSON por pregunta; responde con los eventos del turno.
+    GET  /healthz     proceso vivo.
+    GET  /readyz      503 mientras drena (el balanceador deja de enviarle tráfico).
+    POST /drain       entra en modo drenaje: rechaza turnos nuevos y termina los que están en curso.
+    GET  /metrics     métricas de tracing.py en formato de texto de Prometheus.
+
+Uso:
+    python server.py [--host 0.0.0.0] [--port 8000] [--workers 4]
+    uvicorn server:app --workers 4 --timeout-graceful-shutdown 30
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+from contextlib import aclosing, asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from backend import get_engine, get_schema_catalog, setup_logging
+from rag import get_rag_store
+from pipeline import astream_turn
+from tracing import prometheus_text, start_span
+
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+SERVER_ADMIN_TOKEN = os.getenv("SERVER_ADMIN_TOKEN", "")  # sin token, /drain solo acepta loopback
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant-ID")
+TENANT_MAX_CONCURRENCY = int(os.getenv("TENANT_MAX_CONCURRENCY", "4"))
+TENANT_LIMITS = os.getenv("TENANT_LIMITS", "")  # "bi=8,batch=1": límites propios por tenant
+DEFAULT_TENANT = "default"
+TENANT_QUEUE_TIMEOUT_S = float(os.getenv("TENANT_QUEUE_TIMEOUT_S", "10"))  # espera máxima por un lugar
+DRAIN_TIMEOUT_S = float(os.getenv("DRAIN_TIMEOUT_S", "30"))
+MAX_HISTORY = int(os.getenv("SERVER_MAX_HISTORY", "10"))
+
+
+# ===================== LÍMITES POR TENANT ======================
+
+def parse_tenant_limits(text: str) -> dict:
+    """'bi=8,batch=1' -> {"bi": 8, "batch": 1}."""
+    limits = {}
+    for item in text.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            limits[name.strip()] = int(value)
+    return limits
+
+
+class TenantLimiter:
+    """Un semáforo por tenant: como máximo `limit` turnos en curso cada uno.
+
+    Solo los tenants de `limits` tienen semáforo propio; el resto se cuenta como
+    DEFAULT_TENANT, así que la cantidad de semáforos (y de turnos) queda acotada.
+    """
+
+    def __init__(self, default_limit: int = TENANT_MAX_CONCURRENCY, limits: dict = None):
+        self._default = default_limit
+        self._limits = dict(limits or {})
+        self._semaphores = {}
+        self._active = {}
+        self._rejected = {}
+
+    def resolve(self, tenant: str) -> str:
+        """Tenant con el que se cuenta la petición: el declarado o DEFAULT_TENANT."""
+        return tenant if tenant in self._limits else DEFAULT_TENANT
+
+    def limit(self, tenant: str) -> int:
+        return self._limits.get(tenant, self._default)
+
+    async def acquire(self, tenant: str, timeout: float = TENANT_QUEUE_TIMEOUT_S) -> bool:
+        """Espera un lugar hasta `timeout` segundos; False si el tenant sigue saturado."""
+        sem = self._semaphores.get(tenant)
+        if sem is None:
+            sem = self._semaphores[tenant] = asyncio.Semaphore(self.limit(tenant))
+        try:
+            await asyncio.wait_for(sem.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self._rejected[tenant] = self._rejected.get(tenant, 0) + 1
+            return False
+        self._active[tenant] = self._active.get(tenant, 0) + 1
+        return True
+
+    def release(self, tenant: str):
+        self._active[tenant] -= 1
+        self._semaphores[tenant].release()
+
+    @property
+    def active(self) -> int:
+        return sum(self._active.values())
+
+    def snapshot(self) -> dict:
+        return {
+            t: {"active": self._active.get(t, 0), "limit": self.limit(t), "rejected": self._rejected.get(t, 0)}
+            for t in sorted(set(self._semaphores) | set(self._rejected))
+        }
+
+
+# ===================== ESTADO COMPARTIDO ======================
+
+class _State:
+    engine = None
+    vectordb = None
+    draining = False
+    limiter = TenantLimiter(TENANT_MAX_CONCURRENCY, parse_tenant_limits(TENANT_LIMITS))
+
+
+state = _State()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Abre engine, catálogo y RAG una vez por proceso; al apagar, espera los turnos en curso."""
+    setup_logging()
+    state.engine = get_engine()
+    if state.engine is not None:
+        try:
+            await asyncio.to_thread(get_schema_catalog, state.engine)
+        except Exception:
+            logging.exception("server: no se pudo precargar el catálogo de esquema")
+    try:
+        state.vectordb = await asyncio.to_thread(get_rag_store, chunk_size=1000, chunk_overlap=50)
+    except Exception:
+        logging.exception("server: no se pudo abrir el vector store; se sigue sin RAG")
+    logging.info(f"server: listo (pid {os.getpid()})")
+    yield
+    await drain(DRAIN_TIMEOUT_S)
+
+
+async def drain(timeout: float) -> int:
+    """Deja de aceptar turnos y espera hasta `timeout` s a los que están en curso; devuelve los que quedaron."""
+    state.draining = True
+    deadline = time.monotonic() + timeout
+    while state.limiter.active and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if state.limiter.active:
+        logging.warning(f"server: drenaje incompleto, {state.limiter.active} turnos en curso")
+    return state.limiter.active
+
+
+# ===================== TURNOS ======================
+
+def _parse_request(payload) -> tuple:
+    """(question, history) del cuerpo de la petición; ValueError si no es válido."""
+    if not isinstance(payload, dict):
+        raise ValueError("El cuerpo debe ser un objeto JSON.")
+    question = payload.get("question")
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError("Falta \"question\" (texto no vacío).")
+    history = payload.get("history") or []
+    if not isinstance(history, list) or not all(
+        isinstance(m, dict) and m.get("role") in ("user", "assistant") and isinstance(m.get("content"), str) for m in history
+    ):
+        raise ValueError("\"history\" debe ser una lista de {\"role\": \"user\"|\"assistant\", \"content\": str}.")
+    return question, history[-MAX_HISTORY:]
+
+
+async def _turn_events(tenant: str, question: str, history: list):
+    """Eventos del turno; el lugar del tenant ya fue tomado y se libera al terminar (o si el cliente corta)."""
+    trace = start_span("server.turn", tenant=tenant)
+    error = None
+    try:
+        async with aclosing(astream_turn(state.engine, state.vectordb, question, history, trace_parent=trace)) as events:
+            async for event in events:
+                yield event
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            error = e
+        raise
+    finally:
+        state.limiter.release(tenant)
+        trace.end(error=error)
+
+
+def _busy_response(tenant: str):
+    if state.draining:
+        return JSONResponse({"error": "El servidor está drenando; reintentar en otra instancia."},
+                            status_code=503, headers={"Retry-After": "1"})
+    return JSONResponse({"error": f"Demasiadas consultas en curso para el tenant {tenant}.",
+                         "limit": state.limiter.limit(tenant)}, status_code=429, headers={"Retry-After": "1"})
+
+
+async def chat(request: Request):
+    tenant = state.limiter.resolve(request.headers.get(TENANT_HEADER, DEFAULT_TENANT))
+    try:
+        payload = await request.json()
+        question, history = _parse_request(payload)
+    except (ValueError, json.JSONDecodeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    if state.draining or not await state.limiter.acquire(tenant):
+        return _busy_response(tenant)
+    events = _turn_events(tenant, question, history)
+    # Se arranca el generador acá: si el cliente corta antes de leer la respuesta,
+    # su finally (que libera el lugar del tenant) igual corre al cerrarlo.
+    # Un turno sin eventos ya terminó (y liberó el lugar): first queda en None
+    first = await anext(events, None)
+    leading = [first] if first is not None else []
+
+    if not payload.get("stream", True):
+        collected = leading + [event async for event in events]
+        done = next((e for e in reversed(collected) if e["type"] == "done"), {})
+        return JSONResponse({"answer": done.get("answer", ""), "tokens": done.get("tokens", 0), "events": collected})
+
+    async def body():
+        async with aclosing(events):
+            for event in leading:
+                yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+            async for event in events:
+                yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+async def chat_ws(websocket: WebSocket):
+    tenant = state.limiter.resolve(websocket.headers.get(TENANT_HEADER) or websocket.query_params.get("tenant", DEFAULT_TENANT))
+    await websocket.accept()
+    try:
+        while not state.draining:
+            try:
+                question, history = _parse_request(await websocket.receive_json())
+            except (ValueError, json.JSONDecodeError) as e:
+                await websocket.send_json({"type": "error", "error": str(e)})
+                continue
+            if not await state.limiter.acquire(tenant):
+                await websocket.send_json({"type": "error", "error": f"Demasiadas consultas en curso para el tenant {tenant}."})
+                continue
+            async with aclosing(_turn_events(tenant, question, history)) as events:
+                async for event in events:
+                    await websocket.send_text(json.dumps(event, ensure_ascii=False, default=str))
+        # 1012: el servicio se reinicia, el cliente debe reconectarse a otra instancia
+        await websocket.close(code=1012)
+    except WebSocketDisconnect:
+        pass
+
+
+# ===================== SALUD, DRENAJE Y MÉTRICAS ======================
+
+async def healthz(request: Request):
+    return JSONResponse({"status": "ok", "pid": os.getpid()})
+
+
+async def readyz(request: Request):
+    body = {"ready": not state.draining, "active": state.limiter.active, "tenants": state.limiter.snapshot()}
+    return JSONResponse(body, status_code=503 if state.draining else 200)
+
+
+async def drain_endpoint(request: Request):
+    token = request.headers.get("X-Admin-Token", "")
+    allowed = token == SERVER_ADMIN_TOKEN if SERVER_ADMIN_TOKEN else request.client.host in ("127.0.0.1", "::1")
+    if not allowed:
+        return JSONResponse({"error": "No autorizado."}, status_code=403)
+    state.draining = True
+    # El drenaje sigue en segundo plano: /readyz ya responde 503
+    asyncio.get_running_loop().create_task(drain(DRAIN_TIMEOUT_S))
+    return JSONResponse({"draining": True, "active": state.limiter.active})
+
+
+async def metrics(request: Request):
+    return PlainTextResponse(prometheus_text(), media_type="text/plain; version=0.0.4")
+
+
+app = Starlette(
+    routes=[
+        Route("/chat", chat, methods=["POST"]),
+        WebSocketRoute("/chat/ws", chat_ws),
+        Route("/healthz", healthz),
+        Route("/readyz", readyz),
+        Route("/drain", drain_endpoint, methods=["POST"]),
+        Route("/metrics", metrics),
+    ],
+    lifespan=lifespan,
+)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Servicio HTTP/WebSocket del chat con la base de datos.")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    args = parser.parse_args()
+    uvicorn.run("server:app", host=args.host, port=args.port, workers=args.workers,
+                timeout_graceful_shutdown=int(DRAIN_TIMEOUT_S))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# sql_cache.py
+"""Biblioteca de pares pregunta -> SQL verificado, para saltear la llamada de decisión.
+
+Cada turno cuyas consultas corrieron sin error agrega su pregunta y su SQL. Una
+pregunta nueva se compara primero por texto normalizado (minúsculas, sin acentos
+ni signos) y después por similitud coseno de su embedding (el mismo cliente
+memorizado que usa RAG, así que no hay llamada extra). Si supera SQL_CACHE_THRESHOLD
+se reutiliza el SQL sin llamar al LLM. Las entradas quedan atadas a la huella del
+esquema: si el esquema cambia, vencen. Al superar SQL_CACHE_SIZE se descarta la
+menos usada recientemente.
+
+Una coincidencia por embedding solo se acepta si la pregunta nombra exactamente los
+mismos literales que la guardada: números, fechas (meses, días, "ayer", "hora"...)
+y columnas del catálogo. "promedio de t2 en enero" y "promedio de t2 en marzo" se
+parecen mucho pero no comparten SQL.
+
+Las preguntas que dependen del historial ("¿y el máximo?", "lo mismo para w9") no
+se guardan ni se buscan: su SQL depende del turno anterior.
+"""
+import os
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from rag import get_embeddings
+from tracing import register_metric
+
+SQL_CACHE_ENABLED = os.getenv("SQL_CACHE", "1").lower() not in ("0", "false", "no")
+SQL_CACHE_SIZE = int(os.getenv("SQL_CACHE_SIZE", "512"))
+SQL_CACHE_THRESHOLD = float(os.getenv("SQL_CACHE_THRESHOLD", "0.93"))  # similitud coseno mínima
+SQL_CACHE_EMBED_RETRY_S = float(os.getenv("SQL_CACHE_EMBED_RETRY_S", "60"))  # pausa tras un fallo de embeddings
+
+_FOLLOWUP_START = re.compile(r"^(y|e|pero|entonces|tambien|ahora|idem|lo mismo|y si|que tal|and|what about)\b")
+_FOLLOWUP_WORDS = re.compile(r"\b(eso|esos|esas|ese|esa|esto|anterior|mismo|misma|mismos|mismas|ultimo resultado)\b")
+_NUMBER = re.compile(r"\b\d+(?:[.,]\d+)?\b")
+_DATE_WORD = re.compile(
+    r"\b(enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|setiembre|octubre|noviembre|diciembre"
+    r"|lunes|martes|miercoles|jueves|viernes|sabado|domingo|hoy|ayer|anteayer|manana|tarde|noche"
+    r"|segundo|minuto|hora|dia|semana|mes|ano|trimestre)(?:e?s)?\b"
+)
+
+
+def normalize_question(question: str) -> str:
+    """Minúsculas, sin acentos, sin signos y con espacios simples."""
+    text = unicodedata.normalize("NFKD", question.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", text)).strip()
+
+
+def question_literals(question: str, columns=()) -> frozenset:
+    """Números, palabras de fecha (en singular) y columnas de `columns` que nombra la pregunta."""
+    norm = normalize_question(question)
+    names = {c.lower() for c in columns}
+    found = {n.replace(",", ".") for n in _NUMBER.findall(norm)}
+    found |= {f"@{w}" for w in _DATE_WORD.findall(norm)}
+    found |= {f"#{w}" for w in norm.split() if w in names}
+    return frozenset(found)
+
+
+def catalog_columns(catalog) -> set:
+    """Nombres de columna de las tablas y vistas del catálogo."""
+    sources = (catalog.tables, getattr(catalog, "views", None) or {})
+    return {c for source in sources for cols in source.values() for c, _ in cols}
+
+
+def is_standalone(question: str) -> bool:
+    """False para preguntas que continúan el turno anterior y no se entienden solas."""
+    norm = normalize_question(question)
+    return len(norm.split()) >= 3 and not _FOLLOWUP_START.search(norm) and not _FOLLOWUP_WORDS.search(norm)
+
+
+class SemanticSQLCache:
+    """Caché LRU de {pregunta normalizada: SQL}, con búsqueda exacta y por embedding."""
+
+    def __init__(self, maxsize: int = SQL_CACHE_SIZE, threshold: float = SQL_CACHE_THRESHOLD, embed=None):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._embed = embed
+        self._lock = threading.Lock()
+        # pregunta normalizada -> {"question", "queries", "template", "vector", "literals", "fingerprint", "hits"}
+        self._entries = OrderedDict()
+        self._embed_retry_at = 0.0  # monotonic: hasta entonces no se piden embeddings
+        self.lookups = self.exact_hits = self.semantic_hits = self.evictions = self.expired = self.embed_failures = 0
+
+    def _vector(self, question: str):
+        """Embedding normalizado (norma 1) o None si no hay cliente de embeddings disponible.
+
+        Tras un fallo (red, rate limit) solo se usan coincidencias exactas durante
+        SQL_CACHE_EMBED_RETRY_S segundos; después se vuelve a intentar.
+        """
+        if time.monotonic() < self._embed_retry_at:
+            return None
+        try:
+            embed = self._embed or get_embeddings().embed_query
+            vector = np.asarray(embed(question), dtype=np.float32)
+        except Exception:
+            logging.exception(f"sql_cache: fallaron los embeddings; solo coincidencias exactas por "
+                              f"{SQL_CACHE_EMBED_RETRY_S:.0f} s")
+            self._embed_retry_at = time.monotonic() + SQL_CACHE_EMBED_RETRY_S
+            self.embed_failures += 1
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _expire(self, fingerprint: str):
+        stale = [k for k, e in self._entries.items() if e["fingerprint"] != fingerprint]
+        for key in stale:
+            del self._entries[key]
+        self.expired += len(stale)
+
+    def lookup(self, question: str, fingerprint: str, columns=()):
+        """{"question", "queries", "template", "similarity", "exact"} de la entrada más parecida, o None.
+
+        Por embedding solo compiten las entradas con los mismos question_literals
+        (calculados con las columnas `columns` del catálogo).
+        """
+        if not is_standalone(question):
+            return None
+        key = normalize_question(question)
+        with self._lock:
+            self.lookups += 1
+            self._expire(fingerprint)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry["hits"] += 1
+                self.exact_hits += 1
+                return {"question": entry["question"], "queries": list(entry["queries"]), "template": entry["template"],
+                        "similarity": 1.0, "exact": True}
+            literals = question_literals(question, columns)
+            candidates = [(k, e) for k, e in self._entries.items()
+                          if e["vector"] is not None and e["literals"] == literals]
+        if not candidates:
+            return None
+        vector = self._vector(question)
+        if vector is None:
+            return None
+        sims = np.stack([e["vector"] for _, e in candidates]) @ vector
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+        key, entry = candidates[best]
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            entry["hits"] += 1
+            self.semantic_hits += 1
+        return {"question": entry["question"], "queries": list(entry["queries"]), "template": entry["template"],
+                "similarity": round(float(sims[best]), 4), "exact": False}
+
+    def store(self, question: str, queries: list, fingerprint: str, template: str = "", columns=()):
+        """Guarda el SQL verificado de una pregunta autocontenida (y su plantilla de respuesta, si hay)."""
+        if not queries or not is_standalone(question):
+            return
+        key = normalize_question(question)
+        vector = self._vector(question)
+        with self._lock:
+            self._entries[key] = {"question": question, "queries": list(queries), "template": template or "",
+                                  "vector": vector, "literals": question_literals(question, columns),
+                                  "fingerprint": fingerprint, "hits": 0}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, question: str):
+        """Quita una entrada cuyo SQL dejó de funcionar."""
+        with self._lock:
+            self._entries.pop(normalize_question(question), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "threshold": self.threshold,
+                "lookups": self.lookups,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "hit_rate": round(hits / self.lookups, 4) if self.lookups else 0.0,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "embed_failures": self.embed_failures,
+                "embed_paused": time.monotonic() < self._embed_retry_at,
+            }
+
+
+sql_cache = SemanticSQLCache()
+
+register_metric("llm_sql_sql_cache_lookups_total", "counter", "Búsquedas en la caché pregunta -> SQL por resultado.",
+                lambda: {"exact_hit": sql_cache.exact_hits, "semantic_hit": sql_cache.semantic_hits,
+                         "miss": sql_cache.lookups - sql_cache.exact_hits - sql_cache.semantic_hits}, label="result")
+register_metric("llm_sql_sql_cache_hit_rate", "gauge", "Fracción de preguntas resueltas sin la llamada de decisión.",
+                lambda: sql_cache.stats()["hit_rate"])
+register_metric("llm_sql_sql_cache_embed_failures_total", "counter",
+                "Fallos de embeddings de la caché pregunta -> SQL (cada uno pausa la búsqueda semántica).",
+                lambda: sql_cache.embed_failures)
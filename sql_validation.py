@@ -0,0 +1,259 @@
+# sql_validation.py
+"""Validación local del SQL generado, antes de cualquier viaje a la base.
+
+Cada consulta se parsea con sqlglot (dialecto PostgreSQL) y se revisa contra el
+catálogo de esquema cacheado: cantidad y tipo de sentencias (solo lectura),
+tablas, columnas (con la misma regla de mayúsculas/comillas que Postgres),
+funciones y comas sobrantes. Los errores son precisos (línea, columna y
+sugerencias) para devolvérselos al modelo en el bucle de reparación.
+"""
+import re
+import difflib
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError, TokenError
+from sqlglot.optimizer.scope import traverse_scope
+from sqlglot.tokens import TokenType
+
+DIALECT = "postgres"
+_DIALECT = sqlglot.Dialect.get_or_raise(DIALECT)
+
+# Sentencias/cláusulas que escriben, bloquean o cambian el estado de la sesión
+_WRITE_NODES = (
+    exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop, exp.Alter,
+    exp.TruncateTable, exp.Copy, exp.Grant, exp.Revoke, exp.Set, exp.Command, exp.Into,
+    exp.Lock, exp.Transaction, exp.Commit, exp.Rollback, exp.Analyze, exp.Comment,
+)
+
+# Funciones sin clase propia en sqlglot (llegan como exp.Anonymous) que se permiten.
+# Las que sqlglot reconoce (AVG, CORR, LAG, DATE_TRUNC, ...) se aceptan siempre.
+ALLOWED_FUNCTIONS = {
+    "abs", "age", "array_length", "cardinality", "cbrt", "ceil", "ceiling", "cos", "cot", "degrees",
+    "div", "every", "exp", "factorial", "floor", "gcd", "isfinite", "json_agg", "json_build_object",
+    "jsonb_agg", "jsonb_build_object", "justify_interval", "lcm", "ln", "log", "log10", "make_interval",
+    "min_scale", "num_nulls", "num_nonnulls", "pi", "radians", "regr_avgx", "regr_avgy", "regr_count",
+    "regr_intercept", "regr_r2", "regr_slope", "regr_sxx", "regr_sxy", "regr_syy", "round", "scale",
+    "sign", "sin", "sqrt", "tan", "to_char", "to_number", "to_timestamp", "trim_scale", "trunc",
+    "width_bucket", "percentile_cont", "percentile_disc", "mode", "ntile", "cume_dist", "percent_rank",
+    "nth_value", "first_value", "last_value", "generate_series", "string_agg", "array_agg",
+}
+
+# Esquemas de sistema que se pueden consultar calificados (information_schema.columns, ...)
+SYSTEM_SCHEMAS = {"information_schema", "pg_catalog"}
+
+_TRAILING_COMMA_BEFORE = {TokenType.FROM, TokenType.R_PAREN, TokenType.SELECT, TokenType.WHERE,
+                          TokenType.GROUP_BY, TokenType.ORDER_BY, TokenType.SEMICOLON}
+_SQL_START = re.compile(r"(?i)\b(select|with)\b")
+_ANSI = re.compile(r"\x1b\[[0-9;]*m")
+
+
+# ===================== PARSEO Y DIVISIÓN ======================
+
+def _parse_error_text(e: ParseError) -> str:
+    if not e.errors:
+        return _ANSI.sub("", str(e))
+    err = e.errors[0]
+    near = _ANSI.sub("", err.get("highlight") or "")
+    return f"Error de sintaxis: {err['description']} (línea {err['line']}, columna {err['col']}, cerca de '{near}')"
+
+
+def split_sql(sql_text: str) -> list:
+    """Divide un texto SQL en sentencias según los ';' reales (no los de strings o comentarios)."""
+    try:
+        tokens = _DIALECT.tokenize(sql_text)
+    except TokenError:
+        # Se deja entero: validate_sql reporta el error
+        return [sql_text.strip().rstrip(";") + ";"] if sql_text.strip() else []
+    statements, start = [], 0
+    for tok in tokens:
+        if tok.token_type == TokenType.SEMICOLON:
+            statements.append(sql_text[start:tok.start])
+            start = tok.end + 1
+    statements.append(sql_text[start:])
+    return [s.strip() + ";" for s in statements if s.strip()]
+
+
+def read_only_error(tree) -> str:
+    """Motivo por el que la sentencia no es de solo lectura ('' si lo es)."""
+    if not isinstance(tree, exp.Query):
+        return f"Solo se permiten consultas SELECT o WITH (se recibió {tree.key.upper()})."
+    node = tree.find(*_WRITE_NODES)
+    if node is not None:
+        return f"La consulta contiene una operación no permitida: {node.key.upper()}."
+    return ""
+
+
+def function_errors(tree) -> list:
+    """Funciones fuera de ALLOWED_FUNCTIONS (pg_sleep, set_config, ...) usadas en la sentencia."""
+    return [f"Función desconocida o no permitida: {func.name}."
+            for func in tree.find_all(exp.Anonymous) if func.name.lower() not in ALLOWED_FUNCTIONS]
+
+
+def is_read_only(query: str) -> bool:
+    """True si el texto es exactamente una sentencia SELECT/WITH de solo lectura y solo usa funciones permitidas."""
+    if not query or not query.strip():
+        return False
+    try:
+        statements = [s for s in sqlglot.parse(query, read=DIALECT) if s is not None]
+    except (ParseError, TokenError):
+        return False
+    return len(statements) == 1 and not read_only_error(statements[0]) and not function_errors(statements[0])
+
+
+def _leading_statement(text: str):
+    """Primera sentencia de lectura válida al inicio de `text`: (sql, fin) o (None, 0)."""
+    ends = []
+    try:
+        ends = [tok.end + 1 for tok in _DIALECT.tokenize(text) if tok.token_type == TokenType.SEMICOLON]
+    except TokenError:
+        pass
+    # Sin ';' (o con prosa después) se prueba cortando por líneas, de la más larga a la más corta
+    ends += [len(text)] + [m.start() for m in reversed(list(re.finditer(r"\n", text)))]
+    for end in ends:
+        sql = text[:end].strip().rstrip(";").strip()
+        if sql and is_read_only(sql):
+            return sql + ";", end
+    return None, 0
+
+
+def extract_sql(text: str) -> list:
+    """Extrae las consultas SELECT/WITH de un texto libre generado por el modelo."""
+    queries, pos = [], 0
+    for m in _SQL_START.finditer(text):
+        if m.start() < pos:
+            continue
+        sql, end = _leading_statement(text[m.start():])
+        if sql:
+            queries.append(sql)
+            pos = m.start() + end
+    return queries
+
+
+# ===================== VALIDACIÓN CONTRA EL ESQUEMA ======================
+
+def catalog_schema(catalog) -> dict:
+    """{tabla: {columna: tipo}} con tablas y vistas materializadas del catálogo."""
+    schema = {}
+    for source in (catalog.tables, getattr(catalog, "views", None) or {}):
+        for table, cols in source.items():
+            schema[table] = {c: "unknown" for c, _ in cols}
+    return schema
+
+
+def _resolve(identifier) -> str:
+    """Nombre como lo resuelve Postgres: sin comillas se pasa a minúsculas."""
+    return identifier.this if identifier.quoted else identifier.this.lower()
+
+
+def _suggest(name: str, options) -> str:
+    options = sorted(set(options))
+    close = [o for o in options if o.lower() == name.lower()]
+    if not close:
+        lowered = difflib.get_close_matches(name.lower(), [o.lower() for o in options], n=3, cutoff=0.6)
+        close = [next(o for o in options if o.lower() == c) for c in lowered]
+    if not close:
+        return ""
+    return " ¿Quisiste decir " + " o ".join(f'"{c}"' for c in close) + "?"
+
+
+def _trailing_commas(query: str) -> list:
+    try:
+        tokens = _DIALECT.tokenize(query)
+    except TokenError:
+        return []
+    errors = []
+    for tok, nxt in zip(tokens, tokens[1:] + [None]):
+        if tok.token_type == TokenType.COMMA and (nxt is None or nxt.token_type in _TRAILING_COMMA_BEFORE):
+            where = nxt.text.upper() if nxt is not None else "el final"
+            errors.append(f"Coma sobrante antes de {where} (línea {tok.line}, columna {tok.col}).")
+    return errors
+
+
+def validate_sql(query: str, catalog=None) -> list:
+    """Errores de la consulta ([] si es válida). Sin catálogo solo se revisan sintaxis y tipo de sentencia."""
+    if not query or not query.strip():
+        return ["La consulta está vacía."]
+    errors = _trailing_commas(query)
+    try:
+        statements = [s for s in sqlglot.parse(query, read=DIALECT) if s is not None]
+    except (ParseError, TokenError) as e:
+        # Una coma sobrante ya explica el error de sintaxis que provoca
+        return errors or [_parse_error_text(e) if isinstance(e, ParseError) else f"Error de sintaxis: {e}"]
+    if len(statements) != 1:
+        return errors + [f"Cada elemento de \"sql\" debe tener exactamente una sentencia (se recibieron {len(statements)})."]
+    tree = statements[0]
+    reason = read_only_error(tree)
+    if reason:
+        return errors + [reason]
+
+    errors += function_errors(tree)
+    if catalog is None:
+        return errors
+
+    schema = catalog_schema(catalog)
+    ctes = {_resolve(cte.args["alias"].this) for cte in tree.find_all(exp.CTE) if cte.args.get("alias")}
+    missing, system = [], False
+    for table in tree.find_all(exp.Table):
+        if not isinstance(table.this, exp.Identifier):
+            continue
+        if table.args.get("db") is not None and _resolve(table.args["db"]) in SYSTEM_SCHEMAS:
+            system = True
+            continue
+        name = _resolve(table.this)
+        if name not in schema and name not in ctes:
+            missing.append(f"La tabla {table.this.sql(dialect=DIALECT)} no existe.{_suggest(name, schema)}")
+    # Con tablas inexistentes no se pueden resolver las columnas; las de sistema no están en el catálogo
+    if missing or system:
+        return errors + missing
+    return errors + _column_errors(tree, schema)
+
+
+def _scope_columns(scope, schema: dict):
+    """Columnas visibles desde `scope` (y sus scopes externos): {fuente: set de columnas o None si se desconocen}."""
+    visible = {}
+    while scope is not None:
+        for name, source in scope.sources.items():
+            if name in visible:
+                continue
+            if isinstance(source, exp.Table):
+                known = schema.get(_resolve(source.this)) if isinstance(source.this, exp.Identifier) else None
+                visible[name] = set(known) if known is not None else None
+            else:
+                selects = source.expression.named_selects if isinstance(source.expression, exp.Query) else []
+                star = isinstance(source.expression, exp.Query) and any(
+                    isinstance(e, exp.Star) or (isinstance(e, exp.Column) and isinstance(e.this, exp.Star))
+                    for e in source.expression.selects)
+                visible[name] = None if star else set(selects)
+        scope = scope.parent
+    return visible
+
+
+def _column_errors(tree, schema: dict, max_errors: int = 5) -> list:
+    """Columnas que no resuelven, buscadas en el AST scope por scope (tablas, subconsultas y CTEs).
+
+    Un alias del SELECT vale en GROUP BY, ORDER BY y HAVING, como en Postgres. Si
+    alguna fuente tiene columnas desconocidas (tablas de sistema, funciones de
+    tabla, SELECT *), las columnas sin calificar no se revisan.
+    """
+    columns = [c for cols in schema.values() for c in cols]
+    errors, seen = [], set()
+    for scope in traverse_scope(tree):
+        visible = _scope_columns(scope, schema)
+        aliases = set(scope.expression.named_selects) if isinstance(scope.expression, exp.Select) else set()
+        for column in scope.columns:
+            if not isinstance(column.this, exp.Identifier):
+                continue
+            name = _resolve(column.this)
+            if column.table:
+                known = visible.get(column.table)
+                if column.table not in visible or known is None or name in known:
+                    continue
+            elif any(known is None or name in known for known in visible.values()):
+                continue
+            elif name in aliases and column.find_ancestor(exp.Group, exp.Order, exp.Having) is not None:
+                continue
+            if name not in seen:
+                seen.add(name)
+                errors.append(f"La columna {name} no existe en las tablas de la consulta.{_suggest(name, columns)}")
+    return errors[:max_errors]
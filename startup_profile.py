@@ -0,0 +1,139 @@
+# startup_profile.py
+"""Perfil de arranque: cuánto cuesta importar cada punto de entrada y qué módulo lo explica.
+
+Cada objetivo se importa en un proceso nuevo con `python -X importtime`, `--repeat`
+veces: la primera corrida es el arranque en frío (bytecode y caché de disco sin
+calentar) y la mediana de las siguientes es el arranque en caliente, que es lo que
+paga cada worker nuevo. Para cada objetivo se reporta el tiempo total de import, los
+paquetes raíz que más tiempo propio suman (openai, langchain, pandas, ...) y los
+imports directos más caros.
+
+El objetivo "app" importa los mismos módulos que app.py sin ejecutar el script de
+Streamlit. Termina con código 1 si algún objetivo no se puede importar o si supera
+en caliente el presupuesto (--budget-ms, por defecto STARTUP_BUDGET_MS = 2000 ms).
+
+Uso:
+    python startup_profile.py [--targets app,server,pipeline,backend,rag]
+                              [--repeat 5] [--top 10] [--budget-ms 1500] [--output startup.json]
+"""
+import os
+import re
+import ast
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "2000"))  # import en caliente por objetivo; 0 = sin presupuesto
+DEFAULT_TARGETS = "app,server,pipeline,backend,rag"
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+_IMPORTTIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def entry_modules(target: str) -> list:
+    """Módulos que importa el objetivo: los imports de primer nivel de app.py, o el módulo mismo."""
+    if target != "app":
+        return [target]
+    with open(os.path.join(_ROOT, "app.py"), "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and not node.level:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def parse_importtime(stderr: str) -> list:
+    """[(módulo, propio_us, acumulado_us, profundidad)] de la salida de -X importtime."""
+    entries = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return entries
+
+
+def profile_once(modules: list) -> dict:
+    """Importa `modules` en un proceso nuevo; {"import_ms", "entries"} o {"error"}."""
+    code = (
+        "import time; _t = time.perf_counter()\n"
+        + "".join(f"import {m}\n" for m in modules)
+        + "print((time.perf_counter() - _t) * 1000)"
+    )
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=_ROOT,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        lines = [l for l in proc.stderr.splitlines() if not l.startswith("import time:")]
+        return {"error": lines[-1] if lines else f"código de salida {proc.returncode}"}
+    return {"import_ms": float(proc.stdout.strip().splitlines()[-1]), "entries": parse_importtime(proc.stderr)}
+
+
+def summarize_entries(entries: list, modules: list, top: int) -> dict:
+    """Tiempo propio por paquete raíz y acumulado de los imports directos del objetivo, en ms."""
+    by_root = {}
+    for name, self_us, _, _ in entries:
+        root = name.split(".")[0]
+        by_root[root] = by_root.get(root, 0) + self_us
+    direct = {name: cumulative_us for name, _, cumulative_us, depth in entries if depth == 0 and name in modules}
+    top_roots = sorted(by_root.items(), key=lambda kv: -kv[1])[:top]
+    return {
+        "modules_loaded": len(entries),
+        "packages": {root: round(us / 1000, 1) for root, us in top_roots},
+        "direct_imports": {name: round(us / 1000, 1) for name, us in sorted(direct.items(), key=lambda kv: -kv[1])},
+    }
+
+
+def profile_target(target: str, repeat: int, top: int) -> dict:
+    modules = entry_modules(target)
+    runs = [profile_once(modules) for _ in range(max(1, repeat))]
+    failed = next((r for r in runs if "error" in r), None)
+    if failed:
+        return {"modules": modules, "error": failed["error"]}
+    times = [r["import_ms"] for r in runs]
+    warm = times[1:] or times
+    return {
+        "modules": modules,
+        "cold_ms": round(times[0], 1),
+        "warm_ms": round(statistics.median(warm), 1),
+        "warm_max_ms": round(max(warm), 1),
+        # El desglose sale de la última corrida (en caliente)
+        **summarize_entries(runs[-1]["entries"], modules, top),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Perfil del costo de importar cada punto de entrada.")
+    parser.add_argument("--targets", default=DEFAULT_TARGETS, help="Objetivos separados por coma ('app' o un módulo)")
+    parser.add_argument("--repeat", type=int, default=5, help="Procesos por objetivo (el primero es en frío)")
+    parser.add_argument("--top", type=int, default=10, help="Paquetes a listar por objetivo")
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS,
+                        help="Máximo de import en caliente por objetivo (0 = sin presupuesto)")
+    parser.add_argument("--output", default=None, help="Archivo donde escribir el reporte")
+    args = parser.parse_args()
+
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    report = {t: profile_target(t, args.repeat, args.top) for t in targets}
+    failures = [t for t, r in report.items() if "error" in r]
+    over = [t for t, r in report.items() if args.budget_ms and r.get("warm_ms", 0) > args.budget_ms]
+    if args.budget_ms:
+        report["budget"] = {"warm_ms": args.budget_ms, "over": over}
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    for target in failures:
+        print(f"ERROR {target}: {report[target]['error']}", file=sys.stderr)
+    for target in over:
+        print(f"PRESUPUESTO {target}: {report[target]['warm_ms']} ms > {args.budget_ms} ms", file=sys.stderr)
+    if failures or over:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# tokens.py
+import os
+import logging
+from functools import lru_cache
+import tiktoken
+
+# Presupuesto de entrada por llamada: el menor entre LLM_INPUT_TOKEN_BUDGET y la
+# ventana de contexto del modelo menos lo reservado para la respuesta.
+LLM_INPUT_TOKEN_BUDGET = int(os.getenv("LLM_INPUT_TOKEN_BUDGET", "16000"))
+LLM_OUTPUT_RESERVE = int(os.getenv("LLM_OUTPUT_RESERVE", "2000"))
+DEFAULT_ENCODING = "o200k_base"
+
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4.1-mini": 1047576,
+    "gpt-4-turbo": 128000,
+    "gpt-3.5-turbo": 16385,
+}
+
+# Overhead por mensaje del formato de chat de OpenAI
+TOKENS_PER_MESSAGE = 3
+TOKENS_REPLY_PRIMING = 3
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Encoding de tiktoken del modelo; None si no se puede cargar (p. ej. sin red para bajarlo)."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception:
+        logging.warning("No se pudo cargar el encoding de tiktoken; se estiman los tokens (~4 caracteres/token)", exc_info=True)
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list, model: str) -> int:
+    """Cuenta exacta de tokens de entrada de una lista de mensajes de chat."""
+    total = TOKENS_REPLY_PRIMING
+    for m in messages:
+        total += TOKENS_PER_MESSAGE + count_tokens(m.get("role", ""), model) + count_tokens(m.get("content") or "", model)
+    return total
+
+
+def input_budget(model: str) -> int:
+    window = MODEL_CONTEXT_WINDOWS.get(model)
+    if window is None:
+        return LLM_INPUT_TOKEN_BUDGET
+    return min(LLM_INPUT_TOKEN_BUDGET, window - LLM_OUTPUT_RESERVE)
+
+
+def fit_to_budget(build, history: list, chunks: list, sample_rows: int, model: str, budget: int = None, keep_history: int = 1):
+    """Arma el prompt y lo recorta hasta que entre en el presupuesto de tokens.
+
+    `build(history, chunks, sample_rows)` devuelve (messages, parts), donde parts es
+    {nombre: texto o lista de mensajes} para el desglose de tokens. Se recorta en este
+    orden: historial más antiguo (conservando los últimos `keep_history` mensajes),
+    chunks RAG menos relevantes y filas de ejemplo.
+
+    Devuelve (messages, report) con el total, el presupuesto, lo recortado y los tokens por parte.
+    """
+    budget = budget or input_budget(model)
+    trimmed = {"history": 0, "rag": 0, "samples": 0}
+    history, chunks = list(history), list(chunks)
+    # Entre iteraciones solo cambia lo recortado: cada mensaje se tokeniza una vez
+    counted = {}
+
+    def message_tokens(messages):
+        total = TOKENS_REPLY_PRIMING
+        for m in messages:
+            key = (m.get("role", ""), m.get("content") or "")
+            if key not in counted:
+                counted[key] = TOKENS_PER_MESSAGE + count_tokens(key[0], model) + count_tokens(key[1], model)
+            total += counted[key]
+        return total
+
+    while True:
+        messages, parts = build(history, chunks, sample_rows)
+        total = message_tokens(messages)
+        if total <= budget:
+            break
+        if len(history) > keep_history:
+            history = history[1:]
+            trimmed["history"] += 1
+        elif chunks:
+            chunks = chunks[:-1]
+            trimmed["rag"] += 1
+        elif sample_rows > 0:
+            sample_rows -= 1
+            trimmed["samples"] += 1
+        else:
+            break
+    report = {
+        "total": total,
+        "budget": budget,
+        "over_budget": total > budget,
+        "trimmed": trimmed,
+        "parts": {
+            name: count_message_tokens(part, model) - TOKENS_REPLY_PRIMING if isinstance(part, list) else count_tokens(part, model)
+            for name, part in parts.items()
+        },
+    }
+    return messages, report
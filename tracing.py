@@ -0,0 +1,267 @@
+# tracing.py
+"""Spans por etapa de cada turno, escritos como líneas JSON y agregados en percentiles.
+
+Cada span registra nombre, duración, padre (para reconstruir el árbol del turno),
+estado y atributos numéricos (tokens, filas, aciertos de caché, reintentos). La
+escritura al archivo pasa por un QueueHandler: el hilo que mide nunca espera E/S.
+Los percentiles móviles alimentan el panel de diagnóstico de la app y, si se define
+METRICS_PORT, un endpoint /metrics en formato de texto de Prometheus.
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+TRACE_FILE = os.getenv("TRACE_FILE", "llm_sql_trace.jsonl")
+TRACE_WINDOW = int(os.getenv("TRACE_WINDOW", "500"))  # spans por nombre para los percentiles
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = sin endpoint de Prometheus
+
+_CURRENT = contextvars.ContextVar("tracing_span", default=None)
+_LOGGER = logging.getLogger("llm_sql.trace")
+_LISTENER = None
+_SETUP_LOCK = threading.Lock()
+
+
+def _ensure_listener():
+    """Conecta el logger de trazas a la cola y arranca el hilo que escribe el archivo."""
+    global _LISTENER
+    if _LISTENER is not None:
+        return
+    with _SETUP_LOCK:
+        if _LISTENER is not None:
+            return
+        q = queue.SimpleQueue()
+        file_handler = logging.FileHandler(TRACE_FILE, encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        _LOGGER.addHandler(QueueHandler(q))
+        _LOGGER.setLevel(logging.INFO)
+        _LOGGER.propagate = False
+        _LISTENER = QueueListener(q, file_handler)
+        _LISTENER.start()
+        atexit.register(_LISTENER.stop)
+
+
+# ===================== AGREGADOS MÓVILES ======================
+
+class RollingStats:
+    """Últimas TRACE_WINDOW duraciones por span, más contadores y totales de atributos."""
+
+    def __init__(self, window: int = TRACE_WINDOW):
+        self._window = window
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._counts = {}
+        self._errors = {}
+        self._attrs = {}
+
+    def record(self, name: str, duration_ms: float, error: bool, attrs: dict):
+        with self._lock:
+            self._durations.setdefault(name, deque(maxlen=self._window)).append(duration_ms)
+            self._counts[name] = self._counts.get(name, 0) + 1
+            self._errors[name] = self._errors.get(name, 0) + int(error)
+            totals = self._attrs.setdefault(name, {})
+            for key, value in attrs.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[key] = totals.get(key, 0) + value
+                elif isinstance(value, bool):
+                    totals[key] = totals.get(key, 0) + int(value)
+
+    def snapshot(self) -> dict:
+        """{span: {"count", "errors", "p50", "p95", "p99", "mean", "totals"}} (duraciones en ms)."""
+        with self._lock:
+            items = {n: (list(d), self._counts[n], self._errors[n], dict(self._attrs[n])) for n, d in self._durations.items()}
+        out = {}
+        for name, (durations, count, errors, totals) in sorted(items.items()):
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            out[name] = {
+                "count": count,
+                "errors": errors,
+                "p50": round(float(p50), 2),
+                "p95": round(float(p95), 2),
+                "p99": round(float(p99), 2),
+                "mean": round(float(np.mean(durations)), 2),
+                "totals": totals,
+            }
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+            self._counts.clear()
+            self._errors.clear()
+            self._attrs.clear()
+
+
+stats = RollingStats()
+
+
+# ===================== SPANS ======================
+
+class Span:
+    """Un tramo medido; los atributos se agregan con set() o add() antes de end()."""
+
+    def __init__(self, name: str, parent=None, **attrs):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs = dict(attrs)
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def add(self, key: str, value=1):
+        self.attrs[key] = self.attrs.get(key, 0) + value
+        return self
+
+    def end(self, error: Exception = None):
+        if self.duration_ms is not None:
+            return
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        if error is not None:
+            self.attrs["error"] = f"{type(error).__name__}: {error}"
+        stats.record(self.name, self.duration_ms, error is not None, self.attrs)
+        _ensure_listener()
+        _LOGGER.info(json.dumps({
+            "ts": round(self.started_at, 3),
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": "error" if error is not None else "ok",
+            "attrs": self.attrs,
+        }, ensure_ascii=False, default=str))
+
+
+def current_span():
+    return _CURRENT.get()
+
+
+def start_span(name: str, parent=None, **attrs) -> Span:
+    """Abre un span sin volverlo el actual (para tramos que cruzan yields de un generador)."""
+    return Span(name, parent if parent is not None else _CURRENT.get(), **attrs)
+
+
+@contextmanager
+def span(name: str, parent=None, **attrs):
+    """Mide el bloque como un span hijo del actual (o de `parent`) y lo vuelve el actual."""
+    s = start_span(name, parent, **attrs)
+    token = _CURRENT.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.end(error=e)
+        raise
+    finally:
+        _CURRENT.reset(token)
+        s.end()
+
+
+def bind_context(fn):
+    """Envuelve fn para que corra con el contexto actual (spans) en otro hilo del pool."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+# ===================== EXPORTADOR PROMETHEUS ======================
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+_EXTRA_METRICS = []
+
+
+def register_metric(name: str, kind: str, help_text: str, fn, label: str = None):
+    """Agrega a /metrics una métrica de otro módulo: fn() devuelve un número o, con `label`, {valor_label: número}."""
+    _EXTRA_METRICS.append((name, kind, help_text, fn, label))
+
+
+def _extra_metric_lines() -> list:
+    lines = []
+    for name, kind, help_text, fn, label in _EXTRA_METRICS:
+        try:
+            value = fn()
+        except Exception:
+            logging.exception(f"No se pudo calcular la métrica {name}")
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        if label:
+            lines += [f'{name}{{{label}="{_label(str(k))}"}} {v}' for k, v in sorted(value.items())]
+        else:
+            lines.append(f"{name} {value}")
+    return lines
+
+
+def prometheus_text() -> str:
+    """Métricas agregadas en formato de texto de Prometheus."""
+    lines = [
+        "# HELP llm_sql_span_duration_ms Duración de los spans por etapa (ventana móvil).",
+        "# TYPE llm_sql_span_duration_ms summary",
+    ]
+    snap = stats.snapshot()
+    for name, s in snap.items():
+        for q in ("50", "95", "99"):
+            lines.append(f'llm_sql_span_duration_ms{{span="{_label(name)}",quantile="0.{q}"}} {s["p" + q]}')
+        lines.append(f'llm_sql_span_duration_ms_count{{span="{_label(name)}"}} {s["count"]}')
+    lines += ["# HELP llm_sql_span_errors_total Spans terminados con error.", "# TYPE llm_sql_span_errors_total counter"]
+    lines += [f'llm_sql_span_errors_total{{span="{_label(n)}"}} {s["errors"]}' for n, s in snap.items()]
+    lines += ["# HELP llm_sql_span_attr_total Suma de atributos numéricos por span (tokens, filas, aciertos, reintentos).",
+              "# TYPE llm_sql_span_attr_total counter"]
+    for name, s in snap.items():
+        for attr, value in sorted(s["totals"].items()):
+            lines.append(f'llm_sql_span_attr_total{{span="{_label(name)}",attr="{_label(attr)}"}} {value}')
+    lines += _extra_metric_lines()
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_METRICS_SERVER = None
+
+
+def start_metrics_server(port: int = None):
+    """Sirve /metrics en `port` (una vez por proceso). Sin puerto configurado no hace nada."""
+    global _METRICS_SERVER
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    with _SETUP_LOCK:
+        if _METRICS_SERVER is None:
+            try:
+                _METRICS_SERVER = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            except OSError:
+                logging.exception(f"No se pudo abrir el endpoint de métricas en el puerto {port}")
+                return None
+            threading.Thread(target=_METRICS_SERVER.serve_forever, name="metrics", daemon=True).start()
+        return _METRICS_SERVER
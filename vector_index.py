@@ -0,0 +1,168 @@
+# vector_index.py
+import os
+import re
+import json
+import hashlib
+from abc import ABC, abstractmethod
+from collections import namedtuple
+import numpy as np
+
+# Resultado de búsqueda compatible con los Document de LangChain (page_content/metadata)
+SearchResult = namedtuple("SearchResult", ["page_content", "metadata", "score"])
+
+
+class VectorIndex(ABC):
+    """Interfaz mínima de índice vectorial que usa rag.py.
+
+    El Chroma de LangChain ya la cumple (similarity_search, add_texts con ids, delete);
+    NumpyVectorIndex es la alternativa en proceso para corpus pequeños.
+    """
+
+    @abstractmethod
+    def similarity_search(self, query: str, k: int = 5) -> list:
+        ...
+
+    @abstractmethod
+    def add_texts(self, texts, metadatas=None, ids=None):
+        ...
+
+    @abstractmethod
+    def delete(self, ids=None):
+        ...
+
+
+class HashingEmbeddings:
+    """Embeddings locales y deterministas: n-gramas de caracteres hasheados (feature hashing).
+
+    No requiere red ni modelo; sirve para correr y medir el camino RAG offline.
+    """
+
+    def __init__(self, dim: int = 1024, ngram_range=(3, 5)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def _features(self, text: str):
+        text = " " + re.sub(r"\s+", " ", text.lower()).strip() + " "
+        lo, hi = self.ngram_range
+        for n in range(lo, hi + 1):
+            for i in range(max(len(text) - n + 1, 0)):
+                h = int.from_bytes(hashlib.blake2b(text[i:i + n].encode("utf-8"), digest_size=8).digest(), "little")
+                yield h % self.dim, 1.0 if (h >> 63) & 1 else -1.0
+
+    def _embed(self, text: str) -> list:
+        feats = list(self._features(text))
+        if not feats:
+            return [0.0] * self.dim
+        idx, signs = zip(*feats)
+        vec = np.bincount(np.asarray(idx), weights=np.asarray(signs), minlength=self.dim)
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm else vec).tolist()
+
+    def embed_query(self, text: str) -> list:
+        return self._embed(text)
+
+    def embed_documents(self, texts) -> list:
+        return [self._embed(t) for t in texts]
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class NumpyVectorIndex(VectorIndex):
+    """Índice en proceso: matriz float32 normalizada en un .npy (memory-mapped) + chunks en JSON.
+
+    La búsqueda es un único producto matricial y argpartition para el top-k.
+    """
+
+    MATRIX_FILE = "embeddings.npy"
+    CHUNKS_FILE = "chunks.json"
+
+    def __init__(self, directory: str, embedding):
+        self.directory = directory
+        self.embedding = embedding
+        matrix_path = os.path.join(directory, self.MATRIX_FILE)
+        chunks_path = os.path.join(directory, self.CHUNKS_FILE)
+        self._matrix = np.load(matrix_path, mmap_mode="r") if os.path.exists(matrix_path) else np.zeros((0, 0), dtype=np.float32)
+        if os.path.exists(chunks_path):
+            with open(chunks_path, "r", encoding="utf-8") as f:
+                self._chunks = json.load(f)
+        else:
+            self._chunks = []
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return all(os.path.exists(os.path.join(directory, n)) for n in (cls.MATRIX_FILE, cls.CHUNKS_FILE))
+
+    @classmethod
+    def from_texts(cls, texts, embedding, directory: str, metadatas=None, ids=None):
+        """Embebe los textos y persiste el índice en `directory`."""
+        os.makedirs(directory, exist_ok=True)
+        cls._write(directory, np.zeros((0, 0), dtype=np.float32), [])
+        index = cls(directory, embedding)
+        index.add_texts(texts, metadatas=metadatas, ids=ids)
+        return index
+
+    def add_texts(self, texts, metadatas=None, ids=None, batch_size: int = 256):
+        """Agrega chunks (embebidos en lotes) y reescribe el índice una sola vez."""
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids else [hashlib.sha256(t.encode("utf-8")).hexdigest() for t in texts]
+        vectors = [
+            np.asarray(self.embedding.embed_documents(texts[i:i + batch_size]), dtype=np.float32)
+            for i in range(0, len(texts), batch_size)
+        ]
+        new = np.vstack(vectors)
+        matrix = np.vstack([np.asarray(self._matrix), new]) if self._matrix.size else new
+        chunks = self._chunks + [
+            {"id": ids[i], "text": t, "metadata": (metadatas[i] if metadatas else {})} for i, t in enumerate(texts)
+        ]
+        self._write(self.directory, matrix, chunks)
+        self._reload()
+        return ids
+
+    def delete(self, ids=None):
+        """Elimina los chunks con esos ids."""
+        drop = set(ids or [])
+        keep = [i for i, c in enumerate(self._chunks) if c.get("id") not in drop]
+        if len(keep) == len(self._chunks):
+            return
+        matrix = np.asarray(self._matrix)[keep] if keep else np.zeros((0, 0), dtype=np.float32)
+        self._write(self.directory, matrix, [self._chunks[i] for i in keep])
+        self._reload()
+
+    def _reload(self):
+        fresh = type(self)(self.directory, self.embedding)
+        self._matrix, self._chunks = fresh._matrix, fresh._chunks
+
+    @classmethod
+    def _write(cls, directory: str, vectors: np.ndarray, chunks: list):
+        # Escritura atómica: los lectores con el .npy mapeado siguen viendo el archivo anterior
+        matrix_path = os.path.join(directory, cls.MATRIX_FILE)
+        chunks_path = os.path.join(directory, cls.CHUNKS_FILE)
+        with open(matrix_path + ".tmp", "wb") as f:
+            np.save(f, _normalize_rows(vectors).astype(np.float32) if vectors.size else vectors)
+        with open(chunks_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(chunks, f, ensure_ascii=False)
+        os.replace(matrix_path + ".tmp", matrix_path)
+        os.replace(chunks_path + ".tmp", chunks_path)
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def similarity_search(self, query: str, k: int = 5) -> list:
+        n = len(self._chunks)
+        if not n or not self._matrix.size:
+            return []
+        q = np.asarray(self.embedding.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm:
+            q /= norm
+        scores = self._matrix @ q
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [SearchResult(self._chunks[i]["text"], self._chunks[i]["metadata"], float(scores[i])) for i in top]